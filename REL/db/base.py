@@ -1,11 +1,23 @@
 import json
 import logging
 import sqlite3
+import struct
 from array import array
 from os import makedirs, path
+from urllib.request import pathname2url
 
 import requests
 
+# SQLite limits the number of host parameters in a single statement (999 by default).
+SQLITE_MAX_VARIABLES = 900
+
+# Header of the compact candidate format, see ``DB.dict_to_binary``.
+P_E_M_MAGIC = b"\x00PEM"
+P_E_M_VERSION = 1
+
+# Pragmas applied to read-only connections. The negative cache_size is in KiB.
+READ_ONLY_PRAGMAS = {"mmap_size": 2**30, "cache_size": -64000, "query_only": 1}
+
 
 class DB:
     @staticmethod
@@ -30,13 +42,42 @@ class DB:
                     f.write(chunk)
         return local_filename
 
-    def initialize_db(self, fname, table_name, columns):
+    def initialize_db(
+        self,
+        fname,
+        table_name,
+        columns,
+        read_only=False,
+        immutable=False,
+        pragmas=None,
+    ):
         """
         Args:
             fname (str): location of the database.
+            read_only (bool): open an existing database for serving only, without creating
+                the table. Changes made by other connections remain visible.
+            immutable (bool): additionally open a read-only database as immutable, which
+                skips locking and change detection. The database must then not be modified
+                while it is in use.
+            pragmas (dict): overrides ``READ_ONLY_PRAGMAS`` for read-only connections.
         Returns:
             db (sqlite3.Connection): a SQLite3 database with an embeddings table.
         """
+        if immutable and not read_only:
+            raise ValueError("Only a read-only database can be opened as immutable.")
+
+        if read_only:
+            if not path.isfile(fname):
+                raise Exception("{} does not exist!".format(fname))
+
+            uri = "file:{}?mode=ro{}".format(
+                pathname2url(path.abspath(fname)), "&immutable=1" if immutable else ""
+            )
+            db = sqlite3.connect(uri, uri=True, isolation_level=None)
+            for k, v in {**READ_ONLY_PRAGMAS, **(pragmas or {})}.items():
+                db.execute("pragma {} = {}".format(k, v))
+            return db
+
         # open database in autocommit mode by setting isolation_level to None.
         db = sqlite3.connect(fname, isolation_level=None)
         c = db.cursor()
@@ -130,37 +171,128 @@ class DB:
             raise e
 
     def dict_to_binary(self, the_dict):
-        # credit: https://stackoverflow.com/questions/19232011/convert-dictionary-to-bytes-and-back-again-python
-        str = json.dumps(the_dict)
-        binary = " ".join(format(ord(letter), "b") for letter in str)
-        return binary
+        """
+        Encodes a list of ``(entity, p(e|m))`` pairs into the compact candidate format:
+
+        - header: ``P_E_M_MAGIC``, a version byte and the number of candidates ``n``.
+        - ``n`` little-endian uint16 lengths of the UTF-8 encoded entity titles.
+        - ``n`` little-endian float32 probabilities.
+        - the concatenated UTF-8 encoded entity titles.
+
+        Returns:
+            bytes: encoded candidates.
+        """
+        if isinstance(the_dict, dict):
+            the_dict = the_dict.items()
+        titles = [str(ent).encode("utf-8") for ent, _ in the_dict]
+        probs = [prob for _, prob in the_dict]
+        n = len(titles)
+        return b"".join(
+            [
+                struct.pack("<4sBI", P_E_M_MAGIC, P_E_M_VERSION, n),
+                struct.pack("<{}H".format(n), *[len(t) for t in titles]),
+                struct.pack("<{}f".format(n), *probs),
+            ]
+            + titles
+        )
 
     def binary_to_dict(self, the_binary):
+        """
+        Decodes candidates stored by ``dict_to_binary``. Databases created before the
+        compact format was introduced store the candidates as an ASCII bit-string,
+        which is detected and decoded as well.
+
+        Returns:
+            list: ``[entity, p(e|m)]`` pairs.
+        """
+        if not isinstance(the_binary, bytes) or not the_binary.startswith(P_E_M_MAGIC):
+            return self.__legacy_binary_to_dict(the_binary)
+
+        _, version, n = struct.unpack_from("<4sBI", the_binary)
+        if version != P_E_M_VERSION:
+            raise ValueError("Unsupported p(e|m) format version: {}".format(version))
+
+        offset = struct.calcsize("<4sBI")
+        lengths = struct.unpack_from("<{}H".format(n), the_binary, offset)
+        offset += 2 * n
+        probs = struct.unpack_from("<{}f".format(n), the_binary, offset)
+        offset += 4 * n
+
+        res = []
+        for length, prob in zip(lengths, probs):
+            res.append([the_binary[offset : offset + length].decode("utf-8"), prob])
+            offset += length
+        return res
+
+    def __legacy_binary_to_dict(self, the_binary):
+        if isinstance(the_binary, bytes):
+            the_binary = the_binary.decode("ascii")
         jsn = "".join(chr(int(x, 2)) for x in the_binary.split())
         d = json.loads(jsn)
         return d
 
-    def lookup(self, w, table_name, column="emb"):
+    def migrate_p_e_m(self, batch_size=50000, vacuum=True):
         """
+        Rewrites all candidates that are still stored in the legacy bit-string format
+        into the compact format, in place. The migration is resumable; rows that were
+        already converted are skipped.
+
         Args:
-            w: word to look up.
+            batch_size (int): number of rows converted per transaction.
+            vacuum (bool): whether to reclaim the freed space afterwards.
         Returns:
-            embeddings for ``w``, if it exists.
-            ``None``, otherwise.
+            int: number of converted rows.
         """
         c = self.db.cursor()
+        total = 0
+        last_rowid = 0
+        while True:
+            rows = c.execute(
+                "select rowid, p_e_m from {} where rowid > ? and typeof(p_e_m) = 'text' "
+                "order by rowid limit ?".format(self.table_name),
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                break
 
-        res = []
-        c.execute("BEGIN TRANSACTION;")
-        for word in w:
-            e = c.execute(
-                "select {} from {} where word = :word".format(column, table_name),
-                {"word": word},
-            ).fetchone()
-            res.append(e if e is None else array("f", e[0]).tolist())
-        c.execute("COMMIT;")
+            converted = [
+                (self.dict_to_binary(self.binary_to_dict(p_e_m)), rowid)
+                for rowid, p_e_m in rows
+            ]
+            c.execute("BEGIN TRANSACTION;")
+            c.executemany(
+                "update {} set p_e_m = ? where rowid = ?".format(self.table_name),
+                converted,
+            )
+            c.execute("COMMIT;")
 
-        return res
+            last_rowid = rows[-1][0]
+            total += len(rows)
+            print("Converted {} rows".format(total))
+
+        if vacuum:
+            c.execute("VACUUM;")
+        return total
+
+    def lookup(self, w, table_name, column="emb"):
+        """
+        Args:
+            w: list of words to look up.
+        Returns:
+            embeddings for each word in ``w``, in input order. An entry is
+            ``None`` if the word does not exist.
+        """
+        words = list(w)
+        found = {}
+        c = self.db.cursor()
+        for chunk in self.__chunks(list(set(words))):
+            q = "select word, {} from {} where word in ({})".format(
+                column, table_name, ", ".join("?" * len(chunk))
+            )
+            for word, e in c.execute(q, chunk):
+                found[word] = array("f", e).tolist()
+
+        return [found.get(word) for word in words]
 
     def lookup_wik(self, w, table_name, column):
         """
@@ -170,24 +302,115 @@ class DB:
             embeddings for ``w``, if it exists.
             ``None``, otherwise.
         """
+        return self.lookup_wik_batch([w], table_name, column)[0]
+
+    def lookup_wik_batch(self, w, table_name, column):
+        """
+        Resolves a list of words using a handful of ``IN (...)`` queries instead of
+        one query per word.
+
+        Args:
+            w: list of words to look up.
+            column: column to retrieve, or a tuple of columns that are retrieved at once.
+        Returns:
+            results for each word in ``w``, in input order. An entry is ``None``
+            if the word does not exist, or a tuple if multiple columns are retrieved.
+        """
+        words = list(w)
+        columns = [column] if isinstance(column, str) else list(column)
+        found = {}
         c = self.db.cursor()
-        # q = c.execute('select emb from embeddings where word = :word', {'word': w}).fetchone()
-        # return array('f', q[0]).tolist() if q else None
-        if column == "lower":
-            e = c.execute(
-                "select word from {} where {} = :word".format(table_name, column),
-                {"word": w},
-            ).fetchone()
-        else:
-            e = c.execute(
-                "select {} from {} where word = :word".format(column, table_name),
-                {"word": w},
-            ).fetchone()
-        res = (
-            e if e is None else self.binary_to_dict(e[0]) if column == "p_e_m" else e[0]
+        for chunk in self.__chunks(list(set(words))):
+            params = ", ".join("?" * len(chunk))
+            if column == "lower":
+                # A lowercased mention may map to multiple words. A single lookup
+                # returns the first row in index order, i.e. the lowest rowid.
+                q = "select lower, word, min(rowid) from {} where lower in ({}) group by lower".format(
+                    table_name, params
+                )
+            else:
+                q = "select word, {} from {} where word in ({})".format(
+                    ", ".join(columns), table_name, params
+                )
+            for row in c.execute(q, chunk):
+                values = tuple(
+                    self.binary_to_dict(v) if col == "p_e_m" and v is not None else v
+                    for col, v in zip(columns, row[1:])
+                )
+                found[row[0]] = values[0] if isinstance(column, str) else values
+
+        return [found.get(word) for word in words]
+
+    def lookup_wik_alias_batch(self, w, alias_table, table_name, column):
+        """
+        Version of ``lookup_wik_batch`` for a table of precomputed aliases, which only
+        stores the canonical mention of each word. Other columns are retrieved from the
+        row of the canonical mention in ``table_name`` in the same query.
+
+        Args:
+            w: list of words to look up.
+            column: ``"mention"`` or any column of ``table_name``, or a tuple of these.
+        Returns:
+            results for each word in ``w``, in input order. An entry is ``None``
+            if the word does not exist, or a tuple if multiple columns are retrieved.
+        """
+        words = list(w)
+        columns = [column] if isinstance(column, str) else list(column)
+        select = ", ".join(
+            "a.mention" if col == "mention" else "t.{}".format(col) for col in columns
         )
+        found = {}
+        c = self.db.cursor()
+        for chunk in self.__chunks(list(set(words))):
+            q = "select a.word, {} from {} a left join {} t on t.word = a.mention where a.word in ({})".format(
+                select, alias_table, table_name, ", ".join("?" * len(chunk))
+            )
+            for row in c.execute(q, chunk):
+                values = tuple(
+                    self.binary_to_dict(v) if col == "p_e_m" and v is not None else v
+                    for col, v in zip(columns, row[1:])
+                )
+                found[row[0]] = values[0] if isinstance(column, str) else values
 
-        return res
+        return [found.get(word) for word in words]
+
+    def lookup_wik_resolve(self, words, lowers, table_name):
+        """
+        Retrieves the frequencies of ``words`` and the first word matching each of
+        ``lowers`` in the case insensitive index, including its frequency, in a single
+        query per chunk.
+
+        Returns:
+            tuple: a dict that maps existing words onto their frequency and a dict
+            that maps existing lowercased words onto a tuple ``(word, freq)``.
+        """
+        words, lowers = list(set(words)), list(set(lowers))
+        freqs, found_lower = {}, {}
+        size = SQLITE_MAX_VARIABLES // 2
+        c = self.db.cursor()
+        for i in range(0, max(len(words), len(lowers)), size):
+            chunk_words, chunk_lowers = words[i : i + size], lowers[i : i + size]
+            q = (
+                "select 0, word, word, freq from {0} where word in ({1}) union all "
+                "select 1, lower, word, freq from (select lower, word, freq, min(rowid) "
+                "from {0} where lower in ({2}) group by lower)"
+            ).format(
+                table_name,
+                ", ".join("?" * len(chunk_words)),
+                ", ".join("?" * len(chunk_lowers)),
+            )
+            for is_lower, key, word, freq in c.execute(q, chunk_words + chunk_lowers):
+                if is_lower:
+                    found_lower[key] = (word, freq)
+                else:
+                    freqs[key] = freq
+
+        return freqs, found_lower
+
+    @staticmethod
+    def __chunks(words, size=SQLITE_MAX_VARIABLES):
+        for i in range(0, len(words), size):
+            yield words[i : i + size]
 
     def ensure_file(self, name, url=None, logger=logging.getLogger()):
         """
@@ -0,0 +1,82 @@
+import hashlib
+import math
+import struct
+
+# Header of a stored filter: magic, version, number of bits and number of hashes,
+# followed by the key of the file the filter was built from since version 2.
+BLOOM_MAGIC = b"BLMF"
+BLOOM_VERSION = 2
+BLOOM_HEADER = struct.Struct("<4sBQI")
+BLOOM_KEY = struct.Struct("<qq")
+
+
+class BloomFilter:
+    """
+    Compact membership sketch. A key that was added is always reported as present,
+    whereas a key that was not added is reported as present with a probability of
+    roughly ``fp_rate``.
+    """
+
+    def __init__(
+        self, capacity, fp_rate=0.01, n_bits=None, n_hashes=None, source_key=None
+    ):
+        """
+        Args:
+            capacity: expected number of keys.
+            fp_rate: targeted false-positive rate given ``capacity`` keys.
+            source_key: (size, mtime_ns) of the file the filter is built from, which is
+                stored with the filter such that a stale filter can be detected.
+        """
+        if n_bits is None:
+            n_bits = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        if n_hashes is None:
+            n_hashes = max(1, round(n_bits / max(1, capacity) * math.log(2)))
+
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.source_key = source_key
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    def __positions(self, key):
+        # Double hashing, see Kirsch and Mitzenmacher (2006).
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, key):
+        for pos in self.__positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key)
+        )
+
+    def save(self, fname):
+        with open(fname, "wb") as f:
+            f.write(
+                BLOOM_HEADER.pack(
+                    BLOOM_MAGIC, BLOOM_VERSION, self.n_bits, self.n_hashes
+                )
+            )
+            f.write(BLOOM_KEY.pack(*(self.source_key or (-1, -1))))
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "rb") as f:
+            magic, version, n_bits, n_hashes = BLOOM_HEADER.unpack(
+                f.read(BLOOM_HEADER.size)
+            )
+            if magic != BLOOM_MAGIC or version not in [1, BLOOM_VERSION]:
+                raise ValueError("{} is not a supported Bloom filter".format(fname))
+
+            # Filters of version 1 do not store the key of their source.
+            source_key = None
+            if version > 1:
+                source_key = BLOOM_KEY.unpack(f.read(BLOOM_KEY.size))
+                source_key = None if source_key == (-1, -1) else source_key
+
+            bloom = cls(0, n_bits=n_bits, n_hashes=n_hashes, source_key=source_key)
+            bloom.bits = bytearray(f.read())
+        return bloom
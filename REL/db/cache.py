@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+
+# Marker for keys that are not cached, so that ``None`` (a mention that does not exist)
+# can be cached as well.
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Size-bounded least-recently-used cache that keeps track of its hits, misses and
+    evictions, such that its size can be tuned on observed traffic.
+    """
+
+    def __init__(self, maxsize, weight=None):
+        """
+        Args:
+            maxsize: maximum total weight of the entries, the cache is disabled if this is 0.
+            weight: function that returns the weight of a cached value, such as its number
+                of elements. Each entry weighs 1 by default, such that ``maxsize`` bounds
+                the number of entries.
+        """
+        self.maxsize = maxsize
+        self.weight = weight
+        self.data = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            the cached value or ``MISSING`` if the key is not in the cache.
+        """
+        with self.lock:
+            value = self.data.get(key, MISSING)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return value
+
+    def __weigh(self, value):
+        return 1 if self.weight is None else self.weight(value)
+
+    def put(self, key, value):
+        weight = self.__weigh(value)
+        # Values that would evict the whole cache are not cached.
+        if self.maxsize <= 0 or weight > self.maxsize:
+            return
+
+        with self.lock:
+            if key in self.data:
+                self.total -= self.__weigh(self.data[key])
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.total += weight
+            while self.total > self.maxsize:
+                _, evicted = self.data.popitem(last=False)
+                self.total -= self.__weigh(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.total = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.data),
+            "weight": self.total,
+            "maxsize": self.maxsize,
+        }
@@ -1,4 +1,7 @@
+import glob
 import os
+import shutil
+import threading
 from time import time
 
 import numpy as np
@@ -7,6 +10,32 @@ from numpy import float32 as REAL
 from numpy import zeros
 
 from REL.db.base import DB
+from REL.db.bloom import BloomFilter
+from REL.db.cache import MISSING, LRUCache
+
+# Surface variants of each mention that are resolved ahead of time, see
+# ``GenericLookup.load_resolved_alias``.
+ALIAS_SUFFIXES = [",", ".", "!", "'"]
+
+
+def file_key(path):
+    """
+    Returns:
+        tuple: (size, mtime_ns) of a file, which changes whenever the file is modified.
+        Structures that are derived from the database store it to detect that they are
+        stale.
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def wiki_cache_weight(value):
+    """
+    Weight of a cached ``wiki`` result: the number of candidates of the ``p_e_m`` lists
+    it holds, and at least 1.
+    """
+    values = value if isinstance(value, tuple) else [value]
+    return max(sum(len(v) for v in values if isinstance(v, list)), 1)
 
 
 class GenericLookup(DB):
@@ -17,12 +46,30 @@ class GenericLookup(DB):
         table_name="embeddings",
         d_emb=300,
         columns={"emb": "blob"},
+        emb_backend="sqlite",
+        cache_size=0,
+        read_only=False,
+        immutable=False,
+        use_bloom=True,
     ):
         """
         Args:
             name: name of the embedding to retrieve.
             d_emb: embedding dimensions.
             show_progress: whether to print progress.
+            emb_backend: either ``"sqlite"`` to read embeddings from their blobs or ``"mmap"``
+                to read them from a memory-mapped matrix created by ``export_emb_matrix``.
+            cache_size: maximum number of candidates of the (mention, column) results of
+                ``wiki`` that are kept in an LRU cache, 0 disables the cache. A ``p_e_m``
+                result counts its number of candidates and any other result counts as one.
+                A cached candidate takes roughly 200 bytes, e.g. 10 MB for 50000.
+            read_only: open the existing database in read-only serving mode, which is
+                disabled by default. Changes made by other connections remain visible.
+            immutable: additionally open the read-only database as immutable, which skips
+                locking and change detection. The database must then not be modified
+                (e.g. by ``load_wiki``) while it is in use.
+            use_bloom: skip the database for mentions that are reported as missing by the
+                Bloom filter of a table, if it was created using ``build_bloom``.
         """
         self.avg_cnt = {
             "word": {"cnt": 0, "sum": zeros(d_emb)},
@@ -31,20 +78,504 @@ class GenericLookup(DB):
 
         path_db = os.path.join(save_dir, f"{name}.db")
 
+        if emb_backend not in ["sqlite", "mmap"]:
+            raise ValueError("Unknown embedding backend: {}".format(emb_backend))
+
         self.d_emb = d_emb
         self.name = name
-        self.db = self.initialize_db(path_db, table_name, columns)
+        self.save_dir = save_dir
+        self.path_db = path_db
+        self.read_only = read_only
+        self.immutable = immutable
+        self.local = threading.local()
         self.table_name = table_name
         self.columns = columns
+        self.emb_backend = emb_backend
+        self.emb_matrices = {}
+        self.wiki_cache = LRUCache(cache_size, wiki_cache_weight)
+        self.alias_tables = {}
+        self.use_bloom = use_bloom
+        self.blooms = {}
+
+        # Open the connection of the current thread, which creates the table if needed.
+        self.db
+
+    @property
+    def db(self):
+        """
+        Returns:
+            sqlite3.Connection: the connection of the calling thread and process, which is
+            opened on first use.
+        """
+        db = getattr(self.local, "db", None)
+        # A connection must not be shared with a forked process.
+        if db is None or self.local.pid != os.getpid():
+            db = self.initialize_db(
+                self.path_db,
+                self.table_name,
+                self.columns,
+                self.read_only,
+                self.immutable,
+            )
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def __getstate__(self):
+        # Connections and memory maps cannot be pickled, they are reopened on first use.
+        state = self.__dict__.copy()
+        del state["local"]
+        state["emb_matrices"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
 
     def emb(self, words, table_name):
+        if self.emb_backend == "mmap":
+            return self.lookup_emb_matrix(words, table_name)
         g = self.lookup(words, table_name)
         return g
 
     def wiki(self, mention, table_name, column_name="p_e_m"):
-        g = self.lookup_wik(mention, table_name, column_name)
+        g = self.wiki_batch([mention], table_name, column_name)[0]
+        return g
+
+    def wiki_batch(self, mentions, table_name, column_name="p_e_m"):
+        """
+        Batched version of ``wiki``. Results, including mentions that do not exist, are
+        served from the LRU cache where possible; only the remaining mentions are looked
+        up in the database. Cached values are shared and should not be modified.
+        """
+        return self.__cached_lookup(
+            mentions,
+            (table_name, column_name),
+            lambda missing: self.__filtered_lookup_wik_batch(
+                missing, table_name, column_name
+            ),
+        )
+
+    def __cached_lookup(self, mentions, key, lookup):
+        """
+        Serves the results of ``lookup`` from the LRU cache, where ``key`` identifies the
+        table and column(s) that are looked up.
+        """
+        if self.wiki_cache.maxsize <= 0:
+            return lookup(mentions)
+
+        g = [self.wiki_cache.get((*key, mention)) for mention in mentions]
+        missing = list(
+            dict.fromkeys(m for m, value in zip(mentions, g) if value is MISSING)
+        )
+        if missing:
+            found = dict(zip(missing, lookup(missing)))
+            for mention, value in found.items():
+                self.wiki_cache.put((*key, mention), value)
+            g = [
+                found[m] if value is MISSING else value for m, value in zip(mentions, g)
+            ]
         return g
 
+    def __filtered_lookup_wik_batch(self, mentions, table_name, column_name):
+        """
+        Version of ``lookup_wik_batch`` that skips mentions that are definitely missing
+        according to the Bloom filter of the table.
+        """
+        bloom = self.get_bloom(table_name)
+        if bloom is None:
+            return self.lookup_wik_batch(mentions, table_name, column_name)
+
+        prefix = "l:" if column_name == "lower" else "w:"
+        query = [m for m in dict.fromkeys(mentions) if prefix + m in bloom]
+        found = dict(zip(query, self.lookup_wik_batch(query, table_name, column_name)))
+        return [found.get(m) for m in mentions]
+
+    def bloom_path(self, table_name):
+        return os.path.join(self.save_dir, f"{self.name}_{table_name}.bloom")
+
+    def get_bloom(self, table_name):
+        """
+        Returns:
+            BloomFilter: the Bloom filter of the given table or ``None`` if it does not
+            exist, is disabled or is stale, i.e. the database changed after it was built.
+        """
+        if not self.use_bloom:
+            return None
+
+        if table_name not in self.blooms:
+            path_bloom = self.bloom_path(table_name)
+            bloom = BloomFilter.load(path_bloom) if os.path.isfile(path_bloom) else None
+            # The filter is only valid for the database it was built from.
+            if bloom is not None and bloom.source_key != file_key(self.path_db):
+                bloom = None
+            self.blooms[table_name] = bloom
+        return self.blooms[table_name]
+
+    def build_bloom(self, table_name="wiki", fp_rate=0.01, batch_size=50000):
+        """
+        Creates a Bloom filter that covers the word and lower columns (if any) of the
+        given table and stores it next to the database, such that lookups of mentions
+        that do not exist can skip the database. The filter is ignored once the database
+        changes, after which it must be rebuilt.
+
+        Returns:
+            str: path of the created filter.
+        """
+        c = self.db.cursor()
+        columns = {
+            name
+            for _, name, *_ in c.execute("pragma table_info({})".format(table_name))
+        }
+        lower = "lower" if "lower" in columns else "null"
+        n_rows = c.execute("select count(*) from {}".format(table_name)).fetchone()[0]
+        bloom = BloomFilter(
+            (2 if lower == "lower" else 1) * n_rows,
+            fp_rate,
+            source_key=file_key(self.path_db),
+        )
+
+        start = time()
+        rows = c.execute("select word, {} from {}".format(lower, table_name))
+        i = 0
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+
+            for word, lower in batch:
+                bloom.add("w:" + word)
+                if lower is not None:
+                    bloom.add("l:" + lower)
+            i += len(batch)
+            print("Added {}/{}".format(i, n_rows), time() - start)
+
+        path_bloom = self.bloom_path(table_name)
+        bloom.save(path_bloom)
+        self.blooms[table_name] = bloom
+        return path_bloom
+
+    def wiki_resolve(self, words, lowers, table_name="wiki"):
+        """
+        Retrieves everything needed to resolve a set of mention variants in a single
+        round trip, see ``lookup_wik_resolve``. Results are served from the LRU cache
+        where possible.
+
+        Returns:
+            tuple: a dict that maps each word onto its frequency and a dict that maps
+            each lowercased word onto a tuple ``(word, freq)``. Values are ``None`` if
+            the word does not exist.
+        """
+        freqs = {w: self.wiki_cache.get((table_name, "freq", w)) for w in set(words)}
+        found_lower = {
+            l: self.wiki_cache.get((table_name, "lower_freq", l)) for l in set(lowers)
+        }
+        missing_words = [w for w, v in freqs.items() if v is MISSING]
+        missing_lowers = [l for l, v in found_lower.items() if v is MISSING]
+
+        # Definite misses according to the Bloom filter are not looked up.
+        bloom = self.get_bloom(table_name)
+        query_words = [w for w in missing_words if bloom is None or "w:" + w in bloom]
+        query_lowers = [l for l in missing_lowers if bloom is None or "l:" + l in bloom]
+
+        new_freqs, new_lower = {}, {}
+        if query_words or query_lowers:
+            new_freqs, new_lower = self.lookup_wik_resolve(
+                query_words, query_lowers, table_name
+            )
+        for w in missing_words:
+            freqs[w] = new_freqs.get(w)
+            self.wiki_cache.put((table_name, "freq", w), freqs[w])
+        for l in missing_lowers:
+            found_lower[l] = new_lower.get(l)
+            self.wiki_cache.put((table_name, "lower_freq", l), found_lower[l])
+
+        return freqs, found_lower
+
+    def wiki_alias(
+        self,
+        mentions,
+        alias_table="resolved_alias",
+        column_name="mention",
+        table_name="wiki",
+    ):
+        """
+        Retrieves the precomputed canonical mention of each mention, see
+        ``load_resolved_alias``. Other columns of the canonical mention, such as its
+        ``p_e_m`` and ``freq``, are joined from ``table_name`` in the same query if
+        ``column_name`` is a tuple such as ``("mention", "p_e_m")``.
+
+        Returns:
+            canonical mention (or tuple of columns) for each mention in ``mentions``, in
+            input order. An entry is ``None`` if the mention was not resolved ahead of time.
+        """
+        return self.__cached_lookup(
+            mentions,
+            (alias_table, column_name),
+            lambda missing: self.__filtered_lookup_alias_batch(
+                missing, alias_table, table_name, column_name
+            ),
+        )
+
+    def __filtered_lookup_alias_batch(self, mentions, alias_table, table_name, column):
+        """
+        Version of ``lookup_wik_alias_batch`` that skips mentions that are definitely
+        missing according to the Bloom filter of the alias table, such that the database
+        is not queried at all if none of the mentions were resolved ahead of time.
+        """
+        bloom = self.get_bloom(alias_table)
+        query = [
+            m for m in dict.fromkeys(mentions) if bloom is None or "w:" + m in bloom
+        ]
+        if not query:
+            return [None] * len(mentions)
+
+        if alias_table not in self.alias_tables:
+            self.alias_tables[alias_table] = {
+                name
+                for _, name, *_ in self.db.execute(
+                    "pragma table_info({})".format(alias_table)
+                )
+            }
+        if "mention" not in self.alias_tables[alias_table]:
+            return [None] * len(mentions)
+
+        found = dict(
+            zip(
+                query,
+                self.lookup_wik_alias_batch(query, alias_table, table_name, column),
+            )
+        )
+        return [found.get(m) for m in mentions]
+
+    @staticmethod
+    def alias_variants(word):
+        """
+        Returns:
+            list: surface variants of ``word`` that are resolved ahead of time.
+        """
+        return [
+            word,
+            word.lower(),
+            word.upper(),
+            *(word + suffix for suffix in ALIAS_SUFFIXES),
+            "({})".format(word),
+        ]
+
+    def load_resolved_alias(
+        self,
+        table_name="wiki",
+        alias_table="resolved_alias",
+        min_freq=100,
+        batch_size=50000,
+    ):
+        """
+        Precomputes the canonical mention of the surface variants of all mentions that
+        occur at least ``min_freq`` times, using the same rules as ``preprocess_mention``.
+        The results are stored in a separate table that only holds the canonical mention,
+        which is joined with its row in ``table_name``, such that mention normalization
+        and candidate retrieval only require a single indexed lookup at serving time.
+        Each mention adds up to eight variants, so a low ``min_freq`` makes the table
+        considerably larger. A Bloom filter of the variants is stored next to the
+        database, such that mentions without a precomputed alias skip the table.
+
+        Returns:
+            int: number of stored variants.
+        """
+        from REL.utils import preprocess_mentions
+
+        c = self.db.cursor()
+        c.execute("drop table if exists {}".format(alias_table))
+        c.execute(
+            "create table {}(word text primary key, mention text)".format(alias_table)
+        )
+        # Resolve using the rules, not the partially filled table.
+        self.alias_tables[alias_table] = set()
+        if os.path.isfile(self.bloom_path(alias_table)):
+            os.remove(self.bloom_path(alias_table))
+        self.blooms.pop(alias_table, None)
+
+        start = time()
+        last, total = 0, 0
+        while True:
+            rows = c.execute(
+                "select rowid, word from {} where rowid > ? and freq >= ? order by rowid limit ?".format(
+                    table_name
+                ),
+                (last, min_freq, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+
+            variants = list(
+                dict.fromkeys(v for _, word in rows for v in self.alias_variants(word))
+            )
+            resolved = preprocess_mentions(variants, self)
+
+            c_alias = self.db.cursor()
+            c_alias.execute("BEGIN TRANSACTION;")
+            c_alias.executemany(
+                "insert or ignore into {} (word, mention) values (?, ?)".format(
+                    alias_table
+                ),
+                zip(variants, resolved),
+            )
+            c_alias.execute("COMMIT;")
+            total += len(variants)
+            print("Resolved {} variants".format(total), time() - start)
+
+        self.build_bloom(alias_table, batch_size=batch_size)
+        del self.alias_tables[alias_table]
+        self.wiki_cache.clear()
+        return total
+
+    def cache_info(self):
+        """
+        Returns:
+            dict with the hits, misses, evictions, size (number of entries), weight
+            (number of candidates) and maxsize of the ``wiki`` cache.
+        """
+        return self.wiki_cache.info()
+
+    def emb_matrix_path(self, table_name):
+        return os.path.join(self.save_dir, f"{self.name}_{table_name}.npy")
+
+    def lookup_emb_matrix(self, words, table_name):
+        """
+        Retrieves embeddings from the memory-mapped matrix of the given table. The matrix is
+        opened once and shared through the page cache, so that the returned rows are views
+        into the mapped file rather than copies.
+
+        Returns:
+            embeddings for each word in ``words``, in input order. An entry is ``None``
+            if the word does not exist.
+        """
+        if table_name not in self.emb_matrices:
+            path_matrix = self.emb_matrix_path(table_name)
+            if not os.path.isfile(path_matrix):
+                raise Exception(
+                    "{} does not exist! Create it using export_emb_matrix.".format(
+                        path_matrix
+                    )
+                )
+            self.emb_matrices[table_name] = np.load(path_matrix, mmap_mode="r")
+
+        matrix = self.emb_matrices[table_name]
+        rows = self.lookup_wik_batch(words, f"{table_name}_rows", "row")
+        return [None if row is None else matrix[row] for row in rows]
+
+    def load_emb_table(
+        self, table_name="embeddings", entities=None, limit=None, include=()
+    ):
+        """
+        Loads all embeddings of a table at once. With the "mmap" backend the returned
+        matrix is the memory-mapped matrix itself, which is shared through the page cache.
+
+        Args:
+            entities: ``True`` to only load entities, ``False`` to skip entities and ``None``
+                to load all words. The ``ENTITY/`` prefix is removed from entities.
+            limit: maximum number of words to load, in table order.
+            include: words that are always loaded, such as the #UNK# tokens.
+        Returns:
+            tuple: dict that maps each word onto its row and the matrix of embeddings.
+        """
+        if entities is None:
+            cond = "1"
+        else:
+            cond = "substr(word, 1, 7) {} 'ENTITY/'".format("=" if entities else "!=")
+        limit = -1 if limit is None else int(limit)
+        include = list(include)
+        marks = ", ".join("?" * len(include))
+
+        if self.emb_backend == "mmap":
+            path_matrix = self.emb_matrix_path(table_name)
+            if not os.path.isfile(path_matrix):
+                raise Exception(
+                    "{} does not exist! Create it using export_emb_matrix.".format(
+                        path_matrix
+                    )
+                )
+            # Copy-on-write, such that the matrix can be wrapped in a tensor.
+            matrix = np.load(path_matrix, mmap_mode="c")
+            rows = self.db.execute(
+                "select * from (select word, row from {0}_rows where {1} order by row "
+                "limit {2}) union select word, row from {0}_rows where word in ({3})".format(
+                    table_name, cond, limit, marks
+                ),
+                include,
+            ).fetchall()
+        else:
+            data = self.db.execute(
+                "select * from (select word, emb from {0} where {1} order by rowid "
+                "limit {2}) union select word, emb from {0} where word in ({3})".format(
+                    table_name, cond, limit, marks
+                ),
+                include,
+            ).fetchall()
+            rows = [(word, i) for i, (word, _) in enumerate(data)]
+            matrix = np.array(
+                [np.frombuffer(emb, dtype=REAL) for _, emb in data], dtype=REAL
+            ).reshape(len(data), -1)
+
+        if entities:
+            rows = [
+                (w[len("ENTITY/") :] if w.startswith("ENTITY/") else w, r)
+                for w, r in rows
+            ]
+        return dict(rows), matrix
+
+    def export_emb_matrix(self, table_name="embeddings", batch_size=5000):
+        """
+        Converts the embeddings stored in the given table into a contiguous float32 matrix
+        that is stored as ``.npy`` file next to the database, plus a ``<table_name>_rows``
+        table that maps each word onto its row in this matrix.
+
+        Returns:
+            str: path of the created matrix.
+        """
+        c = self.db.cursor()
+        n_rows, d_emb = c.execute(
+            "select count(*), max(length(emb)) / 4 from {}".format(table_name)
+        ).fetchone()
+        path_matrix = self.emb_matrix_path(table_name)
+        matrix = np.lib.format.open_memmap(
+            path_matrix, mode="w+", dtype=REAL, shape=(n_rows, d_emb)
+        )
+
+        index_table = f"{table_name}_rows"
+        c.execute("drop table if exists {}".format(index_table))
+        c.execute(
+            "create table {}(word text primary key, row INTEGER)".format(index_table)
+        )
+
+        start = time()
+        rows = c.execute("select word, emb from {} order by rowid".format(table_name))
+        i = 0
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+
+            for j, (_, emb) in enumerate(batch):
+                matrix[i + j] = np.frombuffer(emb, dtype=REAL)
+
+            index = [(word, i + j) for j, (word, _) in enumerate(batch)]
+            i += len(batch)
+
+            c_index = self.db.cursor()
+            c_index.execute("BEGIN TRANSACTION;")
+            c_index.executemany(
+                "insert into {} values (?, ?)".format(index_table), index
+            )
+            c_index.execute("COMMIT;")
+            print("Exported {}/{}".format(i, n_rows), time() - start)
+
+        matrix.flush()
+        del matrix
+        self.emb_matrices.pop(table_name, None)
+        return path_matrix
+
     def load_word2emb(self, file_name, batch_size=5000, limit=np.inf, reset=False):
         self.seen = set()
         if reset:
@@ -119,6 +650,20 @@ class GenericLookup(DB):
         if reset:
 
             self.clear()
+        self.wiki_cache.clear()
+
+        # Precomputed aliases, filters and tries are derived from this table.
+        self.db.execute("drop table if exists resolved_alias")
+        self.alias_tables.clear()
+        for table_name in [self.table_name, "resolved_alias"]:
+            if os.path.isfile(self.bloom_path(table_name)):
+                os.remove(self.bloom_path(table_name))
+        self.blooms.clear()
+        for path_trie in glob.glob(os.path.join(self.save_dir, "trie_*")):
+            if os.path.isdir(path_trie):
+                shutil.rmtree(path_trie)
+            else:
+                os.remove(path_trie)
 
         batch = []
         start = time()
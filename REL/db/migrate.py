@@ -0,0 +1,85 @@
+"""
+Command line tool that converts an existing database. Supported commands:
+
+- p_e_m: rewrites the p(e|m) candidates from the legacy bit-string format into the compact
+  candidate format, in place.
+- resolved_alias: precomputes the canonical mention of common surface variants, which
+  is used to normalize mentions with a single lookup.
+- bloom: creates a Bloom filter of all mentions, which is used to skip lookups of
+  mentions that do not exist.
+- emb_matrix: exports an embeddings table to a memory-mapped matrix that can be used with
+  the "mmap" embedding backend.
+
+Usage: python -m REL.db.migrate p_e_m <base_url>/<wiki_version>/generated/entity_word_embedding.db
+"""
+
+import argparse
+import os
+
+from REL.db.generic import GenericLookup
+
+
+def open_db(db_path, table_name, columns):
+    if not os.path.isfile(db_path):
+        raise Exception("{} does not exist!".format(db_path))
+
+    save_dir, fname = os.path.split(os.path.abspath(db_path))
+    return GenericLookup(
+        os.path.splitext(fname)[0], save_dir, table_name=table_name, columns=columns
+    )
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    sub = p.add_subparsers(dest="command", required=True)
+
+    p_p_e_m = sub.add_parser("p_e_m")
+    p_p_e_m.add_argument("db_path")
+    p_p_e_m.add_argument("--table-name", default="wiki")
+    p_p_e_m.add_argument("--batch-size", default=50000, type=int)
+    p_p_e_m.add_argument("--no-vacuum", action="store_true")
+
+    p_alias = sub.add_parser("resolved_alias")
+    p_alias.add_argument("db_path")
+    p_alias.add_argument("--min-freq", default=100, type=int)
+    p_alias.add_argument("--batch-size", default=50000, type=int)
+
+    p_bloom = sub.add_parser("bloom")
+    p_bloom.add_argument("db_path")
+    p_bloom.add_argument("--fp-rate", default=0.01, type=float)
+    p_bloom.add_argument("--batch-size", default=50000, type=int)
+
+    p_emb = sub.add_parser("emb_matrix")
+    p_emb.add_argument("db_path")
+    p_emb.add_argument("--table-name", default="embeddings")
+    p_emb.add_argument("--batch-size", default=5000, type=int)
+    args = p.parse_args()
+
+    if args.command == "p_e_m":
+        wiki_db = open_db(
+            args.db_path,
+            args.table_name,
+            {"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+        )
+        total = wiki_db.migrate_p_e_m(args.batch_size, vacuum=not args.no_vacuum)
+        print("Done, converted {} rows.".format(total))
+    elif args.command == "resolved_alias":
+        wiki_db = open_db(
+            args.db_path, "wiki", {"p_e_m": "blob", "lower": "text", "freq": "INTEGER"}
+        )
+        total = wiki_db.load_resolved_alias(
+            min_freq=args.min_freq, batch_size=args.batch_size
+        )
+        print("Done, stored {} variants.".format(total))
+    elif args.command == "bloom":
+        wiki_db = open_db(
+            args.db_path, "wiki", {"p_e_m": "blob", "lower": "text", "freq": "INTEGER"}
+        )
+        path_bloom = wiki_db.build_bloom(
+            fp_rate=args.fp_rate, batch_size=args.batch_size
+        )
+        print("Done, stored filter at {}.".format(path_bloom))
+    elif args.command == "emb_matrix":
+        emb_db = open_db(args.db_path, args.table_name, {"emb": "blob"})
+        path_matrix = emb_db.export_emb_matrix(args.table_name, args.batch_size)
+        print("Done, stored matrix at {}.".format(path_matrix))
@@ -0,0 +1,231 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from REL.vocabulary import Vocabulary
+
+"""
+Class responsible for storing the embeddings that are retrieved while processing datasets.
+"""
+
+
+# Supported data types of stored embeddings. Embeddings stored as "int8" are quantized per row.
+EMB_DTYPES = ["float32", "bfloat16", "int8"]
+
+
+class CompressedEmbedding(torch.nn.Module):
+    """
+    Drop-in replacement for an Embedding or EmbeddingBag (mean) layer whose weight is stored in
+    reduced precision. Looked up rows are converted to float32, such that the model itself is
+    unchanged.
+    """
+
+    def __init__(self, weight, scale=None, bag=False):
+        """
+        :param scale: scale per row of an int8 weight, None if the weight is not quantized.
+        """
+        super(CompressedEmbedding, self).__init__()
+        self.register_buffer("weight", weight)
+        self.register_buffer("scale", scale)
+        self.bag = bag
+
+    def forward(self, ids, offsets=None):
+        embs = F.embedding(ids, self.weight).float()
+        if self.scale is not None:
+            embs = embs * F.embedding(ids, self.scale)
+        if self.bag:
+            # Average the rows of each bag, in the same way as EmbeddingBag.
+            return F.embedding_bag(
+                torch.arange(ids.numel(), device=ids.device),
+                embs.view(ids.numel(), -1),
+                offsets,
+                mode="mean",
+            )
+        return embs
+
+
+class EmbeddingArena:
+    """
+    Keeps the embeddings of a vocabulary in a preallocated matrix that is shared by an
+    Embedding (and optionally an EmbeddingBag) layer. The matrix doubles in size when it
+    is full, such that adding embeddings takes amortized constant time. If max_size is
+    given, the least recently used tokens are evicted and their IDs are reused.
+    """
+
+    def __init__(
+        self, d_emb, device, max_size=None, bag=False, capacity=1024, dtype="float32"
+    ):
+        assert dtype in EMB_DTYPES, "Unknown embedding dtype {}".format(dtype)
+        self.voca = Vocabulary()
+        # Tokens that were looked up, in least recently used order, and whether they
+        # have an embedding. Tokens without embedding are mapped onto #UNK#.
+        self.seen = OrderedDict()
+        self.max_size = max_size
+        self.bag = bag
+        self.evictions = 0
+        # Preloaded arenas contain a fixed vocabulary and are never updated.
+        self.preloaded = False
+
+        self.dtype = dtype
+        self.weight = torch.zeros(
+            capacity, d_emb, device=device, dtype=self.__torch_dtype()
+        )
+        self.scale = torch.ones(capacity, 1, device=device) if dtype == "int8" else None
+        self.embedding = None
+        self.embedding_bag = None
+        self.__build_layers()
+
+    @classmethod
+    def from_table(
+        cls,
+        word2row,
+        matrix,
+        device,
+        unk_token,
+        bag=False,
+        dtype="float32",
+        chunk_size=100000,
+    ):
+        """
+        Creates an arena that wraps a complete table of embeddings, as returned by
+        GenericLookup.load_emb_table. On the CPU the matrix is not copied, such that a
+        memory-mapped matrix stays shared between processes, unless it is stored in reduced
+        precision.
+
+        :param unk_token: word whose embedding is used for unknown tokens.
+        """
+        capacity = 0 if dtype == "float32" else matrix.shape[0]
+        arena = cls(matrix.shape[1], device, bag=bag, capacity=capacity, dtype=dtype)
+        arena.voca.word2id = word2row
+        arena.voca.unk_id = word2row[unk_token]
+        arena.preloaded = True
+
+        if dtype == "float32":
+            arena.weight = torch.from_numpy(matrix).to(device)
+        else:
+            # Convert in chunks, such that the float32 matrix is never copied as a whole.
+            for start in range(0, matrix.shape[0], chunk_size):
+                rows = np.asarray(matrix[start : start + chunk_size])
+                arena.__store(list(range(start, start + len(rows))), rows)
+        arena.__build_layers()
+        return arena
+
+    def __torch_dtype(self):
+        return {
+            "float32": torch.float32,
+            "bfloat16": torch.bfloat16,
+            "int8": torch.int8,
+        }[self.dtype]
+
+    def __build_layers(self):
+        # Both layers share the weight, so they see embeddings that are written to it.
+        if self.dtype == "float32":
+            self.embedding = torch.nn.Embedding.from_pretrained(
+                self.weight, freeze=True
+            )
+            if self.bag:
+                self.embedding_bag = torch.nn.EmbeddingBag.from_pretrained(
+                    self.weight, freeze=True
+                )
+        else:
+            self.embedding = CompressedEmbedding(self.weight, self.scale)
+            if self.bag:
+                self.embedding_bag = CompressedEmbedding(
+                    self.weight, self.scale, bag=True
+                )
+
+    def __store(self, ids, vecs):
+        """
+        Writes float32 embeddings to the given IDs, converting them to the stored dtype.
+        """
+        vecs = torch.tensor(np.array(vecs, dtype=np.float32), device=self.weight.device)
+        if self.dtype == "int8":
+            scale = vecs.abs().max(dim=1, keepdim=True)[0].clamp(min=1e-12) / 127
+            self.scale[ids] = scale
+            vecs = torch.round(vecs / scale)
+        self.weight[ids] = vecs.to(self.weight.dtype)
+
+    def __reserve(self, size):
+        """
+        Makes sure that the weight has room for at least size IDs.
+        """
+        capacity = self.weight.shape[0]
+        if size <= capacity:
+            return
+
+        while capacity < size:
+            capacity *= 2
+        weight = self.weight.new_zeros(capacity, self.weight.shape[1])
+        weight[: self.weight.shape[0]] = self.weight
+        self.weight = weight
+        if self.scale is not None:
+            scale = self.scale.new_ones(capacity, 1)
+            scale[: self.scale.shape[0]] = self.scale
+            self.scale = scale
+        self.__build_layers()
+
+    def add_unk(self, emb):
+        """
+        Adds the #UNK# token, which is never evicted.
+        """
+        self.add_batch([Vocabulary.unk_token], [emb], track=False)
+
+    def touch(self, tokens):
+        """
+        Marks tokens as recently used.
+
+        :return: tokens that were not seen before.
+        """
+        unseen = []
+        for token in tokens:
+            if token in self.seen:
+                self.seen.move_to_end(token)
+            else:
+                unseen.append(token)
+        return unseen
+
+    def evict(self, n_new, keep):
+        """
+        Evicts the least recently used tokens, such that n_new tokens can be added
+        without exceeding max_size. Tokens in keep are never evicted, which may cause the
+        arena to exceed max_size temporarily.
+        """
+        if self.max_size is None:
+            return
+
+        while self.seen and len(self.seen) + n_new > self.max_size:
+            token = next(iter(self.seen))
+            # All tokens after this one have been used more recently.
+            if token in keep:
+                break
+            has_emb = self.seen.pop(token)
+            if has_emb:
+                self.voca.remove_from_vocab(token)
+            self.evictions += 1
+
+    def add_batch(self, tokens, embs, track=True):
+        """
+        Adds tokens with their embeddings, where an embedding is None if it does not
+        exist.
+        """
+        ids, vecs = [], []
+        for token, emb in zip(tokens, embs):
+            if track:
+                self.seen[token] = emb is not None
+            if emb is not None:
+                ids.append(self.voca.add_to_vocab(token))
+                vecs.append(emb)
+
+        if ids:
+            self.__reserve(self.voca.size())
+            self.__store(ids, vecs)
+
+    def stats(self):
+        return {
+            "resident": len(self.voca.word2id),
+            "seen": len(self.seen),
+            "capacity": self.weight.shape[0],
+            "evictions": self.evictions,
+        }
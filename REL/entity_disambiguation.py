@@ -3,6 +3,7 @@ import os
 import pickle as pkl
 import re
 import tarfile
+import threading
 import time
 from pathlib import Path
 from random import shuffle
@@ -13,13 +14,12 @@ import numpy as np
 import pkg_resources
 import torch
 import torch.optim as optim
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import f1_score
-from torch.autograd import Variable
 
 import REL.utils as utils
 from REL.db.generic import GenericLookup
-from REL.mulrel_ranker import MulRelRanker, PreRank
+from REL.embedding_arena import EmbeddingArena
+from REL.mention_batch import MentionBatch
+from REL.mulrel_ranker import MulRelRanker, PreRank, TracedMulRelRanker
 from REL.training_datasets import TrainingEvaluationDatasets
 from REL.vocabulary import Vocabulary
 
@@ -30,6 +30,21 @@ for the ED step.
 
 wiki_prefix = "en.wikipedia.org/wiki/"
 
+# Settings that do not affect the trained model and are therefore not overwritten by
+# the configuration of a stored model.
+RUNTIME_CONFIG = [
+    "emb_backend",
+    "read_only_db",
+    "max_embeddings",
+    "preload_embeddings",
+    "emb_dtype",
+    "quantize",
+    "lbp_window",
+    "max_batch_mentions",
+    "lbp_tol",
+    "max_packed_mentions",
+]
+
 
 class EntityDisambiguation:
     def __init__(self, base_url, wiki_version, user_config, reset_embeddings=False):
@@ -43,10 +58,18 @@ class EntityDisambiguation:
         self.model = None
         self.reset_embeddings = reset_embeddings
         self.emb = GenericLookup(
-            "entity_word_embedding", os.path.join(base_url, wiki_version, "generated")
+            "entity_word_embedding",
+            os.path.join(base_url, wiki_version, "generated"),
+            emb_backend=self.config["emb_backend"],
+            read_only=self.config["read_only_db"],
         )
 
-        self.g_emb = GenericLookup("common_drawl", os.path.join(base_url, "generic"))
+        self.g_emb = GenericLookup(
+            "common_drawl",
+            os.path.join(base_url, "generic"),
+            emb_backend=self.config["emb_backend"],
+            read_only=self.config["read_only_db"],
+        )
         test = self.g_emb.emb(["in"], "embeddings")[0]
         assert (
             test is not None
@@ -58,20 +81,21 @@ class EntityDisambiguation:
 
         self.__max_conf = None
 
+        # Guards the vocabularies and embeddings, which are updated while processing datasets.
+        # Embeddings are only evicted if no other prediction is in flight, as evicted IDs are
+        # reused for other tokens.
+        self.__lock = threading.RLock()
+        self.__in_flight = 0
+        self.__lbp_stats = {"documents": 0, "iterations": 0}
+
         # Load LR model for confidence.
-        if os.path.exists(Path(self.config["model_path"]).parent / "lr_model.pkl"):
-            with open(
-                Path(self.config["model_path"]).parent / "lr_model.pkl",
-                "rb",
-            ) as f:
-                self.model_lr = pkl.load(f)
-        else:
-            print("No LR model found, confidence scores ED will be set to zero.")
-            self.model_lr = None
+        self.model_lr = self.__load_lr(Path(self.config["model_path"]).parent)
 
         if self.config["mode"] == "eval":
             print("Loading model from given path: {}".format(self.config["model_path"]))
             self.model = self.__load(self.config["model_path"])
+            if self.config["quantize"]:
+                self.model = self.__quantize(self.model)
         else:
             if reset_embeddings:
                 raise Exception("You cannot train a model and reset the embeddings.")
@@ -113,6 +137,37 @@ class EntityDisambiguation:
             "use_local": True,
             "use_local_only": False,
             "oracle": False,
+            # Either "sqlite" or "mmap", see GenericLookup.
+            "emb_backend": "sqlite",
+            # Open the databases in read-only serving mode, see GenericLookup.
+            "read_only_db": False,
+            # Maximum number of entity, word and snd embeddings that are kept in memory
+            # each, None for no limit. Only predict evicts embeddings, as train and
+            # evaluate prepare all their datasets up front.
+            "max_embeddings": None,
+            # Load all entity, word and snd embeddings when constructing ED, such that
+            # the database is not queried for embeddings while processing datasets.
+            # Either False, True or the maximum number of embeddings per table.
+            "preload_embeddings": False,
+            # Data type of the embeddings kept in memory, either "float32", "bfloat16" or "int8"
+            # (quantized per row).
+            "emb_dtype": "float32",
+            # Set to "int8" to apply dynamic quantization to the context layer of the model when
+            # it is evaluated on the CPU.
+            "quantize": None,
+            # Number of mentions that each mention exchanges messages with during LBP, where None
+            # connects all mentions. Should be combined with a larger max_batch_mentions.
+            "lbp_window": None,
+            # Maximum number of mentions that are disambiguated jointly, None for no limit.
+            # Longer documents are split into independent batches.
+            "max_batch_mentions": 100,
+            # LBP stops once the messages (as probabilities) are estimated to be within lbp_tol
+            # of the messages they converge to, None to always run n_loops iterations.
+            "lbp_tol": None,
+            # When predicting, consecutive documents with fewer mentions are packed into batches
+            # of at most max_packed_mentions mentions, which are disambiguated in a single forward
+            # pass. None to disambiguate each document separately.
+            "max_packed_mentions": None,
         }
 
         default_config.update(user_config)
@@ -145,40 +200,129 @@ class EntityDisambiguation:
 
         return config
 
+    def __quantize(self, model):
+        """
+        Applies dynamic int8 quantization to the linear layer of the context vectors, which is
+        the only large layer of the model and only supported on the CPU. The small layers that
+        combine scores are kept in float32, as their inputs include log p(e|m) down to -46,
+        which leaves too little precision for the other inputs if quantized per tensor.
+
+        :return: quantized model.
+        """
+        if self.config["quantize"] != "int8":
+            raise Exception("Unknown quantization {}".format(self.config["quantize"]))
+        if self.device.type != "cpu":
+            raise Exception("Quantized models can only be evaluated on the CPU.")
+
+        return torch.quantization.quantize_dynamic(
+            model, {"ctx_layer.0"}, dtype=torch.qint8
+        )
+
     def __load_embeddings(self):
         """
         Initialised embedding dictionary and creates #UNK# token for respective embeddings.
         :return: -
         """
-        self.__batch_embs = {}
+        self.__arenas = {}
 
-        for name in ["snd", "entity", "word"]:
-            # Init entity embeddings.
-            self.embeddings["{}_seen".format(name)] = set()
-            self.embeddings["{}_voca".format(name)] = Vocabulary()
-            self.embeddings["{}_embeddings".format(name)] = None
+        if self.config["preload_embeddings"]:
+            self.__preload_embeddings()
+            return
 
+        for name in ["snd", "entity", "word"]:
             if name in ["word", "entity"]:
-                # Add #UNK# token.
-                self.embeddings["{}_voca".format(name)].add_to_vocab("#UNK#")
                 e = self.emb.emb(["#{}/UNK#".format(name.upper())], "embeddings")[0]
-
-                assert e is not None, "#UNK# token not found for {} in db".format(name)
-
-                self.__batch_embs[name] = []
-                self.__batch_embs[name].append(torch.tensor(e))
             else:
                 # For Glove the #UNK# token was randomly initialised as can be seen. We added this to
                 # our generated database for reproducability. Author also reports no significant difference
                 # in using the mean of the vector or a randomly intialised vector for the glove embeddings.
                 # https://github.com/lephong/mulrel-nel/issues/21
-                self.embeddings["{}_voca".format(name)].add_to_vocab("#UNK#")
                 e = self.g_emb.emb(["#SND/UNK#"], "embeddings")[0]
 
-                assert e is not None, "#UNK# token not found for {} in db".format(name)
+            assert e is not None, "#UNK# token not found for {} in db".format(name)
+
+            # Init embeddings, which are filled while processing datasets.
+            arena = EmbeddingArena(
+                len(e),
+                self.device,
+                max_size=self.config["max_embeddings"],
+                bag=name == "word",
+                dtype=self.config["emb_dtype"],
+            )
+            arena.add_unk(e)
+            self.__arenas[name] = arena
+            self.__set_embeddings(name)
+
+    def __preload_embeddings(self):
+        """
+        Loads the complete (or the first preload_embeddings) snd, entity and word
+        embeddings into fixed embedding tables.
 
-                self.__batch_embs[name] = []
-                self.__batch_embs[name].append(torch.tensor(e))
+        :return: -
+        """
+        limit = self.config["preload_embeddings"]
+        limit = None if limit is True else limit
+
+        for name in ["snd", "entity", "word"]:
+            unk = "#{}/UNK#".format(name.upper())
+            if name == "snd":
+                word2row, matrix = self.g_emb.load_emb_table(
+                    "embeddings", limit=limit, include=[unk]
+                )
+            else:
+                word2row, matrix = self.emb.load_emb_table(
+                    "embeddings",
+                    entities=name == "entity",
+                    limit=limit,
+                    include=[unk],
+                )
+
+            assert unk in word2row, "#UNK# token not found for {} in db".format(name)
+            self.__arenas[name] = EmbeddingArena.from_table(
+                word2row,
+                matrix,
+                self.device,
+                unk,
+                bag=name == "word",
+                dtype=self.config["emb_dtype"],
+            )
+            self.__set_embeddings(name)
+
+    def __set_embeddings(self, name):
+        """
+        Exposes the vocabulary and embedding layers of an arena, which are replaced when
+        the arena grows.
+
+        :return: -
+        """
+        arena = self.__arenas[name]
+        self.embeddings["{}_seen".format(name)] = arena.seen
+        self.embeddings["{}_voca".format(name)] = arena.voca
+        self.embeddings["{}_embeddings".format(name)] = arena.embedding
+        if arena.bag:
+            self.embeddings["{}_embeddings_bag".format(name)] = arena.embedding_bag
+
+    def lbp_stats(self):
+        """
+        Reports the number of LBP iterations that were run for the documents that were
+        disambiguated, which may be less than n_loops if lbp_tol is set. Documents that are
+        packed into a single batch are counted separately.
+
+        :return: dictionary with the number of documents, iterations and iterations per document.
+        """
+        with self.__lock:
+            stats = dict(self.__lbp_stats)
+        stats["mean_iterations"] = stats["iterations"] / max(1, stats["documents"])
+        return stats
+
+    def embedding_stats(self):
+        """
+        Reports the number of resident embeddings, seen tokens, allocated rows and
+        evictions for the entity, word and snd (GloVe) embeddings.
+
+        :return: dictionary with statistics per embedding.
+        """
+        return {name: arena.stats() for name, arena in self.__arenas.items()}
 
     def train(self, org_train_dataset, org_dev_datasets):
         """
@@ -187,10 +331,15 @@ class EntityDisambiguation:
         :return: -
         """
 
-        train_dataset = self.get_data_items(org_train_dataset, "train", predict=False)
+        # All datasets are prepared up front, so embeddings may not be evicted in between.
+        train_dataset = self.get_data_items(
+            org_train_dataset, "train", predict=False, evict=False
+        )
         dev_datasets = []
         for dname, data in org_dev_datasets.items():
-            dev_datasets.append((dname, self.get_data_items(data, dname, predict=True)))
+            dev_datasets.append(
+                (dname, self.get_data_items(data, dname, predict=True, evict=False))
+            )
 
         print("Creating optimizer")
         optimizer = optim.Adam(
@@ -210,83 +359,9 @@ class EntityDisambiguation:
                 optimizer.zero_grad()
 
                 # convert data items to pytorch inputs
-                token_ids = [
-                    m["context"][0] + m["context"][1]
-                    if len(m["context"][0]) + len(m["context"][1]) > 0
-                    else [self.embeddings["word_voca"].unk_id]
-                    for m in batch
-                ]
-                s_ltoken_ids = [m["snd_ctx"][0] for m in batch]
-                s_rtoken_ids = [m["snd_ctx"][1] for m in batch]
-                s_mtoken_ids = [m["snd_ment"] for m in batch]
-
-                entity_ids = Variable(
-                    torch.LongTensor([m["selected_cands"]["cands"] for m in batch]).to(
-                        self.device
-                    )
-                )
-                true_pos = Variable(
-                    torch.LongTensor(
-                        [m["selected_cands"]["true_pos"] for m in batch]
-                    ).to(self.device)
-                )
-                p_e_m = Variable(
-                    torch.FloatTensor([m["selected_cands"]["p_e_m"] for m in batch]).to(
-                        self.device
-                    )
-                )
-                entity_mask = Variable(
-                    torch.FloatTensor([m["selected_cands"]["mask"] for m in batch]).to(
-                        self.device
-                    )
-                )
-
-                token_ids, token_mask = utils.make_equal_len(
-                    token_ids, self.embeddings["word_voca"].unk_id
-                )
-                s_ltoken_ids, s_ltoken_mask = utils.make_equal_len(
-                    s_ltoken_ids, self.embeddings["snd_voca"].unk_id, to_right=False
-                )
-                s_rtoken_ids, s_rtoken_mask = utils.make_equal_len(
-                    s_rtoken_ids, self.embeddings["snd_voca"].unk_id
-                )
-                s_rtoken_ids = [l[::-1] for l in s_rtoken_ids]
-                s_rtoken_mask = [l[::-1] for l in s_rtoken_mask]
-                s_mtoken_ids, s_mtoken_mask = utils.make_equal_len(
-                    s_mtoken_ids, self.embeddings["snd_voca"].unk_id
-                )
-
-                token_ids = Variable(torch.LongTensor(token_ids).to(self.device))
-                token_mask = Variable(torch.FloatTensor(token_mask).to(self.device))
-
-                # too ugly but too lazy to fix it
-                self.model.s_ltoken_ids = Variable(
-                    torch.LongTensor(s_ltoken_ids).to(self.device)
-                )
-                self.model.s_ltoken_mask = Variable(
-                    torch.FloatTensor(s_ltoken_mask).to(self.device)
-                )
-                self.model.s_rtoken_ids = Variable(
-                    torch.LongTensor(s_rtoken_ids).to(self.device)
-                )
-                self.model.s_rtoken_mask = Variable(
-                    torch.FloatTensor(s_rtoken_mask).to(self.device)
-                )
-                self.model.s_mtoken_ids = Variable(
-                    torch.LongTensor(s_mtoken_ids).to(self.device)
-                )
-                self.model.s_mtoken_mask = Variable(
-                    torch.FloatTensor(s_mtoken_mask).to(self.device)
-                )
-
+                inputs, true_pos = batch.inputs(self.device)
                 scores, ent_scores = self.model.forward(
-                    token_ids,
-                    token_mask,
-                    entity_ids,
-                    entity_mask,
-                    p_e_m,
-                    self.embeddings,
-                    gold=true_pos.view(-1, 1),
+                    embeddings=self.embeddings, gold=true_pos.view(-1, 1), **inputs
                 )
                 loss = self.model.loss(scores, true_pos)
                 # loss = self.model.prob_loss(scores, true_pos)
@@ -355,17 +430,26 @@ class EntityDisambiguation:
         Parent function r esponsible for evaluating the ED model during the ED step. Note that
         this is different from predict as this requires ground truth entities to be present.
 
-        :return: -
+        :return: F1, recall, precision, number of NIL predictions and time taken for the ED step per dataset.
         """
 
         dev_datasets = []
         for dname, data in list(datasets.items()):
-            start = time.time()
-            dev_datasets.append((dname, self.get_data_items(data, dname, predict=True)))
+            dev_datasets.append(
+                (dname, self.get_data_items(data, dname, predict=True, evict=False))
+            )
 
+        results = {}
         for dname, data in dev_datasets:
-            predictions = self.__predict(data)
+            predictions, timing = self.__predict(data, include_timing=True)
             f1, recall, precision, total_nil = self.__eval(datasets[dname], predictions)
+            results[dname] = {
+                "f1": f1,
+                "recall": recall,
+                "precision": precision,
+                "total_nil": total_nil,
+                "time": sum(timing),
+            }
             print(
                 dname,
                 utils.tokgreen(
@@ -377,6 +461,8 @@ class EntityDisambiguation:
             print("Total NIL: {}".format(total_nil))
             print("----------------------------------")
 
+        return results
+
     def __create_dataset_LR(self, datasets, predictions, dname):
         X = []
         y = []
@@ -411,14 +497,19 @@ class EntityDisambiguation:
         print(os.path.join(model_path_lr, "lr_model.pkl"))
 
         train_dataset = self.get_data_items(
-            datasets["aida_train"], "train", predict=False
+            datasets["aida_train"], "train", predict=False, evict=False
         )
 
         dev_datasets = []
         for dname, data in list(datasets.items()):
             if dname == "aida_train":
                 continue
-            dev_datasets.append((dname, self.get_data_items(data, dname, predict=True)))
+            dev_datasets.append(
+                (dname, self.get_data_items(data, dname, predict=True, evict=False))
+            )
+
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.metrics import f1_score
 
         model = LogisticRegression()
 
@@ -443,20 +534,98 @@ class EntityDisambiguation:
             with open(path, "wb") as handle:
                 pkl.dump(model, handle, protocol=pkl.HIGHEST_PROTOCOL)
 
+            # Coefficients for inference, which does not require sklearn.
+            path = os.path.join(model_path_lr, "lr_model.json")
+            with open(path, "w") as f:
+                json.dump(
+                    {
+                        "coef": model.coef_[0].tolist(),
+                        "intercept": model.intercept_[0].item(),
+                    },
+                    f,
+                )
+
+    def __load_lr(self, path):
+        """
+        Loads the coefficients of the LR model that is used for confidence scores. These are
+        read from lr_model.json, or from the sklearn model in lr_model.pkl for models that were
+        trained before.
+
+        :return: coefficients and intercept or None if no LR model is found.
+        """
+        if os.path.exists(path / "lr_model.json"):
+            with open(path / "lr_model.json", "r") as f:
+                lr = json.load(f)
+        elif os.path.exists(path / "lr_model.pkl"):
+            with open(path / "lr_model.pkl", "rb") as f:
+                model_lr = pkl.load(f)
+            lr = {
+                "coef": model_lr.coef_[0].tolist(),
+                "intercept": model_lr.intercept_[0].item(),
+            }
+        else:
+            print("No LR model found, confidence scores ED will be set to zero.")
+            return None
+
+        return (
+            torch.tensor(lr["coef"], dtype=torch.float64, device=self.device),
+            torch.tensor(lr["intercept"], dtype=torch.float64, device=self.device),
+        )
+
     def predict(self, data):
         """
         Parent function responsible for predicting on any raw text as input. This does not require ground
         truth entities to be present.
 
+        This function is reentrant, such that a single instance may serve concurrent requests.
+
         :return: predictions and time taken for the ED step.
         """
 
-        self.coref.with_coref(data)
-        data = self.get_data_items(data, "raw", predict=True)
-        predictions, timing = self.__predict(data, include_timing=True, eval_raw=True)
+        with self.__lock:
+            self.__in_flight += 1
+        try:
+            self.coref.with_coref(data)
+            data = self.get_data_items(data, "raw", predict=True)
+            predictions, timing = self.__predict(
+                data, include_timing=True, eval_raw=True
+            )
+        finally:
+            with self.__lock:
+                self.__in_flight -= 1
 
         return predictions, timing
 
+    def export_torchscript(self, path, mentions_dataset):
+        """
+        Exports the ranker together with its embeddings using torch.jit.trace, such that it can be
+        loaded for serving with torch.jit.load without the Python model code. The traced model takes
+        the tensors of a document in the order of MulRelRanker.forward, without the embeddings.
+
+        The embeddings must be preloaded, as lazily loaded embeddings are assigned IDs in order of
+        appearance.
+
+        :param mentions_dataset: mentions, as returned by mention detection, that are used as example input.
+        :return: traced model.
+        """
+        if not self.config["preload_embeddings"]:
+            raise Exception("Exporting the model requires preloaded embeddings.")
+        if self.config["max_packed_mentions"] is not None:
+            raise Exception("Exporting the model does not support packed documents.")
+
+        self.coref.with_coref(mentions_dataset)
+        data = self.get_data_items(mentions_dataset, "raw", predict=True)
+        inputs, _ = max(data, key=len).inputs(self.device)
+
+        self.model.eval()
+        ranker = TracedMulRelRanker(
+            self.model, self.embeddings, self.embeddings["word_voca"].unk_id
+        )
+        with torch.no_grad():
+            traced = torch.jit.trace(ranker, tuple(inputs.values()))
+        torch.jit.save(traced, path)
+        return traced
+
     def __compute_confidence_legacy(self, scores, preds):
         """
         LEGACY
@@ -488,14 +657,15 @@ class EntityDisambiguation:
 
         :return:
         """
-        X = np.array([[score[pred]] for score, pred in zip(scores, preds)])
         if self.model_lr:
-            preds = self.model_lr.predict_proba(X)
-            confidence_scores = [x[1] for x in preds]
+            coef, intercept = self.model_lr
+            X = scores.gather(1, preds.view(-1, 1)).double()
+            confidence_scores = torch.sigmoid(X.matmul(coef) + intercept).tolist()
         else:
-            confidence_scores = [0.0 for _ in scores]
+            confidence_scores = [0.0 for _ in range(len(scores))]
         return confidence_scores
 
+    @torch.no_grad()
     def __predict(self, data, include_timing=False, eval_raw=False):
         """
         Uses the trained model to make predictions of individual batches (i.e. documents).
@@ -503,7 +673,7 @@ class EntityDisambiguation:
         :return: predictions and time taken for the ED step.
         """
 
-        predictions = {items[0]["doc_name"]: [] for items in data}
+        predictions = {m["doc_name"]: [] for items in data for m in items}
         self.model.eval()
 
         timing = []
@@ -512,87 +682,21 @@ class EntityDisambiguation:
 
             start = time.time()
 
-            token_ids = [
-                m["context"][0] + m["context"][1]
-                if len(m["context"][0]) + len(m["context"][1]) > 0
-                else [self.embeddings["word_voca"].unk_id]
-                for m in batch
-            ]
-            s_ltoken_ids = [m["snd_ctx"][0] for m in batch]
-            s_rtoken_ids = [m["snd_ctx"][1] for m in batch]
-            s_mtoken_ids = [m["snd_ment"] for m in batch]
-
-            entity_ids = Variable(
-                torch.LongTensor([m["selected_cands"]["cands"] for m in batch]).to(
-                    self.device
-                )
-            )
-            p_e_m = Variable(
-                torch.FloatTensor([m["selected_cands"]["p_e_m"] for m in batch]).to(
-                    self.device
-                )
-            )
-            entity_mask = Variable(
-                torch.FloatTensor([m["selected_cands"]["mask"] for m in batch]).to(
-                    self.device
-                )
-            )
-            true_pos = Variable(
-                torch.LongTensor([m["selected_cands"]["true_pos"] for m in batch]).to(
-                    self.device
-                )
-            )
-
-            token_ids, token_mask = utils.make_equal_len(
-                token_ids, self.embeddings["word_voca"].unk_id
-            )
-            s_ltoken_ids, s_ltoken_mask = utils.make_equal_len(
-                s_ltoken_ids, self.embeddings["snd_voca"].unk_id, to_right=False
-            )
-            s_rtoken_ids, s_rtoken_mask = utils.make_equal_len(
-                s_rtoken_ids, self.embeddings["snd_voca"].unk_id
-            )
-            s_rtoken_ids = [l[::-1] for l in s_rtoken_ids]
-            s_rtoken_mask = [l[::-1] for l in s_rtoken_mask]
-            s_mtoken_ids, s_mtoken_mask = utils.make_equal_len(
-                s_mtoken_ids, self.embeddings["snd_voca"].unk_id
-            )
-
-            token_ids = Variable(torch.LongTensor(token_ids).to(self.device))
-            token_mask = Variable(torch.FloatTensor(token_mask).to(self.device))
-
-            self.model.s_ltoken_ids = Variable(
-                torch.LongTensor(s_ltoken_ids).to(self.device)
-            )
-            self.model.s_ltoken_mask = Variable(
-                torch.FloatTensor(s_ltoken_mask).to(self.device)
-            )
-            self.model.s_rtoken_ids = Variable(
-                torch.LongTensor(s_rtoken_ids).to(self.device)
-            )
-            self.model.s_rtoken_mask = Variable(
-                torch.FloatTensor(s_rtoken_mask).to(self.device)
-            )
-            self.model.s_mtoken_ids = Variable(
-                torch.LongTensor(s_mtoken_ids).to(self.device)
-            )
-            self.model.s_mtoken_mask = Variable(
-                torch.FloatTensor(s_mtoken_mask).to(self.device)
-            )
-
+            inputs, true_pos = batch.inputs(self.device)
+            lbp_stats = {}
             scores, ent_scores = self.model.forward(
-                token_ids,
-                token_mask,
-                entity_ids,
-                entity_mask,
-                p_e_m,
-                self.embeddings,
+                embeddings=self.embeddings,
                 gold=true_pos.view(-1, 1),
+                lbp_stats=lbp_stats,
+                **inputs,
             )
+            with self.__lock:
+                self.__lbp_stats["documents"] += lbp_stats.get("documents", 0)
+                self.__lbp_stats["iterations"] += lbp_stats.get("iterations", 0)
             pred_ids = torch.argmax(scores, axis=1)
-            scores = scores.cpu().data.numpy()
-
             confidence_scores = self.__compute_confidence(scores, pred_ids)
+
+            scores = scores.cpu().data.numpy()
             pred_ids = np.argmax(scores, axis=1)
 
             if not eval_raw:
@@ -673,6 +777,7 @@ class EntityDisambiguation:
         else:
             return predictions
 
+    @torch.no_grad()
     def prerank(self, dataset, dname, predict=False):
         """
         Responsible for preranking the set of possible candidates using both context and p(e|m) scores.
@@ -683,110 +788,73 @@ class EntityDisambiguation:
         total = 0
 
         for content in dataset:
-            items = []
+            t = content.tensors
             if self.config["keep_ctx_ent"] > 0:
                 # rank the candidates by ntee scores
-                lctx_ids = [
-                    m["context"][0][
-                        max(
-                            len(m["context"][0])
-                            - self.config["prerank_ctx_window"] // 2,
-                            0,
-                        ) :
-                    ]
-                    for m in content
-                ]
-                rctx_ids = [
-                    m["context"][1][
-                        : min(
-                            len(m["context"][1]), self.config["prerank_ctx_window"] // 2
-                        )
-                    ]
-                    for m in content
-                ]
-                ment_ids = [[] for m in content]
-                token_ids = [
-                    l + m + r
-                    if len(l) + len(r) > 0
-                    else [self.embeddings["word_voca"].unk_id]
-                    for l, m, r in zip(lctx_ids, ment_ids, rctx_ids)
-                ]
-
-                entity_ids = [m["cands"] for m in content]
-                entity_ids = Variable(torch.LongTensor(entity_ids).to(self.device))
-
-                entity_mask = [m["mask"] for m in content]
-                entity_mask = Variable(torch.FloatTensor(entity_mask).to(self.device))
-
-                token_ids, token_offsets = utils.flatten_list_of_lists(token_ids)
-                token_offsets = Variable(
-                    torch.LongTensor(token_offsets).to(self.device)
-                )
-                token_ids = Variable(torch.LongTensor(token_ids).to(self.device))
-
-                entity_names = [m["named_cands"] for m in content]  # named_cands
-
+                entity_mask = t["cands_mask"].to(self.device)
                 log_probs = self.prerank_model.forward(
-                    token_ids, token_offsets, entity_ids, self.embeddings, self.emb
+                    t["prerank_token_ids"].to(self.device),
+                    t["prerank_token_offsets"].to(self.device),
+                    t["cands"].to(self.device),
+                    self.embeddings,
+                    self.emb,
                 )
 
                 # Entity mask makes sure that the UNK entities are zero.
                 log_probs = (log_probs * entity_mask).add_((entity_mask - 1).mul_(1e10))
                 _, top_pos = torch.topk(log_probs, dim=1, k=self.config["keep_ctx_ent"])
-                top_pos = top_pos.data.cpu().numpy()
+                top_pos = top_pos.cpu()
 
             else:
-                top_pos = [[]] * len(content)
+                top_pos = torch.zeros(len(content), 0, dtype=torch.long)
 
             # select candidats: mix between keep_ctx_ent best candidates (ntee scores) with
-            # keep_p_e_m best candidates (p_e_m scores)
-            for i, m in enumerate(content):
-                sm = {
-                    "cands": [],
-                    "named_cands": [],
-                    "p_e_m": [],
-                    "mask": [],
-                    "true_pos": -1,
+            # keep_p_e_m best candidates (p_e_m scores). Candidates are sorted by p_e_m, so the
+            # latter are the first candidates that are not among the former.
+            in_top = torch.zeros(t["cands"].shape, dtype=torch.bool)
+            in_top.scatter_(1, top_pos, True)
+            selected = in_top | ((~in_top).cumsum(dim=1) <= self.config["keep_p_e_m"])
+            # Positions of the selected candidates in ascending order, as every mention has the
+            # same number of selected candidates.
+            selected = selected.nonzero()[:, 1].view(len(content), -1)
+
+            true_pos = selected == t["cands_true_pos"].view(-1, 1)
+            true_pos = torch.where(
+                true_pos.any(dim=1), true_pos.long().argmax(dim=1), -1
+            )
+            has_true_pos = true_pos >= 0
+            if predict:
+                # only for oracle model, not used for eval
+                # a fake gold, happens only 2%, but avoid the non-gold
+                content.select_cands(selected, true_pos.clamp(min=0))
+            else:
+                content.select_cands(selected, true_pos)
+
+            selected_cands = zip(
+                selected.tolist(),
+                t["entity_ids"].tolist(),
+                torch.gather(t["cands_p_e_m"], 1, selected).tolist(),
+                t["entity_mask"].tolist(),
+                t["true_pos"].tolist(),
+            )
+            for m, (pos, sel_cands, sel_p_e_m, sel_mask, sel_true_pos) in zip(
+                content, selected_cands
+            ):
+                m["selected_cands"] = {
+                    "cands": sel_cands,
+                    "named_cands": [m["named_cands"][idx] for idx in pos],
+                    "p_e_m": sel_p_e_m,
+                    "mask": sel_mask,
+                    "true_pos": sel_true_pos,
                 }
-                m["selected_cands"] = sm
-
-                selected = set(top_pos[i])
-                idx = 0
-                while (
-                    len(selected)
-                    < self.config["keep_ctx_ent"] + self.config["keep_p_e_m"]
-                ):
-                    if idx not in selected:
-                        selected.add(idx)
-                    idx += 1
-
-                selected = sorted(list(selected))
-                for idx in selected:
-                    sm["cands"].append(m["cands"][idx])
-                    sm["named_cands"].append(m["named_cands"][idx])
-                    sm["p_e_m"].append(m["p_e_m"][idx])
-                    sm["mask"].append(m["mask"][idx])
-                    if idx == m["true_pos"]:
-                        sm["true_pos"] = len(sm["cands"]) - 1
-
-                if not predict:
-                    if sm["true_pos"] == -1:
-                        continue
-
-                items.append(m)
-                if sm["true_pos"] >= 0:
-                    has_gold += 1
-                total += 1
 
-                if predict:
-                    # only for oracle model, not used for eval
-                    if sm["true_pos"] == -1:
-                        sm[
-                            "true_pos"
-                        ] = 0  # a fake gold, happens only 2%, but avoid the non-gold
+            total += int(has_true_pos.sum()) if not predict else len(content)
+            has_gold += int(has_true_pos.sum())
+            if not predict:
+                content = content.subset(has_true_pos.nonzero()[:, 0].tolist())
 
-            if len(items) > 0:
-                new_dataset.append(items)
+            if len(content) > 0:
+                new_dataset.append(content)
 
         # if total > 0
         if dname != "raw":
@@ -794,81 +862,65 @@ class EntityDisambiguation:
             print("-----------------------------------------------")
         return new_dataset
 
-    def __update_embeddings(self, emb_name, embs):
+    def __embed_words(self, words_used, name, table_name="embeddings", evict=True):
         """
-        Responsible for updating the dictionaries with their respective word, entity and snd (GloVe) embeddings.
+        Responsible for retrieving embeddings using the given sqlite3 database. Only words
+        that were not seen before are retrieved, after evicting the least recently used
+        words if the number of embeddings is bounded and evict is set.
 
         :return: -
         """
+        arena = self.__arenas[name]
+        if arena.preloaded:
+            return
 
-        embs = embs.to(self.device)
-
-        if self.embeddings["{}_embeddings".format(emb_name)]:
-            new_weights = torch.cat(
-                (self.embeddings["{}_embeddings".format(emb_name)].weight, embs)
-            )
-        else:
-            new_weights = embs
-
-        # Weights are now updated, so we create a new Embedding layer.
-        layer = torch.nn.Embedding(
-            self.embeddings["{}_voca".format(emb_name)].size(), self.config["emb_dims"]
-        )
-        layer.weight = torch.nn.Parameter(new_weights)
-        layer.grad = False
-        self.embeddings["{}_embeddings".format(emb_name)] = layer
-        if emb_name == "word":
-            layer = torch.nn.EmbeddingBag(
-                self.embeddings["{}_voca".format(emb_name)].size(),
-                self.config["emb_dims"],
-            )
-            layer.weight = torch.nn.Parameter(new_weights)
-
-            layer.requires_grad = False
-            self.embeddings["{}_embeddings_bag".format(emb_name)] = layer
-
-        del new_weights
-
-    def __embed_words(self, words_filt, name, table_name="embeddings"):
-        """
-        Responsible for retrieving embeddings using the given sqlite3 database.
-
-        :return: -
-        """
+        words_filt = arena.touch(words_used)
+        if evict and self.__in_flight <= 1:
+            arena.evict(len(words_filt), words_used)
+        if not words_filt:
+            return
 
         # Returns None if not in db.
         if table_name == "glove":
             embs = self.g_emb.emb(words_filt, "embeddings")
+        elif name == "entity":
+            embs = self.emb.emb(["ENTITY/" + c for c in words_filt], table_name)
         else:
             embs = self.emb.emb(words_filt, table_name)
 
-        # Now we go over the embs and see which one is None. Order is preserved.
-        for e, c in zip(embs, words_filt):
-            if name == "entity":
-                c = c.replace("ENTITY/", "")
-            self.embeddings["{}_seen".format(name)].add(c)
-            if e is not None:
-                # Embedding exists, so we add it.
-                self.embeddings["{}_voca".format(name)].add_to_vocab(c)
-                self.__batch_embs[name].append(torch.tensor(e))
-
-    def get_data_items(self, dataset, dname, predict=False):
+        arena.add_batch(words_filt, embs)
+        self.__set_embeddings(name)
+
+    def get_data_items(self, dataset, dname, predict=False, evict=True):
         """
         Responsible for formatting dataset. Triggers the preranking function.
 
+        :param evict: allow evicting embeddings if their number is bounded. Eviction reuses
+            the IDs of other tokens, so it must be disabled if several datasets are prepared
+            before predicting on them.
+
         :return: preranking function.
         """
         data = []
 
-        if self.reset_embeddings:
+        with self.__lock:
             # If user wants to reset, he can do this here, right before loading a new dataset.
-            self.__load_embeddings()
-
+            # Embeddings are not reset while other predictions are using them.
+            if (
+                self.reset_embeddings
+                and not self.config["preload_embeddings"]
+                and self.__in_flight <= 1
+            ):
+                self.__load_embeddings()
+
+        # First pass: tokenize all mentions and gather the words and entities they use,
+        # such that missing embeddings can be retrieved in batches.
+        entities_used, words_used, snd_used = set(), set(), set()
+        mentions_dataset = []
         for doc_name, content in dataset.items():
-            items = []
             if len(content) == 0:
                 continue
-            conll_doc = content[0].get("conll_doc", None)
+            mentions_doc = []
             for m in content:
                 named_cands = [c[0] for c in m["candidates"]]
                 p_e_m = [min(1.0, max(1e-3, c[1])) for c in m["candidates"]]
@@ -878,6 +930,7 @@ class EntityDisambiguation:
                     p = p_e_m[true_pos]
                 except:
                     true_pos = -1
+                    p = None
 
                 # Get all words and check for embeddings.
                 named_cands = named_cands[
@@ -885,15 +938,7 @@ class EntityDisambiguation:
                 ]
 
                 # Candidate list per mention.
-                named_cands_filt = set(
-                    [
-                        "ENTITY/" + item
-                        for item in named_cands
-                        if item not in self.embeddings["entity_seen"]
-                    ]
-                )
-
-                self.__embed_words(named_cands_filt, "entity", "embeddings")
+                entities_used.update(named_cands)
 
                 # Use re.split() to make sure that special characters are considered.
                 lctx = [
@@ -903,15 +948,7 @@ class EntityDisambiguation:
                     x for x in re.split("(\W)", m["context"][1].strip()) if x != " "
                 ]  # split()
 
-                words_filt = set(
-                    [
-                        item
-                        for item in lctx + rctx
-                        if item not in self.embeddings["word_seen"]
-                    ]
-                )
-
-                self.__embed_words(words_filt, "word", "embeddings")
+                words_used.update(lctx + rctx)
 
                 snd_lctx = m["sentence"][: m["pos"]].strip().split()
                 snd_lctx = [
@@ -925,16 +962,44 @@ class EntityDisambiguation:
 
                 snd_ment = m["ngram"].strip().split()
 
-                words_filt = set(
-                    [
-                        item
-                        for item in snd_lctx + snd_rctx + snd_ment
-                        if item not in self.embeddings["snd_seen"]
-                    ]
+                snd_used.update(snd_lctx + snd_rctx + snd_ment)
+
+                mentions_doc.append(
+                    (
+                        m,
+                        named_cands,
+                        p_e_m,
+                        true_pos,
+                        p,
+                        lctx,
+                        rctx,
+                        snd_lctx,
+                        snd_rctx,
+                        snd_ment,
+                    )
                 )
+            mentions_dataset.append((doc_name, mentions_doc))
 
-                self.__embed_words(words_filt, "snd", "glove")
+        with self.__lock:
+            self.__embed_words(entities_used, "entity", "embeddings", evict)
+            self.__embed_words(words_used, "word", "embeddings", evict)
+            self.__embed_words(snd_used, "snd", "glove", evict)
 
+        # Second pass: map tokens and candidates to their ids.
+        for doc_name, mentions_doc in mentions_dataset:
+            items = []
+            for (
+                m,
+                named_cands,
+                p_e_m,
+                true_pos,
+                p,
+                lctx,
+                rctx,
+                snd_lctx,
+                snd_rctx,
+                snd_ment,
+            ) in mentions_doc:
                 p_e_m = p_e_m[: min(self.config["n_cands_before_rank"], len(p_e_m))]
 
                 if true_pos >= len(named_cands):
@@ -1040,22 +1105,54 @@ class EntityDisambiguation:
             if len(items) > 0:
                 # note: this shouldn't affect the order of prediction because we use doc_name to add predicted entities,
                 # and we don't shuffle the data for prediction
-                if len(items) > 100:
-                    # print(len(items))
-                    for k in range(0, len(items), 100):
-                        data.append(items[k : min(len(items), k + 100)])
-                else:
-                    data.append(items)
-
-        # Update batch
-        for n in ["word", "entity", "snd"]:
-            if self.__batch_embs[n]:
-                self.__batch_embs[n] = torch.stack(self.__batch_embs[n])
-                self.__update_embeddings(n, self.__batch_embs[n])
-                self.__batch_embs[n] = []
+                max_mentions = self.config["max_batch_mentions"]
+                if max_mentions is None or len(items) <= max_mentions:
+                    max_mentions = len(items)
+                for k in range(0, len(items), max_mentions):
+                    data.append(items[k : min(len(items), k + max_mentions)])
+
+        data = [
+            MentionBatch.from_items(
+                [m for items in batch for m in items],
+                self.embeddings["word_voca"].unk_id,
+                self.embeddings["snd_voca"].unk_id,
+                self.config["prerank_ctx_window"],
+                [i for i, items in enumerate(batch) for _ in items]
+                if len(batch) > 1
+                else None,
+            )
+            for batch in self.__pack_batches(data, predict)
+        ]
 
         return self.prerank(data, dname, predict)
 
+    def __pack_batches(self, data, predict):
+        """
+        Packs consecutive batches (i.e. documents) into larger batches of at most
+        max_packed_mentions mentions when predicting. Batches that would use the sparse LBP
+        of lbp_window are not packed.
+
+        :return: list of packed batches, each a list of batches.
+        """
+        max_mentions = self.config["max_packed_mentions"] if predict else None
+        lbp_window = self.config["lbp_window"]
+
+        packed = []
+        for items in data:
+            if (
+                len(packed) > 0
+                and max_mentions is not None
+                and sum(len(b) for b in packed[-1]) + len(items) <= max_mentions
+                and (
+                    lbp_window is None
+                    or all(len(b) <= lbp_window for b in packed[-1] + [items])
+                )
+            ):
+                packed[-1].append(items)
+            else:
+                packed.append([items])
+        return packed
+
     def __eval(self, testset, system_pred):
         """
         Responsible for evaluating data points, which is solely used for the local ED step.
@@ -1097,16 +1194,17 @@ class EntityDisambiguation:
     def __load(self, path):
         """
         Responsible for loading a trained model and its respective config. Note that this config cannot be
-        overwritten. If required, this behavior may be modified in future releases.
+        overwritten, except for the settings in RUNTIME_CONFIG. If required, this behavior may be modified
+        in future releases.
 
         :return: model
         """
 
         if os.path.exists("{}.config".format(path)):
             with open("{}.config".format(path), "r") as f:
-                temp = self.config["model_path"]
+                temp = {k: self.config[k] for k in ["model_path"] + RUNTIME_CONFIG}
                 self.config = json.load(f)
-                self.config["model_path"] = temp
+                self.config.update(temp)
         else:
             print(
                 "No configuration file found at {}, default settings will be used.".format(
@@ -33,29 +33,36 @@ class GenTrainingTest(MentionDetectionBase):
         for doc in dataset:
             contents = dataset[doc]
             sentences_doc = [v[0] for v in contents.values()]
+            ground_truth_doc = [
+                (idx_sent, sentence, m, gt, start, ngram)
+                for idx_sent, (sentence, ground_truth_sentence) in contents.items()
+                for m, gt, start, ngram in ground_truth_sentence
+            ]
+            cands_doc = self.get_candidates_batch([gt[2] for gt in ground_truth_doc])
+            doc_tokens = self.tokenize_doc(sentences_doc)
             result_doc = []
 
-            for idx_sent, (sentence, ground_truth_sentence) in contents.items():
-                for m, gt, start, ngram in ground_truth_sentence:
-                    end = start + len(ngram)
-                    left_ctxt, right_ctxt = self.get_ctxt(
-                        start, end, idx_sent, sentence, sentences_doc
-                    )
-                    cands = self.get_candidates(m)
-
-                    res = {
-                        "mention": m,
-                        "context": (left_ctxt, right_ctxt),
-                        "candidates": cands,
-                        "gold": [gt.replace(" ", "_")],
-                        "pos": start,
-                        "sent_idx": idx_sent,
-                        "ngram": ngram,
-                        "end_pos": end,
-                        "sentence": sentence,
-                    }
-
-                    result_doc.append(res)
+            for (idx_sent, sentence, m, gt, start, ngram), cands in zip(
+                ground_truth_doc, cands_doc
+            ):
+                end = start + len(ngram)
+                left_ctxt, right_ctxt = self.get_ctxt(
+                    start, end, idx_sent, sentence, sentences_doc, doc_tokens
+                )
+
+                res = {
+                    "mention": m,
+                    "context": (left_ctxt, right_ctxt),
+                    "candidates": cands,
+                    "gold": [gt.replace(" ", "_")],
+                    "pos": start,
+                    "sent_idx": idx_sent,
+                    "ngram": ngram,
+                    "end_pos": end,
+                    "sentence": sentence,
+                }
+
+                result_doc.append(res)
 
             results[doc] = result_doc
 
@@ -126,11 +133,8 @@ class GenTrainingTest(MentionDetectionBase):
                 )
                 if pos not in mentions_gt:
                     total_gt += 1
-                mentions_gt[pos] = [
-                    self.preprocess_mention(mention_gt),
-                    ent_title,
-                    mention_gt,
-                ]
+                # The mention is preprocessed for the whole document at once, see below.
+                mentions_gt[pos] = [mention_gt, ent_title, mention_gt]
 
             total_characters = 0
             i = 0
@@ -165,6 +169,7 @@ class GenTrainingTest(MentionDetectionBase):
             assert (
                 total_gt == total_assigned
             ), "We missed a ground truth.. {};{}".format(total_gt, total_assigned)
+            self.__preprocess_gt(sentences)
             contents[doc_name] = sentences
         print("Replaced {} ground truth entites".format(cnt_replaced))
 
@@ -221,6 +226,7 @@ class GenTrainingTest(MentionDetectionBase):
                             )
 
                     if len(sentences) > 0:
+                        self.__preprocess_gt(sentences)
                         contents[doc_name] = sentences
 
                     words = split_in_words_mention(line)
@@ -269,13 +275,9 @@ class GenTrainingTest(MentionDetectionBase):
                         pos_mention_gt = (
                             len(" ".join(sentence)) + 1 if len(sentence) > 0 else 0
                         )  # + 1 for space between mention and sentence
+                        # The mention is preprocessed once the document is complete.
                         gt_sent.append(
-                            [
-                                self.preprocess_mention(mention_gt),
-                                ent_title,
-                                pos_mention_gt,
-                                mention_gt,
-                            ]
+                            [mention_gt, ent_title, pos_mention_gt, mention_gt]
                         )
                         words = mention_gt
 
@@ -312,6 +314,7 @@ class GenTrainingTest(MentionDetectionBase):
             sentence_words = " ".join(sentence)
             sentences[i_sent] = [sentence_words, gt_sent]
         if len(sentences) > 0:
+            self.__preprocess_gt(sentences)
             contents[doc_name] = sentences
 
         if "train" in dataset:
@@ -320,6 +323,18 @@ class GenTrainingTest(MentionDetectionBase):
             self.__save(self.__format(contents), "aida_testB")
         print("Replaced {} ground truth entites".format(cnt_replaced))
 
+    def __preprocess_gt(self, sentences):
+        """
+        Replaces the mention of each ground truth entity in the sentences of a document by its
+        preprocessed mention, resolving all mentions of the document at once.
+
+        :return: -
+        """
+        gts = [gt for _, gt_sent in sentences.values() for gt in gt_sent]
+        mentions = self.preprocess_mentions([gt[-1] for gt in gts])
+        for gt, mention in zip(gts, mentions):
+            gt[0] = mention
+
     def __save(self, mentions_dataset, file_name):
         """
         Responsible for saving mentions. This is used to get the processed mentions into the format required
@@ -0,0 +1,151 @@
+import numpy as np
+import torch
+
+"""
+Class responsible for storing the mentions of a batch (i.e. document) that are disambiguated jointly.
+"""
+
+# Tensors that are passed to MulRelRanker.forward.
+MODEL_INPUTS = [
+    "token_ids",
+    "tok_mask",
+    "entity_ids",
+    "entity_mask",
+    "p_e_m",
+    "s_ltoken_ids",
+    "s_ltoken_mask",
+    "s_rtoken_ids",
+    "s_rtoken_mask",
+    "s_mtoken_ids",
+    "s_mtoken_mask",
+]
+
+
+def pad_ids(lists, fill_in, to_right=True):
+    """
+    Tensorized equivalent of utils.make_equal_len.
+
+    :return: padded IDs and mask.
+    """
+    lens = np.array([len(l) for l in lists], dtype=np.int64)
+    max_len = max(1, lens.max(initial=0))
+    ids = torch.full((len(lists), max_len), fill_in, dtype=torch.long)
+    mask = torch.zeros(len(lists), max_len)
+
+    rows = np.repeat(np.arange(len(lists)), lens)
+    starts = np.cumsum(lens) - lens
+    cols = np.arange(lens.sum()) - np.repeat(starts, lens)
+    if not to_right:
+        cols += np.repeat(max_len - lens, lens)
+
+    rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+    ids[rows, cols] = torch.LongTensor([i for l in lists for i in l])
+    mask[rows, cols] = 1.0
+    return ids, mask
+
+
+class MentionBatch(list):
+    """
+    List of the data items of a batch, together with padded tensors of their token IDs, snd token
+    IDs and candidates. The tensors are built once when the batch is created, such that preranking
+    and disambiguation do not need to convert the data items again.
+    """
+
+    def __init__(self, items, tensors=None):
+        super().__init__(items)
+        self.tensors = tensors or {}
+
+    @classmethod
+    def from_items(
+        cls, items, word_unk_id, snd_unk_id, prerank_ctx_window, doc_ids=None
+    ):
+        """
+        Tensorizes data items as created by EntityDisambiguation.get_data_items.
+
+        :param doc_ids: optional document index of each item, if several documents are packed.
+        :return: MentionBatch
+        """
+        batch = cls(items)
+        t = batch.tensors
+        if doc_ids is not None:
+            t["doc_ids"] = torch.LongTensor(doc_ids)
+
+        # Context of the local model.
+        t["token_ids"], t["tok_mask"] = pad_ids(
+            [
+                m["context"][0] + m["context"][1]
+                if len(m["context"][0]) + len(m["context"][1]) > 0
+                else [word_unk_id]
+                for m in items
+            ],
+            word_unk_id,
+        )
+
+        # Context of the preranking model, as inputs for an EmbeddingBag.
+        prerank_token_ids = [
+            m["context"][0][max(len(m["context"][0]) - prerank_ctx_window // 2, 0) :]
+            + m["context"][1][: min(len(m["context"][1]), prerank_ctx_window // 2)]
+            for m in items
+        ]
+        prerank_token_ids = [ids if ids else [word_unk_id] for ids in prerank_token_ids]
+        lens = torch.LongTensor([len(ids) for ids in prerank_token_ids])
+        t["prerank_token_ids"] = torch.LongTensor(
+            [i for ids in prerank_token_ids for i in ids]
+        )
+        t["prerank_token_offsets"] = torch.cumsum(lens, dim=0) - lens
+
+        # Secondary local context, where the right context is reversed.
+        t["s_ltoken_ids"], t["s_ltoken_mask"] = pad_ids(
+            [m["snd_ctx"][0] for m in items], snd_unk_id, to_right=False
+        )
+        s_rtoken_ids, s_rtoken_mask = pad_ids(
+            [m["snd_ctx"][1] for m in items], snd_unk_id
+        )
+        t["s_rtoken_ids"], t["s_rtoken_mask"] = s_rtoken_ids.flip(
+            1
+        ), s_rtoken_mask.flip(1)
+        t["s_mtoken_ids"], t["s_mtoken_mask"] = pad_ids(
+            [m["snd_ment"] for m in items], snd_unk_id
+        )
+
+        # All candidates, before preranking.
+        t["cands"] = torch.LongTensor([m["cands"] for m in items])
+        t["cands_mask"] = torch.FloatTensor([m["mask"] for m in items])
+        t["cands_p_e_m"] = torch.DoubleTensor([m["p_e_m"] for m in items])
+        t["cands_true_pos"] = torch.LongTensor([m["true_pos"] for m in items])
+        return batch
+
+    def select_cands(self, selected, true_pos):
+        """
+        Keeps the candidates at the given positions as inputs for the model.
+
+        :param selected: positions of the selected candidates per mention.
+        :param true_pos: position of the gold entity among the selected candidates per mention.
+        :return: -
+        """
+        t = self.tensors
+        t["entity_ids"] = torch.gather(t["cands"], 1, selected)
+        t["entity_mask"] = torch.gather(t["cands_mask"], 1, selected)
+        t["p_e_m"] = torch.gather(t["cands_p_e_m"], 1, selected).float()
+        t["true_pos"] = true_pos
+
+    def subset(self, idx):
+        """
+        :return: MentionBatch with the mentions at the given positions.
+        """
+        index = torch.LongTensor(idx)
+        tensors = {
+            k: v.index_select(0, index)
+            for k, v in self.tensors.items()
+            if not k.startswith("prerank")
+        }
+        return MentionBatch([self[i] for i in idx], tensors)
+
+    def inputs(self, device):
+        """
+        :return: keyword arguments for MulRelRanker.forward and the positions of the gold entities.
+        """
+        inputs = {k: self.tensors[k].to(device) for k in MODEL_INPUTS}
+        if "doc_ids" in self.tensors:
+            inputs["doc_ids"] = self.tensors["doc_ids"].to(device)
+        return inputs, self.tensors["true_pos"].to(device)
@@ -1,21 +1,58 @@
+import os
+from itertools import islice
+from multiprocessing import Pool
+
+import torch
 from flair.data import Sentence
 from flair.models import SequenceTagger
 from segtok.segmenter import split_single
 
+from REL.db.generic import GenericLookup
 from REL.mention_detection_base import MentionDetectionBase
 
 """
 Class responsible for mention detection.
 """
 
+# State of a worker process of the parallel mention detection.
+_worker = {}
+
+
+def _init_worker(md, tagger):
+    # Workers run side by side, so each of them gets a single thread.
+    torch.set_num_threads(1)
+    # Workers only look up mentions, so their connections are opened as read-only on
+    # first use, rather than as read-write connections that create the table.
+    for obj in [md, tagger]:
+        if isinstance(getattr(obj, "wiki_db", None), GenericLookup):
+            obj.wiki_db.read_only = True
+    _worker["md"] = md
+    _worker["tagger"] = tagger
+
+
+def _find_mentions_shard(shard):
+    return _worker["md"].find_mentions(shard, _worker["tagger"])
+
+
+def _format_spans_shard(shard):
+    return _worker["md"].format_spans(shard)
+
 
 class MentionDetection(MentionDetectionBase):
-    def __init__(self, base_url, wiki_version):
+    def __init__(
+        self,
+        base_url,
+        wiki_version,
+        cache_size=50000,
+        mini_batch_size=32,
+        read_only=False,
+    ):
         self.cnt_exact = 0
         self.cnt_partial = 0
         self.cnt_total = 0
+        self.mini_batch_size = mini_batch_size
 
-        super().__init__(base_url, wiki_version)
+        super().__init__(base_url, wiki_version, cache_size, read_only)
 
     def format_spans(self, dataset):
         """
@@ -33,32 +70,43 @@ class MentionDetection(MentionDetectionBase):
             contents = dataset[doc]
             sentences_doc = [v[0] for v in contents.values()]
 
+            spans_doc = [
+                (idx_sent, sentence, ngram, start_pos, end_pos)
+                for idx_sent, (sentence, spans) in contents.items()
+                for ngram, start_pos, end_pos in spans
+            ]
+            total_ment += len(spans_doc)
+
+            # end_pos = start_pos + length
+            # ngram = text[start_pos:end_pos]
+            # Resolve and look up the candidates of all mentions in this document at once.
+            mentions, cands_doc = self.preprocess_mentions_candidates(
+                [span[2] for span in spans_doc]
+            )
+
+            doc_tokens = self.tokenize_doc(sentences_doc)
             results_doc = []
-            for idx_sent, (sentence, spans) in contents.items():
-                for ngram, start_pos, end_pos in spans:
-                    total_ment += 1
-
-                    # end_pos = start_pos + length
-                    # ngram = text[start_pos:end_pos]
-                    mention = self.preprocess_mention(ngram)
-                    left_ctxt, right_ctxt = self.get_ctxt(
-                        start_pos, end_pos, idx_sent, sentence, sentences_doc
-                    )
+            for (
+                (idx_sent, sentence, ngram, start_pos, end_pos),
+                mention,
+                chosen_cands,
+            ) in zip(spans_doc, mentions, cands_doc):
+                left_ctxt, right_ctxt = self.get_ctxt(
+                    start_pos, end_pos, idx_sent, sentence, sentences_doc, doc_tokens
+                )
+                res = {
+                    "mention": mention,
+                    "context": (left_ctxt, right_ctxt),
+                    "candidates": chosen_cands,
+                    "gold": ["NONE"],
+                    "pos": start_pos,
+                    "sent_idx": idx_sent,
+                    "ngram": ngram,
+                    "end_pos": end_pos,
+                    "sentence": sentence,
+                }
 
-                    chosen_cands = self.get_candidates(mention)
-                    res = {
-                        "mention": mention,
-                        "context": (left_ctxt, right_ctxt),
-                        "candidates": chosen_cands,
-                        "gold": ["NONE"],
-                        "pos": start_pos,
-                        "sent_idx": idx_sent,
-                        "ngram": ngram,
-                        "end_pos": end_pos,
-                        "sentence": sentence,
-                    }
-
-                    results_doc.append(res)
+                results_doc.append(res)
             results[doc] = results_doc
         return results, total_ment
 
@@ -108,27 +156,146 @@ class MentionDetection(MentionDetectionBase):
         """
         Responsible for finding mentions given a set of documents in a batch-wise manner. More specifically,
         it returns the mention, its left/right context and a set of candidates.
+        :return: Dictionary with mentions per document.
+        """
+        results = {}
+        total_ment = 0
+        documents = ((doc, *dataset[doc]) for doc in dataset)
+        for doc, result_doc, n_ment in self.__iter_mentions(documents, tagger, None):
+            results[doc] = result_doc
+            total_ment += n_ment
+        return results, total_ment
+
+    def find_mentions_iter(self, documents, tagger=None, chunk_size=1000):
+        """
+        Streaming version of find_mentions. Documents are consumed lazily and tagged in chunks
+        of at least chunk_size sentences, such that memory usage is bounded by the chunk size
+        instead of the number of documents.
+
+        :param documents: iterable of (doc_id, text, spans) tuples.
+        :return: generator of (doc_id, mentions) tuples, in input order.
+        """
+        for doc, result_doc, _ in self.__iter_mentions(documents, tagger, chunk_size):
+            yield doc, result_doc
+
+    def format_spans_iter(self, documents):
+        """
+        Streaming version of format_spans, which formats one document at a time.
+
+        :param documents: iterable of (doc_id, text, spans) tuples.
+        :return: generator of (doc_id, mentions) tuples, in input order.
+        """
+        for doc, text, spans in documents:
+            results, _ = self.format_spans({doc: [text, spans]})
+            yield doc, results[doc]
+
+    def find_mentions_parallel(
+        self, dataset, tagger=None, n_workers=None, chunk_size=100
+    ):
+        """
+        Parallel version of find_mentions. The dataset is split into shards of chunk_size
+        documents that are processed by a pool of n_workers processes, each of which opens
+        its own database connection. Results are merged in the order of the dataset.
+
         :return: Dictionary with mentions per document.
         """
         if tagger is None:
             raise Exception(
                 "No NER tagger is set, but you are attempting to perform Mention Detection.."
             )
-        # Verify if Flair, else ngram or custom.
-        is_flair = isinstance(tagger, SequenceTagger)
-        dataset_sentences_raw, processed_sentences, splits = self.split_text(
-            dataset, is_flair
+        return self.__run_parallel(
+            _find_mentions_shard, dataset, tagger, n_workers, chunk_size
+        )
+
+    def format_spans_parallel(self, dataset, n_workers=None, chunk_size=100):
+        """
+        Parallel version of format_spans, see find_mentions_parallel.
+
+        :return: Dictionary with mentions per document.
+        """
+        return self.__run_parallel(
+            _format_spans_shard, dataset, None, n_workers, chunk_size
         )
+
+    def __run_parallel(self, func, dataset, tagger, n_workers, chunk_size):
+        docs = iter(dataset)
+        shards = iter(
+            lambda: {doc: dataset[doc] for doc in islice(docs, chunk_size)}, {}
+        )
+
         results = {}
         total_ment = 0
+        with Pool(
+            n_workers or os.cpu_count(),
+            initializer=_init_worker,
+            initargs=(self, tagger),
+        ) as pool:
+            for results_shard, total_shard in pool.imap(func, shards):
+                results.update(results_shard)
+                total_ment += total_shard
+        return results, total_ment
+
+    def __iter_mentions(self, documents, tagger, chunk_size):
+        """
+        Splits documents into sentences and tags them once chunk_size sentences have been
+        collected, or at the end if chunk_size is None.
+
+        :return: generator of (doc_id, mentions, number of detected mentions) tuples.
+        """
+        if tagger is None:
+            raise Exception(
+                "No NER tagger is set, but you are attempting to perform Mention Detection.."
+            )
+        # Verify if Flair, else ngram or custom.
+        is_flair = isinstance(tagger, SequenceTagger)
+
+        chunk, n_sentences = [], 0
+        for doc, text, spans in documents:
+            dataset_sentences_raw, processed_sentences, splits = self.split_text(
+                {doc: [text, spans]}, is_flair
+            )
+            chunk.append(
+                (doc, text, dataset_sentences_raw[doc], processed_sentences, splits[-1])
+            )
+            n_sentences += len(processed_sentences)
+
+            if chunk_size is not None and n_sentences >= chunk_size:
+                yield from self.__tag_chunk(chunk, tagger)
+                chunk, n_sentences = [], 0
+
+        if chunk:
+            yield from self.__tag_chunk(chunk, tagger)
+
+    def __tag_chunk(self, chunk, tagger):
+        """
+        Tags a chunk of documents at once and formats the detected mentions per document.
+
+        :param chunk: list of (doc_id, text, sentences, processed sentences, number of
+        sentences) tuples as produced by split_text.
+        :return: generator of (doc_id, mentions, number of detected mentions) tuples.
+        """
+        is_flair = isinstance(tagger, SequenceTagger)
+        processed_sentences = [
+            snt for _, _, _, processed, _ in chunk for snt in processed
+        ]
         if is_flair:
-            tagger.predict(processed_sentences)
-        for i, doc in enumerate(dataset_sentences_raw):
-            contents = dataset_sentences_raw[doc]
-            raw_text = dataset[doc][0]
+            # Tag each distinct sentence once, sorted by length such that mini-batches
+            # need little padding, and share the result between its occurrences.
+            unique = {}
+            processed_sentences = [
+                unique.setdefault(snt.to_original_text(), snt)
+                for snt in processed_sentences
+            ]
+            tagger.predict(
+                sorted(unique.values(), key=len), mini_batch_size=self.mini_batch_size
+            )
+
+        split = 0
+        for doc, raw_text, contents, _, n_sentences in chunk:
             sentences_doc = [v[0] for v in contents.values()]
-            sentences = processed_sentences[splits[i] : splits[i + 1]]
-            result_doc = []
+            sentences = processed_sentences[split : split + n_sentences]
+            split += n_sentences
+            entities_doc = []
             cum_sent_length = 0
             offset = 0
             for (idx_sent, (sentence, ground_truth_sentence)), snt in zip(
@@ -144,37 +311,45 @@ class MentionDetection(MentionDetectionBase):
                     if is_flair
                     else tagger.predict(snt, processed_sentences)
                 ):
-                    text, start_pos, end_pos, conf, tag = (
-                        entity.text,
-                        entity.start_pos,
-                        entity.end_pos,
-                        entity.score,
-                        entity.tag,
-                    )
-                    total_ment += 1
-                    m = self.preprocess_mention(text)
-                    cands = self.get_candidates(m)
-                    if len(cands) == 0:
-                        continue
-                    # Re-create ngram as 'text' is at times changed by Flair (e.g. double spaces are removed).
-                    ngram = sentence[start_pos:end_pos]
-                    left_ctxt, right_ctxt = self.get_ctxt(
-                        start_pos, end_pos, idx_sent, sentence, sentences_doc
-                    )
-                    res = {
-                        "mention": m,
-                        "context": (left_ctxt, right_ctxt),
-                        "candidates": cands,
-                        "gold": ["NONE"],
-                        "pos": start_pos + offset,
-                        "sent_idx": idx_sent,
-                        "ngram": ngram,
-                        "end_pos": end_pos + offset,
-                        "sentence": sentence,
-                        "conf_md": conf,
-                        "tag": tag,
-                    }
-                    result_doc.append(res)
+                    entities_doc.append((idx_sent, sentence, offset, entity))
                 cum_sent_length += len(sentence) + (offset - cum_sent_length)
-            results[doc] = result_doc
-        return results, total_ment
+
+            # Resolve and look up the candidates of all mentions in this document at once.
+            mentions, cands_doc = self.preprocess_mentions_candidates(
+                [entity.text for _, _, _, entity in entities_doc]
+            )
+
+            doc_tokens = self.tokenize_doc(sentences_doc)
+            result_doc = []
+            for (idx_sent, sentence, offset, entity), m, cands in zip(
+                entities_doc, mentions, cands_doc
+            ):
+                text, start_pos, end_pos, conf, tag = (
+                    entity.text,
+                    entity.start_pos,
+                    entity.end_pos,
+                    entity.score,
+                    entity.tag,
+                )
+                if len(cands) == 0:
+                    continue
+                # Re-create ngram as 'text' is at times changed by Flair (e.g. double spaces are removed).
+                ngram = sentence[start_pos:end_pos]
+                left_ctxt, right_ctxt = self.get_ctxt(
+                    start_pos, end_pos, idx_sent, sentence, sentences_doc, doc_tokens
+                )
+                res = {
+                    "mention": m,
+                    "context": (left_ctxt, right_ctxt),
+                    "candidates": cands,
+                    "gold": ["NONE"],
+                    "pos": start_pos + offset,
+                    "sent_idx": idx_sent,
+                    "ngram": ngram,
+                    "end_pos": end_pos + offset,
+                    "sentence": sentence,
+                    "conf_md": conf,
+                    "tag": tag,
+                }
+                result_doc.append(res)
+            yield doc, result_doc, len(entities_doc)
@@ -1,23 +1,83 @@
 import os
 import re
+from bisect import bisect_left, bisect_right
+
+import unidecode
 
 from REL.db.generic import GenericLookup
-from REL.utils import modify_uppercase_phrase, split_in_words
+from REL.utils import preprocess_mentions, preprocess_mentions_lookup, split_in_words
+
+# Same pattern as the tokenizer of split_in_words.
+WORD_PATTERN = re.compile(r"\w+")
 
 
 class MentionDetectionBase:
-    def __init__(self, base_url, wiki_version):
+    def __init__(self, base_url, wiki_version, cache_size=50000, read_only=False):
+        """
+        :param cache_size: maximum number of candidates of the wiki lookups that are cached,
+            0 disables the cache. A cached candidate takes roughly 200 bytes, so the default
+            of 50000 candidates takes about 10 MB, see GenericLookup.
+        :param read_only: open the database in read-only serving mode, see GenericLookup.
+        """
         self.wiki_db = GenericLookup(
-            "entity_word_embedding", os.path.join(base_url, wiki_version, "generated")
+            "entity_word_embedding",
+            os.path.join(base_url, wiki_version, "generated"),
+            cache_size=cache_size,
+            read_only=read_only,
         )
 
-    def get_ctxt(self, start, end, idx_sent, sentence, sentences_doc):
+    def tokenize_doc(self, sentences_doc):
+        """
+        Tokenizes a document once, such that get_ctxt can slice the context of each mention
+        from it instead of re-tokenizing the surrounding sentences.
+
+        :return: tokens of the document, index of the first token of each sentence and
+        start and end positions of the tokens per sentence.
+        """
+
+        tokens, sent_starts, spans = [], [], []
+        for sentence in sentences_doc:
+            sent_starts.append(len(tokens))
+            spans_sent = [match.span() for match in WORD_PATTERN.finditer(sentence)]
+            tokens.extend(unidecode.unidecode(sentence[s:e]) for s, e in spans_sent)
+            spans.append(([s for s, _ in spans_sent], [e for _, e in spans_sent]))
+        return tokens, sent_starts, spans
+
+    def get_ctxt(self, start, end, idx_sent, sentence, sentences_doc, doc_tokens=None):
         """
         Retrieves context surrounding a given mention up to 100 words from both sides.
+        If the output of tokenize_doc for sentences_doc is given, the context is sliced
+        from it, which gives the same result.
 
         :return: left and right context
         """
 
+        if (
+            doc_tokens is not None
+            and idx_sent < len(sentences_doc)
+            and sentences_doc[idx_sent] == sentence
+        ):
+            tokens, sent_starts, spans = doc_tokens
+            starts, ends = spans[idx_sent]
+            first = sent_starts[idx_sent]
+
+            # Tokens that end before the mention, plus the part of a token it cuts off.
+            i = bisect_right(ends, start)
+            left_ctxt = tokens[max(0, first + i - 100) : first + i]
+            if i < len(starts) and starts[i] < start:
+                left_ctxt.append(unidecode.unidecode(sentence[starts[i] : start]))
+            left_ctxt = " ".join(left_ctxt[-100:])
+
+            # Idem for the tokens that start after the mention.
+            i = bisect_left(starts, end)
+            right_ctxt = []
+            if i > 0 and ends[i - 1] > end:
+                right_ctxt.append(unidecode.unidecode(sentence[end : ends[i - 1]]))
+            right_ctxt += tokens[first + i : first + i + 100]
+            right_ctxt = " ".join(right_ctxt[:100])
+
+            return left_ctxt, right_ctxt
+
         # Iteratively add words up until we have 100
         left_ctxt = split_in_words(sentence[:start])
         if idx_sent > 0:
@@ -46,12 +106,21 @@ class MentionDetectionBase:
         :return: set of candidates
         """
 
+        return self.get_candidates_batch([mention])[0]
+
+    def get_candidates_batch(self, mentions):
+        """
+        Retrieves a maximum of 100 candidates per mention for a list of mentions using
+        a single batched lookup.
+
+        :return: list of candidates for each mention, in input order.
+        """
+
         # Performs extra check for ED.
-        cands = self.wiki_db.wiki(mention, "wiki")
-        if cands:
-            return cands[:100]
-        else:
-            return []
+        return [
+            cands[:100] if cands else []
+            for cands in self.wiki_db.wiki_batch(mentions, "wiki")
+        ]
 
     def preprocess_mention(self, m):
         """
@@ -61,40 +130,28 @@ class MentionDetectionBase:
         :return: mention
         """
 
-        # TODO: This can be optimised (less db calls required).
-        cur_m = modify_uppercase_phrase(m)
-        freq_lookup_cur_m = self.wiki_db.wiki(cur_m, "wiki", "freq")
-
-        if not freq_lookup_cur_m:
-            cur_m = m
-
-        freq_lookup_m = self.wiki_db.wiki(m, "wiki", "freq")
-        freq_lookup_cur_m = self.wiki_db.wiki(cur_m, "wiki", "freq")
+        return self.preprocess_mentions([m])[0]
 
-        if freq_lookup_m and (freq_lookup_m > freq_lookup_cur_m):
-            # Cases like 'U.S.' are handed badly by modify_uppercase_phrase
-            cur_m = m
+    def preprocess_mentions(self, mentions):
+        """
+        Preprocesses a list of mentions, resolving all of them in a single round trip.
 
-        freq_lookup_cur_m = self.wiki_db.wiki(cur_m, "wiki", "freq")
-        # If we cannot find the exact mention in our index, we try our luck to
-        # find it in a case insensitive index.
-        if not freq_lookup_cur_m:
-            # cur_m and m both not found, verify if lower-case version can be found.
-            find_lower = self.wiki_db.wiki(m.lower(), "wiki", "lower")
+        :return: list of mentions, in input order.
+        """
 
-            if find_lower:
-                cur_m = find_lower
+        return preprocess_mentions(mentions, self.wiki_db)
 
-        freq_lookup_cur_m = self.wiki_db.wiki(cur_m, "wiki", "freq")
-        # Try and remove first or last characters (e.g. 'Washington,' to 'Washington')
-        # To be error prone, we only try this if no match was found thus far, else
-        # this might get in the way of 'U.S.' converting to 'US'.
-        # Could do this recursively, interesting to explore in future work.
-        if not freq_lookup_cur_m:
-            temp = re.sub(r"[\(.|,|!|')]", "", m).strip()
-            simple_lookup = self.wiki_db.wiki(temp, "wiki", "freq")
+    def preprocess_mentions_candidates(self, mentions):
+        """
+        Preprocesses a list of mentions and retrieves a maximum of 100 candidates for each
+        preprocessed mention. Precomputed aliases already contain the candidates, so these
+        need no lookup in the wiki table.
 
-            if simple_lookup:
-                cur_m = temp
+        :return: list of mentions and list of candidates, in input order.
+        """
 
-        return cur_m
+        resolved = preprocess_mentions_lookup(mentions, self.wiki_db, "p_e_m")
+        return (
+            [m for m, _ in resolved],
+            [cands[:100] if cands else [] for _, cands in resolved],
+        )
@@ -1,7 +1,6 @@
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 """
 PreRank class is used for preranking entities for a given mention by multiplying entity vectors with
@@ -99,7 +98,6 @@ class MulRelRanker(torch.nn.Module):
         self.ew_embs = torch.nn.Parameter(
             torch.randn(self.config["n_rels"], self.config["emb_dims"]) * 0.01
         )
-        self._coh_ctx_vecs = None
 
         self.score_combine = torch.nn.Sequential(
             torch.nn.Linear(2, self.config["hid_dims"]),
@@ -167,83 +165,113 @@ class MulRelRanker(torch.nn.Module):
 
         scores = (scores * entity_mask).add_((entity_mask - 1).mul_(1e10))
 
-        self._entity_vecs = entity_vecs
-        self._local_ctx_vecs = ctx_vecs
-
-        return scores
+        return scores, entity_vecs
 
     def forward(
-        self, token_ids, tok_mask, entity_ids, entity_mask, p_e_m, embeddings, gold=None
+        self,
+        token_ids,
+        tok_mask,
+        entity_ids,
+        entity_mask,
+        p_e_m,
+        embeddings,
+        s_ltoken_ids,
+        s_ltoken_mask,
+        s_rtoken_ids,
+        s_rtoken_mask,
+        s_mtoken_ids,
+        s_mtoken_mask,
+        gold=None,
+        lbp_stats=None,
+        doc_ids=None,
     ):
         """
         Responsible for forward pass of ED model and produces a ranking of candidates for a given set of mentions.
+        All inputs are passed explicitly and no state is stored on the model, such that concurrent forward
+        passes do not interfere with each other.
 
         - ctx_layer refers to function f. See Figure 3 in respective paper.
         - ent_scores refers to function q.
         - score_combine refers to function g.
 
+        :param lbp_stats: optional dictionary in which the number of documents and the total number of
+            LBP iterations over these documents are stored.
+        :param doc_ids: optional document index of each mention, for a batch in which several documents
+            are packed. Mentions of the same document must be consecutive. Mentions are only connected
+            to mentions of the same document, such that each document is disambiguated independently.
         :return: Ranking of entities per mention.
         """
 
         n_ments, n_cands = entity_ids.size()
         n_rels = self.config["n_rels"]
 
+        n_docs = 1
+        if doc_ids is not None:
+            _, doc_ids = torch.unique_consecutive(doc_ids, return_inverse=True)
+            n_docs = int(doc_ids[-1]) + 1
+            if n_docs == 1:
+                doc_ids = None
+            else:
+                # Position of each mention within its document.
+                doc_sizes = torch.bincount(doc_ids, minlength=n_docs)
+                doc_starts = torch.cumsum(doc_sizes, dim=0) - doc_sizes
+                ment_pos = (
+                    torch.arange(n_ments, device=doc_ids.device) - doc_starts[doc_ids]
+                )
+
         if self.config["use_local"]:
-            local_ent_scores = self.__local_ent_scores(
+            local_ent_scores, ent_vecs = self.__local_ent_scores(
                 token_ids, tok_mask, entity_ids, entity_mask, embeddings, p_e_m=None
             )
-            ent_vecs = self._entity_vecs
         else:
             ent_vecs = embeddings["entity_embeddings"](entity_ids)
-            local_ent_scores = Variable(
-                torch.zeros(n_ments, n_cands), requires_grad=False
-            ).to(self.device)
+            local_ent_scores = torch.zeros(n_ments, n_cands, device=self.device)
 
         # compute context vectors
-        ltok_vecs = embeddings["snd_embeddings"](
-            self.s_ltoken_ids
-        ) * self.s_ltoken_mask.view(n_ments, -1, 1)
+        ltok_vecs = embeddings["snd_embeddings"](s_ltoken_ids) * s_ltoken_mask.view(
+            n_ments, -1, 1
+        )
         local_lctx_vecs = torch.sum(ltok_vecs, dim=1) / torch.sum(
-            self.s_ltoken_mask, dim=1, keepdim=True
+            s_ltoken_mask, dim=1, keepdim=True
         ).add_(1e-5)
-        rtok_vecs = embeddings["snd_embeddings"](
-            self.s_rtoken_ids
-        ) * self.s_rtoken_mask.view(n_ments, -1, 1)
+        rtok_vecs = embeddings["snd_embeddings"](s_rtoken_ids) * s_rtoken_mask.view(
+            n_ments, -1, 1
+        )
         local_rctx_vecs = torch.sum(rtok_vecs, dim=1) / torch.sum(
-            self.s_rtoken_mask, dim=1, keepdim=True
+            s_rtoken_mask, dim=1, keepdim=True
         ).add_(1e-5)
-        mtok_vecs = embeddings["snd_embeddings"](
-            self.s_mtoken_ids
-        ) * self.s_mtoken_mask.view(n_ments, -1, 1)
+        mtok_vecs = embeddings["snd_embeddings"](s_mtoken_ids) * s_mtoken_mask.view(
+            n_ments, -1, 1
+        )
         ment_vecs = torch.sum(mtok_vecs, dim=1) / torch.sum(
-            self.s_mtoken_mask, dim=1, keepdim=True
+            s_mtoken_mask, dim=1, keepdim=True
         ).add_(1e-5)
         bow_ctx_vecs = torch.cat([local_lctx_vecs, ment_vecs, local_rctx_vecs], dim=1)
 
         if self.config["use_pad_ent"]:
+            # A padding entity is added to each document.
             ent_vecs = torch.cat(
-                [ent_vecs, self.pad_ent_emb.view(1, 1, -1).repeat(1, n_cands, 1)], dim=0
+                [ent_vecs, self.pad_ent_emb.view(1, 1, -1).repeat(n_docs, n_cands, 1)],
+                dim=0,
             )
-            tmp = torch.zeros(1, n_cands)
-            tmp[0, 0] = 1
-            tmp = Variable(tmp).to(self.device)
+            tmp = torch.zeros(n_docs, n_cands, device=self.device)
+            tmp[:, 0] = 1
             entity_mask = torch.cat([entity_mask, tmp], dim=0)
             p_e_m = torch.cat([p_e_m, tmp], dim=0)
             local_ent_scores = torch.cat(
-                [
-                    local_ent_scores,
-                    Variable(torch.zeros(1, n_cands), requires_grad=False).to(
-                        self.device
-                    ),
-                ],
+                [local_ent_scores, torch.zeros(n_docs, n_cands, device=self.device)],
                 dim=0,
             )
-            n_ments += 1
+            n_ments += n_docs
+            if doc_ids is not None:
+                pad_doc_ids = torch.arange(n_docs, device=doc_ids.device)
+                doc_ids = torch.cat([doc_ids, pad_doc_ids])
+                ment_pos = torch.cat([ment_pos, doc_sizes])
 
         if self.config["use_local_only"]:
             inputs = torch.cat(
                 [
-                    Variable(torch.zeros(n_ments * n_cands, 1)).to(self.device),
+                    torch.zeros(n_ments * n_cands, 1, device=self.device),
                     local_ent_scores.view(n_ments * n_cands, -1),
                     torch.log(p_e_m + 1e-20).view(n_ments * n_cands, -1),
                 ],
@@ -252,13 +280,29 @@ class MulRelRanker(torch.nn.Module):
             scores = self.score_combine(inputs).view(n_ments, n_cands)
             return scores
 
-        if n_ments == 1:
+        # The mentions of each document are placed in a block of n_docs x doc_len slots.
+        if doc_ids is None:
+            doc_len = n_ments
+        else:
+            doc_len = int(ment_pos.max()) + 1
+            slots = torch.full(
+                (n_docs, doc_len), -1, dtype=torch.long, device=doc_ids.device
+            )
+            slots[doc_ids, ment_pos] = torch.arange(n_ments, device=doc_ids.device)
+            valid = slots >= 0
+            slots.clamp_(min=0)
+
+        def block(x):
+            return x.unsqueeze(0) if doc_ids is None else x[slots]
+
+        if doc_len == 1:
             ent_scores = local_ent_scores
+            n_iters = torch.zeros(n_docs, dtype=torch.long, device=self.device)
 
         else:
             # distance - to consider only neighbor mentions
-            ment_pos = torch.arange(0, n_ments).long()
-            dist = (ment_pos.view(n_ments, 1) - ment_pos.view(1, n_ments)).abs()
+            ment_pos = torch.arange(0, doc_len).long()
+            dist = (ment_pos.view(doc_len, 1) - ment_pos.view(1, doc_len)).abs()
             dist.masked_fill_(dist == 1, -1)
             dist.masked_fill_((dist > 1) & (dist <= self.max_dist), -1)
             dist.masked_fill_(dist > self.max_dist, 0)
@@ -266,88 +310,67 @@ class MulRelRanker(torch.nn.Module):
 
             ctx_vecs = self.ctx_layer(bow_ctx_vecs)
             if self.config["use_pad_ent"]:
-                ctx_vecs = torch.cat([ctx_vecs, self.pad_ctx_vec], dim=0)
+                ctx_vecs = torch.cat(
+                    [ctx_vecs, self.pad_ctx_vec.repeat(n_docs, 1)], dim=0
+                )
 
-            m1_ctx_vecs, m2_ctx_vecs = ctx_vecs, ctx_vecs
-            rel_ctx_vecs = m1_ctx_vecs.view(1, n_ments, -1) * self.ew_embs.view(
-                n_rels, 1, -1
+            m1_ctx_vecs, m2_ctx_vecs = block(ctx_vecs), block(ctx_vecs)
+            rel_ctx_vecs = m1_ctx_vecs.view(1, n_docs, doc_len, -1) * self.ew_embs.view(
+                n_rels, 1, 1, -1
             )
             rel_ctx_ctx_scores = torch.matmul(
-                rel_ctx_vecs, m2_ctx_vecs.view(1, n_ments, -1).permute(0, 2, 1)
-            )  # n_rels x n_ments x n_ments
+                rel_ctx_vecs,
+                m2_ctx_vecs.view(1, n_docs, doc_len, -1).permute(0, 1, 3, 2),
+            )  # n_rels x n_docs x doc_len x doc_len
 
             rel_ctx_ctx_scores = rel_ctx_ctx_scores.add_(
-                (1 - Variable(dist.float()).to(self.device)).mul_(-1e10)
+                (1 - dist.float().to(self.device)).mul_(-1e10)
             )
-            eye = Variable(torch.eye(n_ments)).view(1, n_ments, n_ments).to(self.device)
+            if doc_ids is not None:
+                # Empty slots get a larger penalty, such that they stay below masked mentions.
+                rel_ctx_ctx_scores.add_(
+                    valid.logical_not().float().mul_(-2e10).view(1, n_docs, 1, doc_len)
+                )
+            eye = torch.eye(doc_len, device=self.device).view(1, 1, doc_len, doc_len)
             rel_ctx_ctx_scores.add_(eye.mul_(-1e10))
             rel_ctx_ctx_scores.mul_(
                 1 / np.sqrt(self.config["emb_dims"])
             )  # scaling proposed by "attention is all you need"
 
-            # get top_n neighbour
-            if self.ent_top_n < n_ments:
-                topk_values, _ = torch.topk(
-                    rel_ctx_ctx_scores, k=min(self.ent_top_n, n_ments), dim=2
+            n_neighbours = self.config["lbp_window"]
+            if (
+                n_neighbours is not None
+                and n_neighbours < n_ments - 1
+                and doc_ids is None
+            ):
+                ent_scores, n_iters = self.__sparse_ent_scores(
+                    rel_ctx_ctx_scores[:, 0],
+                    ent_vecs,
+                    entity_mask,
+                    local_ent_scores,
+                    n_neighbours,
                 )
-                threshold = topk_values[:, :, -1:]
-                mask = 1 - (rel_ctx_ctx_scores >= threshold).float()
-                rel_ctx_ctx_scores.add_(mask.mul_(-1e10))
-
-            rel_ctx_ctx_probs = F.softmax(rel_ctx_ctx_scores, dim=2)
-            rel_ctx_ctx_weights = rel_ctx_ctx_probs + rel_ctx_ctx_probs.permute(0, 2, 1)
-            self._rel_ctx_ctx_weights = rel_ctx_ctx_probs
-
-            # compute phi(ei, ej)
-            rel_ent_vecs = ent_vecs.view(1, n_ments, n_cands, -1) * self.rel_embs.view(
-                n_rels, 1, 1, -1
-            )
-            rel_ent_ent_scores = torch.matmul(
-                rel_ent_vecs.view(n_rels, n_ments, 1, n_cands, -1),
-                ent_vecs.view(1, 1, n_ments, n_cands, -1).permute(0, 1, 2, 4, 3),
-            )
-
-            rel_ent_ent_scores = rel_ent_ent_scores.permute(
-                0, 1, 3, 2, 4
-            )  # n_rel x n_ments x n_cands x n_ments x n_cands
-            rel_ent_ent_scores = (rel_ent_ent_scores * entity_mask).add_(
-                (entity_mask - 1).mul_(1e10)
-            )
-            ent_ent_scores = torch.sum(
-                rel_ent_ent_scores
-                * rel_ctx_ctx_weights.view(n_rels, n_ments, 1, n_ments, 1),
-                dim=0,
-            ).mul(
-                1.0 / n_rels
-            )  # n_ments x n_cands x n_ments x n_cands
-
-            # LBP
-            prev_msgs = Variable(torch.zeros(n_ments, n_cands, n_ments)).to(self.device)
-
-            for _ in range(self.config["n_loops"]):
-                mask = 1 - Variable(torch.eye(n_ments)).to(self.device)
-                ent_ent_votes = (
-                    ent_ent_scores
-                    + local_ent_scores * 1
-                    + torch.sum(
-                        prev_msgs.view(1, n_ments, n_cands, n_ments)
-                        * mask.view(n_ments, 1, 1, n_ments),
-                        dim=3,
-                    ).view(n_ments, 1, n_ments, n_cands)
+            else:
+                ent_scores, n_iters = self.__dense_ent_scores(
+                    rel_ctx_ctx_scores,
+                    block(ent_vecs),
+                    block(entity_mask),
+                    block(local_ent_scores),
+                    None if doc_ids is None else valid,
                 )
-                msgs, _ = torch.max(ent_ent_votes, dim=3)
-                msgs = (
-                    F.softmax(msgs, dim=1).mul(self.config["dropout_rate"])
-                    + prev_msgs.exp().mul(1 - self.config["dropout_rate"])
-                ).log()
-                prev_msgs = msgs
-
-            # compute marginal belief
-            mask = 1 - Variable(torch.eye(n_ments)).to(self.device)
-            ent_scores = local_ent_scores * 1 + torch.sum(
-                msgs * mask.view(n_ments, 1, n_ments), dim=2
-            )
-            ent_scores = F.softmax(ent_scores, dim=1)
+                if doc_ids is None:
+                    ent_scores = ent_scores[0]
+                else:
+                    block_scores = ent_scores
+                    ent_scores = torch.empty_like(local_ent_scores)
+                    ent_scores[slots[valid]] = block_scores[valid]
+                    if not self.config["use_pad_ent"]:
+                        # Documents with a single mention only use their local scores.
+                        single = valid.sum(dim=1)[doc_ids] == 1
+                        ent_scores = torch.where(
+                            single.view(n_ments, 1), local_ent_scores, ent_scores
+                        )
+                        n_iters = n_iters * (valid.sum(dim=1) > 1)
 
         # combine with p_e_m
         inputs = torch.cat(
@@ -361,9 +384,203 @@ class MulRelRanker(torch.nn.Module):
         # scores = F.softmax(scores, dim=1)
 
         if self.config["use_pad_ent"]:
-            scores = scores[:-1]
+            scores = scores[:-n_docs]
+        if lbp_stats is not None:
+            lbp_stats["documents"] = n_docs
+            lbp_stats["iterations"] = int(n_iters.sum())
         return scores, ent_scores
 
+    def __dense_ent_scores(
+        self, rel_ctx_ctx_scores, ent_vecs, entity_mask, local_ent_scores, valid=None
+    ):
+        """
+        Loopy belief propagation between all pairs of mentions of each document, where the
+        mentions of n_docs documents are given in blocks of n_ments slots.
+
+        :param rel_ctx_ctx_scores: n_rels x n_docs x n_ments x n_ments
+        :param valid: optional mask (n_docs x n_ments) of the slots that hold a mention.
+        :return: entity scores (n_docs x n_ments x n_cands) after LBP and the number of iterations
+            per document.
+        """
+        n_rels, n_docs, n_ments, _ = rel_ctx_ctx_scores.size()
+        n_cands = ent_vecs.size(2)
+
+        # get top_n neighbour
+        if self.ent_top_n < n_ments:
+            topk_values, _ = torch.topk(
+                rel_ctx_ctx_scores, k=min(self.ent_top_n, n_ments), dim=3
+            )
+            threshold = topk_values[:, :, :, -1:]
+            mask = 1 - (rel_ctx_ctx_scores >= threshold).float()
+            rel_ctx_ctx_scores.add_(mask.mul_(-1e10))
+
+        rel_ctx_ctx_probs = F.softmax(rel_ctx_ctx_scores, dim=3)
+        rel_ctx_ctx_weights = rel_ctx_ctx_probs + rel_ctx_ctx_probs.permute(0, 1, 3, 2)
+
+        # compute phi(ei, ej)
+        rel_ent_vecs = ent_vecs.view(
+            1, n_docs, n_ments, n_cands, -1
+        ) * self.rel_embs.view(n_rels, 1, 1, 1, -1)
+        rel_ent_ent_scores = torch.matmul(
+            rel_ent_vecs.view(n_rels, n_docs, n_ments, 1, n_cands, -1),
+            ent_vecs.view(1, n_docs, 1, n_ments, n_cands, -1).permute(0, 1, 2, 3, 5, 4),
+        )
+
+        rel_ent_ent_scores = rel_ent_ent_scores.permute(
+            0, 1, 2, 4, 3, 5
+        )  # n_rel x n_docs x n_ments x n_cands x n_ments x n_cands
+        entity_mask = entity_mask.view(1, n_docs, 1, 1, n_ments, n_cands)
+        rel_ent_ent_scores = (rel_ent_ent_scores * entity_mask).add_(
+            (entity_mask - 1).mul_(1e10)
+        )
+        ent_ent_scores = torch.sum(
+            rel_ent_ent_scores
+            * rel_ctx_ctx_weights.view(n_rels, n_docs, n_ments, 1, n_ments, 1),
+            dim=0,
+        ).mul(
+            1.0 / n_rels
+        )  # n_docs x n_ments x n_cands x n_ments x n_cands
+
+        # Messages are only sent between the slots that hold a mention.
+        msg_mask = None
+        if valid is not None:
+            msg_mask = valid.view(n_docs, n_ments, 1, 1) & valid.view(
+                n_docs, 1, 1, n_ments
+            )
+
+        # LBP, where a mention combines all its incoming messages except the one from the receiver.
+        msgs, n_iters = self.__lbp(
+            ent_ent_scores + local_ent_scores.view(n_docs, 1, 1, n_ments, n_cands),
+            lambda prev_msgs: prev_msgs.sum(dim=3).view(n_docs, 1, n_ments, n_cands)
+            - prev_msgs.permute(0, 3, 1, 2),
+            msg_mask,
+        )
+
+        # compute marginal belief, excluding messages from a mention to itself.
+        not_eye = 1 - torch.eye(n_ments, device=self.device)
+        ent_scores = local_ent_scores + torch.sum(
+            msgs * not_eye.view(1, n_ments, 1, n_ments), dim=3
+        )
+        ent_scores = F.softmax(ent_scores, dim=2)
+        return ent_scores, n_iters
+
+    def __sparse_ent_scores(
+        self, rel_ctx_ctx_scores, ent_vecs, entity_mask, local_ent_scores, n_neighbours
+    ):
+        """
+        Loopy belief propagation in which each mention only exchanges messages with the n_neighbours
+        mentions that it attends to most, such that time and memory scale linearly with the number of
+        mentions. Equal to __dense_ent_scores if all other mentions are neighbours.
+
+        :return: entity scores after LBP and the number of iterations.
+        """
+        n_rels, n_ments, _ = rel_ctx_ctx_scores.size()
+        n_cands = ent_vecs.size(1)
+
+        # nbrs[i, s] is the s-th neighbour of mention i, ranked by its highest score over the relations.
+        _, nbrs = torch.topk(rel_ctx_ctx_scores.max(dim=0)[0], k=n_neighbours, dim=1)
+        nbr_probs = F.softmax(
+            torch.gather(
+                rel_ctx_ctx_scores, 2, nbrs.view(1, n_ments, -1).expand(n_rels, -1, -1)
+            ),
+            dim=2,
+        )  # n_rels x n_ments x n_neighbours
+
+        # Position of mention i among the neighbours of its s-th neighbour, if any.
+        is_rev = nbrs[nbrs] == torch.arange(n_ments, device=nbrs.device).view(-1, 1, 1)
+        has_rev = is_rev.any(dim=2).float()
+        rev = is_rev.float().argmax(dim=2)
+        rel_ctx_ctx_weights = nbr_probs + nbr_probs[:, nbrs, rev] * has_rev
+
+        # compute phi(ei, ej) for the neighbours only
+        rel_ent_ent_scores = torch.einsum(
+            "ibe,re,isde->ribsd", ent_vecs, self.rel_embs, ent_vecs[nbrs]
+        )  # n_rels x n_ments x n_cands x n_neighbours x n_cands
+        nbr_mask = entity_mask[nbrs].view(1, n_ments, 1, n_neighbours, n_cands)
+        rel_ent_ent_scores = (rel_ent_ent_scores * nbr_mask).add_(
+            (nbr_mask - 1).mul_(1e10)
+        )
+        ent_ent_scores = torch.einsum(
+            "ribsd,ris->ibsd", rel_ent_ent_scores, rel_ctx_ctx_weights
+        ).mul(1.0 / n_rels)
+
+        # LBP, where msgs[i, b, s] is the message from the s-th neighbour of mention i. A neighbour
+        # combines all its incoming messages, except the one from the receiver.
+        has_rev = has_rev.view(n_ments, n_neighbours, 1)
+        msgs, n_iters = self.__lbp(
+            ent_ent_scores
+            + local_ent_scores[nbrs].view(n_ments, 1, n_neighbours, n_cands),
+            lambda prev_msgs: prev_msgs.sum(dim=2)[nbrs]
+            - prev_msgs[nbrs, :, rev] * has_rev,
+        )
+
+        # compute marginal belief
+        ent_scores = local_ent_scores + torch.sum(msgs, dim=2)
+        return F.softmax(ent_scores, dim=1), n_iters
+
+    def __lbp(self, ent_ent_local_scores, incoming_msgs, msg_mask=None):
+        """
+        Loopy belief propagation, which stops early once the messages (as probabilities) are
+        estimated to be within lbp_tol of the messages they converge to.
+
+        :param ent_ent_local_scores: pairwise plus local scores, n_ments x n_cands x n_senders x n_cands,
+            optionally preceded by dimensions of independent documents. Each document stops
+            independently and keeps its messages once it stopped.
+        :param incoming_msgs: function that combines the messages of each sender for each receiver.
+        :param msg_mask: optional boolean mask of the messages that are sent, n_ments x 1 x n_senders.
+        :return: messages (n_ments x n_cands x n_senders) and the number of iterations of each
+            document.
+        """
+        docs = ent_ent_local_scores.shape[:-4]
+        n_ments, n_cands, n_senders, _ = ent_ent_local_scores.shape[-4:]
+        df = self.config["dropout_rate"]
+        tol = self.config["lbp_tol"]
+
+        prev_msgs = torch.zeros(*docs, n_ments, n_cands, n_senders, device=self.device)
+        stopped = torch.zeros(docs, dtype=torch.bool, device=self.device)
+        n_iters = torch.zeros(docs, dtype=torch.long, device=self.device)
+        prev_change = torch.full(docs, float("nan"), device=self.device)
+        prev_rate = prev_change.clone()
+        # Without autograd, all iterations write their votes to the same workspace.
+        votes = (
+            None if torch.is_grad_enabled() else torch.empty_like(ent_ent_local_scores)
+        )
+
+        for _ in range(self.config["n_loops"]):
+            n_iters += stopped.logical_not()
+            incoming = incoming_msgs(prev_msgs).view(
+                *docs, n_ments, 1, n_senders, n_cands
+            )
+            if votes is None:
+                ent_ent_votes = ent_ent_local_scores + incoming
+            else:
+                ent_ent_votes = torch.add(ent_ent_local_scores, incoming, out=votes)
+            msgs, _ = torch.max(ent_ent_votes, dim=-1)
+            msgs = (F.softmax(msgs, dim=-2).mul(df) + prev_msgs.exp().mul(1 - df)).log()
+            if msg_mask is not None:
+                msgs.masked_fill_(msg_mask.logical_not(), 0)
+
+            converged = False
+            if tol is not None:
+                msgs = torch.where(stopped.view(*docs, 1, 1, 1), prev_msgs, msgs)
+                # Compare probabilities, as messages of improbable candidates keep decreasing in
+                # log space.
+                change = (msgs.exp() - prev_msgs.exp()).abs()
+                change = change.flatten(start_dim=len(docs)).max(dim=-1)[0]
+                # The messages converge about geometrically, such that the remaining distance
+                # to the converged messages is about change * rate / (1 - rate). The rate is the
+                # largest of the last two ratios of changes, and half of lbp_tol is kept as a
+                # margin for the error of this estimate.
+                rate = torch.max(change / prev_change, prev_rate)
+                estimate = change * rate / (1 - rate)
+                stopped = stopped | ((rate < 1) & (estimate < tol / 2))
+                prev_change, prev_rate = change, change / prev_change
+                converged = bool(stopped.all())
+            prev_msgs = msgs
+            if converged:
+                break
+        return prev_msgs, n_iters
+
     def regularize(self, max_norm=1):
         """
         Regularises model parameters.
@@ -432,3 +649,65 @@ class MulRelRanker(torch.nn.Module):
         diff = diff * (diff < 1).float()
         loss -= torch.sum(diff).mul(lamb)
         return loss
+
+
+class TracedMulRelRanker(torch.nn.Module):
+    """
+    Wraps a MulRelRanker together with fixed embedding layers, such that its forward pass only
+    takes tensors and can be exported with torch.jit.trace.
+    """
+
+    def __init__(self, model, embeddings, pad_id):
+        """
+        :param pad_id: word ID that is used to pad the context of each mention.
+        """
+        super(TracedMulRelRanker, self).__init__()
+        self.model = model
+        self.embeddings = torch.nn.ModuleDict(
+            {
+                k: embeddings[k]
+                for k in ["word_embeddings", "entity_embeddings", "snd_embeddings"]
+            }
+        )
+        self.pad_id = pad_id
+
+    def forward(
+        self,
+        token_ids,
+        tok_mask,
+        entity_ids,
+        entity_mask,
+        p_e_m,
+        s_ltoken_ids,
+        s_ltoken_mask,
+        s_rtoken_ids,
+        s_rtoken_mask,
+        s_mtoken_ids,
+        s_mtoken_mask,
+    ):
+        # A trace records the number of attended context tokens as a constant. Masked tokens do
+        # not contribute to the context vectors, so adding tok_top_n of them makes sure there
+        # are always enough tokens.
+        n_pad = self.model.config["tok_top_n"]
+        token_ids = torch.cat(
+            [token_ids, token_ids.new_full((token_ids.size(0), n_pad), self.pad_id)],
+            dim=1,
+        )
+        tok_mask = torch.cat(
+            [tok_mask, tok_mask.new_zeros((tok_mask.size(0), n_pad))], dim=1
+        )
+
+        return self.model.forward(
+            token_ids,
+            tok_mask,
+            entity_ids,
+            entity_mask,
+            p_e_m,
+            self.embeddings,
+            s_ltoken_ids,
+            s_ltoken_mask,
+            s_rtoken_ids,
+            s_rtoken_mask,
+            s_mtoken_ids,
+            s_mtoken_mask,
+        )
@@ -4,3 +4,4 @@
 from REL.ner.base import NERBase, Span
 from REL.ner.flair_wrapper import load_flair_ner
 from REL.ner.ngram import Cmns
+from REL.ner.trie import TrieTagger
@@ -0,0 +1,206 @@
+import os
+import re
+import shutil
+from collections import deque
+
+import numpy as np
+
+from REL.db.generic import GenericLookup, file_key
+from REL.ner.base import NERBase, Span
+
+# Words and individual punctuation marks, such that e.g. "U.S." and "U. S." share a key.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Arrays of a stored trie, see TrieTagger.
+TRIE_ARRAYS = ["key", "vocab", "vocab_offsets", "children", "tokens", "freqs"]
+
+
+class TrieTagger(NERBase):
+    """
+    Dictionary based mention detection. All surface forms in the wiki table that occur
+    at least min_freq times are compiled into a token trie that is stored on disk.
+    Text is tagged in a single pass without database calls by greedily selecting the
+    longest surface form that starts at each token.
+
+    The trie is stored as flat arrays that are memory-mapped, such that it is shared
+    through the page cache rather than loaded into every process:
+
+    - vocab, vocab_offsets: the UTF-8 encoded tokens in sorted order, concatenated, and
+      the offset of each token. The id of a token is its position in this order.
+    - children, tokens, freqs: nodes are numbered in breadth-first order, such that the
+      children of node n are the nodes children[n] up to children[n + 1], sorted by the
+      id of the token that leads to them. The frequency of a node is -1 if it does not
+      complete a surface form.
+
+    It is rebuilt whenever the database file changes.
+    """
+
+    def __init__(self, base_url, wiki_version, min_freq=1, reset=False):
+        """
+        :param min_freq: minimum frequency of a surface form to be detected.
+        :param reset: rebuild the trie, even if it already exists on disk.
+        """
+        self.__base_dir = os.path.join(base_url, wiki_version, "generated")
+        path = os.path.join(self.__base_dir, "trie_{}".format(min_freq))
+
+        # The cached trie is only valid for the database it was built from.
+        db_key = file_key(os.path.join(self.__base_dir, "entity_word_embedding.db"))
+
+        arrays = None
+        if not reset and os.path.isdir(path):
+            arrays = self.__load(path)
+        if arrays is None or tuple(arrays["key"]) != db_key:
+            self.__save(path, {"key": np.array(db_key), **self.__build(min_freq)})
+            arrays = self.__load(path)
+
+        self.__vocab = arrays["vocab"]
+        self.__vocab_offsets = arrays["vocab_offsets"]
+        self.__children = arrays["children"]
+        self.__tokens = arrays["tokens"]
+        self.__freqs = arrays["freqs"]
+
+    def predict(self, sentence, sentences_doc):
+        """
+        Finds the longest non-overlapping surface forms in a sentence.
+
+        Added optional parameter sentences_doc for completeness sake, see Cmns.
+        """
+        tokens = [
+            (m.group(), m.start(), m.end()) for m in TOKEN_PATTERN.finditer(sentence)
+        ]
+        token_ids = {t: self.__token_id(t) for t in {t for t, _, _ in tokens}}
+        ids = [token_ids[t] for t, _, _ in tokens]
+
+        mentions = []
+        i = 0
+        while i < len(tokens):
+            node, match = 0, None
+            for j in range(i, len(tokens)):
+                node = self.__child(node, ids[j])
+                if node is None:
+                    break
+                if self.__freqs[node] >= 0:
+                    match = (j + 1, int(self.__freqs[node]))
+
+            if match is None:
+                i += 1
+                continue
+
+            j, freq = match
+            start, end = tokens[i][1], tokens[j - 1][2]
+            mentions.append(Span(sentence[start:end], start, end, freq, "#TRIE#"))
+            i = j
+
+        # returns list of Span objects.
+        return mentions
+
+    def __token_id(self, token):
+        """
+        Binary search for a token in the sorted vocabulary.
+
+        :return: id of the token or None if no surface form contains it.
+        """
+        word = token.encode("utf-8")
+        lo, hi = 0, len(self.__vocab_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = self.__vocab_offsets[mid], self.__vocab_offsets[mid + 1]
+            if self.__vocab[start:end].tobytes() < word:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == len(self.__vocab_offsets) - 1:
+            return None
+        start, end = self.__vocab_offsets[lo], self.__vocab_offsets[lo + 1]
+        return lo if self.__vocab[start:end].tobytes() == word else None
+
+    def __child(self, node, token_id):
+        """
+        :return: child of a node that is reached by a token or None if it does not exist.
+        """
+        if token_id is None:
+            return None
+
+        start, end = self.__children[node], self.__children[node + 1]
+        i = start + int(np.searchsorted(self.__tokens[start:end], token_id))
+        return i if i < end and self.__tokens[i] == token_id else None
+
+    @staticmethod
+    def __load(path):
+        """
+        :return: memory-mapped arrays of a stored trie or None if it is incomplete.
+        """
+        paths = {name: os.path.join(path, name + ".npy") for name in TRIE_ARRAYS}
+        if not all(os.path.isfile(p) for p in paths.values()):
+            return None
+        return {name: np.load(p, mmap_mode="r") for name, p in paths.items()}
+
+    @staticmethod
+    def __save(path, arrays):
+        """
+        Stores the arrays of a trie in a new directory that replaces the existing one.
+        """
+        path_tmp = path + ".tmp"
+        shutil.rmtree(path_tmp, ignore_errors=True)
+        os.makedirs(path_tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(path_tmp, name + ".npy"), array)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(path_tmp, path)
+
+    def __build(self, min_freq):
+        """
+        Compiles the surface forms in the wiki table into a token trie, see TrieTagger.
+
+        :return: dictionary of the arrays of the trie.
+        """
+        wiki_db = GenericLookup(
+            "entity_word_embedding",
+            self.__base_dir,
+            table_name="wiki",
+            columns={"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+        )
+
+        forms = {}
+        for word, freq in wiki_db.db.execute(
+            "select word, freq from wiki where freq >= ?", (min_freq,)
+        ):
+            tokens = TOKEN_PATTERN.findall(word)
+            # Similar to Cmns, skip forms without any word characters.
+            if not any(re.match(r"\w", t) for t in tokens):
+                continue
+
+            key = tuple(t.encode("utf-8") for t in tokens)
+            forms[key] = max(freq, forms.get(key, 0))
+
+        vocab = sorted({t for key in forms for t in key})
+        vocab_ids = {t: i for i, t in enumerate(vocab)}
+
+        # Nested nodes [children by token id, frequency], numbered breadth-first below.
+        root = [{}, -1]
+        for key, freq in forms.items():
+            node = root
+            for t in key:
+                node = node[0].setdefault(vocab_ids[t], [{}, -1])
+            node[1] = freq
+
+        children, tokens, freqs = [], [-1], [-1]
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            children.append(len(tokens))
+            for token_id in sorted(node[0]):
+                child = node[0][token_id]
+                tokens.append(token_id)
+                freqs.append(child[1])
+                queue.append(child)
+        children.append(len(tokens))
+
+        return {
+            "vocab": np.frombuffer(b"".join(vocab), dtype=np.uint8),
+            "vocab_offsets": np.cumsum([0] + [len(t) for t in vocab], dtype=np.int64),
+            "children": np.array(children, dtype=np.int64),
+            "tokens": np.array(tokens, dtype=np.int32),
+            "freqs": np.array(freqs, dtype=np.int64),
+        }
@@ -25,43 +25,91 @@ def preprocess_mention(m, wiki_db):
     :return: mention
     """
 
-    # TODO: This can be optimised (less db calls required).
-    cur_m = modify_uppercase_phrase(m)
-    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
-
-    if not freq_lookup_cur_m:
-        cur_m = m
-
-    freq_lookup_m = wiki_db.wiki(m, "wiki", "freq")
-    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
-
-    if freq_lookup_m and (freq_lookup_m > freq_lookup_cur_m):
-        # Cases like 'U.S.' are handed badly by modify_uppercase_phrase
-        cur_m = m
-
-    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
-    # If we cannot find the exact mention in our index, we try our luck to
-    # find it in a case insensitive index.
-    if not freq_lookup_cur_m:
-        # cur_m and m both not found, verify if lower-case version can be found.
-        find_lower = wiki_db.wiki(m.lower(), "wiki", "lower")
-
-        if find_lower:
-            cur_m = find_lower
-
-    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
-    # Try and remove first or last characters (e.g. 'Washington,' to 'Washington')
-    # To be error prone, we only try this if no match was found thus far, else
-    # this might get in the way of 'U.S.' converting to 'US'.
-    # Could do this recursively, interesting to explore in future work.
-    if not freq_lookup_cur_m:
-        temp = re.sub(r"[\(.|,|!|')]", "", m).strip()
-        simple_lookup = wiki_db.wiki(temp, "wiki", "freq")
-
-        if simple_lookup:
-            cur_m = temp
-
-    return cur_m
+    return preprocess_mentions([m], wiki_db)[0]
+
+
+def preprocess_mentions(mentions, wiki_db):
+    """
+    Batched version of preprocess_mention. Mentions are first looked up in the table of
+    precomputed aliases, if it exists. All variants of the remaining mentions are
+    resolved in a single round trip, after which the same rules are applied in memory.
+
+    :return: list of mentions, in input order.
+    """
+
+    aliases = wiki_db.wiki_alias(mentions)
+    todo = list(dict.fromkeys(m for m, a in zip(mentions, aliases) if a is None))
+    if not todo:
+        return aliases
+
+    resolved = dict(zip(todo, _resolve_mentions(todo, wiki_db)))
+    return [resolved[m] if a is None else a for m, a in zip(mentions, aliases)]
+
+
+def preprocess_mentions_lookup(mentions, wiki_db, column_name="p_e_m"):
+    """
+    Preprocesses a list of mentions and retrieves the given column ("p_e_m" or "freq") of
+    the wiki table for each preprocessed mention. Mentions in the table of precomputed
+    aliases are served from it directly, as it stores the row of the canonical mention.
+
+    :return: list of (mention, value) tuples, in input order. The value is None if the
+        mention does not exist.
+    """
+
+    aliases = wiki_db.wiki_alias(mentions, column_name=("mention", column_name))
+    todo = list(dict.fromkeys(m for m, a in zip(mentions, aliases) if a is None))
+    if not todo:
+        return aliases
+
+    resolved = _resolve_mentions(todo, wiki_db)
+    resolved = dict(
+        zip(todo, zip(resolved, wiki_db.wiki_batch(resolved, "wiki", column_name)))
+    )
+    return [resolved[m] if a is None else a for m, a in zip(mentions, aliases)]
+
+
+def _resolve_mentions(mentions, wiki_db):
+    """
+    Applies the rules of preprocess_mention to a list of mentions.
+
+    :return: list of mentions, in input order.
+    """
+
+    variants = [
+        (m, modify_uppercase_phrase(m), re.sub(r"[\(.|,|!|')]", "", m).strip())
+        for m in mentions
+    ]
+    freqs, found_lower = wiki_db.wiki_resolve(
+        [v for vs in variants for v in vs], [m.lower() for m in mentions], "wiki"
+    )
+
+    res = []
+    for m, upper_m, stripped_m in variants:
+        cur_m = upper_m if freqs[upper_m] else m
+
+        if freqs[m] and (freqs[m] > freqs[cur_m]):
+            # Cases like 'U.S.' are handed badly by modify_uppercase_phrase
+            cur_m = m
+
+        freq_cur_m = freqs[cur_m]
+        # If we cannot find the exact mention in our index, we try our luck to
+        # find it in a case insensitive index.
+        if not freq_cur_m:
+            # cur_m and m both not found, verify if lower-case version can be found.
+            find_lower = found_lower[m.lower()]
+
+            if find_lower and find_lower[0]:
+                cur_m, freq_cur_m = find_lower
+
+        # Try and remove first or last characters (e.g. 'Washington,' to 'Washington')
+        # To be error prone, we only try this if no match was found thus far, else
+        # this might get in the way of 'U.S.' converting to 'US'.
+        # Could do this recursively, interesting to explore in future work.
+        if not freq_cur_m and freqs[stripped_m]:
+            cur_m = stripped_m
+
+        res.append(cur_m)
+    return res
 
 
 def process_results(
@@ -29,6 +29,7 @@ class Vocabulary:
         self.counts = []
         self.unk_id = 0
         self.first_run = 0
+        self.free_ids = []
 
     @staticmethod
     def normalize(token, lower=LOWER, digit_0=DIGIT_0):
@@ -53,18 +54,35 @@ class Vocabulary:
 
     def add_to_vocab(self, token):
         """
-        Adds token to vocabulary.
+        Adds token to vocabulary. IDs of removed tokens are reused.
 
-        :return:
+        :return: ID of the token.
         """
-        new_id = len(self.id2word)
-        self.id2word.append(token)
+        if self.free_ids:
+            new_id = self.free_ids.pop()
+            self.id2word[new_id] = token
+        else:
+            new_id = len(self.id2word)
+            self.id2word.append(token)
         self.word2id[token] = new_id
         self.idtoword[new_id] = token
+        return new_id
+
+    def remove_from_vocab(self, token):
+        """
+        Removes token from vocabulary, such that its ID can be reused.
+
+        :return: ID of the removed token.
+        """
+        old_id = self.word2id.pop(token)
+        del self.idtoword[old_id]
+        self.id2word[old_id] = None
+        self.free_ids.append(old_id)
+        return old_id
 
     def size(self):
         """
-        Checks size vocabulary.
+        Checks size vocabulary, including the IDs of removed tokens.
 
         :return: size vocabulary
         """
@@ -23,10 +23,13 @@ class WikipediaYagoFreq:
         self.p_e_m = {}
         self.mention_freq = {}
 
-    def store(self):
+    def store(self, resolve_alias=False):
         """
         Stores results in a sqlite3 database.
 
+        :param resolve_alias: also precompute the canonical mention of common surface
+            variants, see GenericLookup.load_resolved_alias. This is disabled by default, as
+            it makes the database larger.
         :return:
         """
         print("Please take a break, this will take a while :).")
@@ -39,6 +42,9 @@ class WikipediaYagoFreq:
         )
 
         wiki_db.load_wiki(self.p_e_m, self.mention_freq, batch_size=50000, reset=True)
+        if resolve_alias:
+            wiki_db.load_resolved_alias(batch_size=50000)
+        wiki_db.build_bloom(batch_size=50000)
 
     def compute_wiki(self):
         """
@@ -0,0 +1,46 @@
+import torch
+
+from REL.entity_disambiguation import EntityDisambiguation
+from REL.training_datasets import TrainingEvaluationDatasets
+
+"""
+Compares the accuracy and latency of ED on the AIDA evaluation datasets when the model and
+embeddings are kept in reduced precision on the CPU.
+"""
+
+base_url = "/users/vanhulsm/Desktop/projects/data"
+wiki_version = "wiki_2014"
+
+# Run on a fixed number of threads, such that timings are comparable.
+torch.set_num_threads(4)
+
+datasets = TrainingEvaluationDatasets(base_url, wiki_version).load()
+datasets = {k: v for k, v in datasets.items() if k in ["aida_testA", "aida_testB"]}
+
+# Name, quantization of the model and dtype of the embeddings.
+modes = [
+    ("float32", None, "float32"),
+    ("bfloat16 embeddings", None, "bfloat16"),
+    ("int8 embeddings", None, "int8"),
+    ("int8 model", "int8", "float32"),
+    ("int8 model + embeddings", "int8", "int8"),
+]
+
+results = {}
+for name, quantize, emb_dtype in modes:
+    config = {
+        "mode": "eval",
+        "model_path": "{}/{}/generated/model".format(base_url, wiki_version),
+        "quantize": quantize,
+        "emb_dtype": emb_dtype,
+        "preload_embeddings": False,
+    }
+    model = EntityDisambiguation(base_url, wiki_version, config)
+    results[name] = model.evaluate(datasets)
+
+print("{:<25} {:<12} {:>8} {:>10}".format("Mode", "Dataset", "F1", "Time (s)"))
+for name, result in results.items():
+    for dname, r in result.items():
+        print(
+            "{:<25} {:<12} {:>8.4f} {:>10.2f}".format(name, dname, r["f1"], r["time"])
+        )
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pickle
+import shutil
+import sqlite3
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from REL.db.base import SQLITE_MAX_VARIABLES
+from REL.db.generic import GenericLookup
+from REL.mention_detection import MentionDetection
+from REL.utils import preprocess_mentions, preprocess_mentions_lookup
+
+
+def get_wiki_db():
+    return GenericLookup(
+        "entity_word_embedding", Path(__file__).parent / "wiki_test" / "generated"
+    )
+
+
+def test_batched_lookup():
+    wiki_db = get_wiki_db()
+    c = wiki_db.db.cursor()
+
+    def select(q, w):
+        row = c.execute(q, (w,)).fetchone()
+        return None if row is None else row[0]
+
+    # More distinct keys than fit in a single IN (...) query.
+    missing = ["missing_{}".format(i) for i in range(2 * SQLITE_MAX_VARIABLES)]
+
+    words = ["the", "zebra", "fox", "the"] + missing + ["dog"]
+    embs = wiki_db.emb(words, "embeddings")
+    assert [e is None for e in embs[:4]] == [False, True, False, False]
+    for w, e in zip(words, embs):
+        emb = select("select emb from embeddings where word = ?", w)
+        assert e == (None if emb is None else array("f", emb).tolist())
+
+    mentions = ["Fox", "zebra", "fox", "BROWN"] + missing + ["brown"]
+    p_e_m = wiki_db.wiki_batch(mentions, "wiki", "p_e_m")
+    assert p_e_m[0] is not None
+    for m, candidates in zip(mentions, p_e_m):
+        row = select("select p_e_m from wiki where word = ?", m)
+        assert candidates == (None if row is None else wiki_db.binary_to_dict(row))
+    assert wiki_db.wiki_batch(mentions, "wiki", "freq") == [
+        select("select freq from wiki where word = ?", m) for m in mentions
+    ]
+
+    lowers = ["fox", "zebra", "brown"] + missing
+    assert wiki_db.wiki_batch(lowers, "wiki", "lower") == [
+        select("select word from wiki where lower = ? order by rowid limit 1", m)
+        for m in lowers
+    ]
+    assert wiki_db.wiki_batch([], "wiki", "freq") == []
+
+
+def test_p_e_m_format():
+    wiki_db = get_wiki_db()
+    p_e_m = [["Fox", 0.5], ["Fox_(band)", 0.25], ["Zoë_(film)", 0.125]]
+
+    binary = wiki_db.dict_to_binary(p_e_m)
+    assert isinstance(binary, bytes)
+    assert wiki_db.binary_to_dict(binary) == p_e_m
+
+    # The test database still uses the legacy bit-string format.
+    legacy = wiki_db.db.execute("select p_e_m from wiki where word = 'Fox'").fetchone()
+    assert isinstance(legacy[0], str)
+    assert wiki_db.wiki("Fox", "wiki") == wiki_db.binary_to_dict(legacy[0])
+
+
+def test_migrate_p_e_m(tmp_path):
+    db_path = (
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db"
+    )
+    shutil.copy(db_path, tmp_path / "entity_word_embedding.db")
+
+    wiki_db = get_wiki_db()
+    migrated_db = GenericLookup(
+        "entity_word_embedding",
+        tmp_path,
+        table_name="wiki",
+        columns={"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+    )
+    words = [w for w, in wiki_db.db.execute("select word from wiki")]
+    assert migrated_db.migrate_p_e_m(batch_size=5) == len(words)
+
+    types = migrated_db.db.execute("select distinct typeof(p_e_m) from wiki")
+    assert [t for t, in types] == ["blob"]
+    p_e_m = migrated_db.db.execute("select p_e_m from wiki").fetchone()[0]
+    assert isinstance(p_e_m, bytes)
+
+    # Results are unchanged, apart from the probabilities being stored as float32.
+    for column in ["p_e_m", "freq", "lower"]:
+        for old, new in zip(
+            wiki_db.wiki_batch(words, "wiki", column),
+            migrated_db.wiki_batch(words, "wiki", column),
+        ):
+            if column == "p_e_m":
+                assert [e for e, _ in new] == [e for e, _ in old]
+                assert [p for _, p in new] == [array("f", [p])[0] for _, p in old]
+            else:
+                assert new == old
+
+    # Rows that were converted already are skipped.
+    assert migrated_db.migrate_p_e_m(vacuum=False) == 0
+
+
+def test_emb_matrix(tmp_path):
+    db_path = (
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db"
+    )
+    shutil.copy(db_path, tmp_path / "entity_word_embedding.db")
+
+    emb_db = GenericLookup("entity_word_embedding", tmp_path)
+    emb_db.export_emb_matrix("embeddings")
+    emb_mmap = GenericLookup("entity_word_embedding", tmp_path, emb_backend="mmap")
+
+    words = ["the", "zebra", "fox", "#WORD/UNK#"]
+    for e, e_mmap in zip(
+        emb_db.emb(words, "embeddings"), emb_mmap.emb(words, "embeddings")
+    ):
+        if e is None:
+            assert e_mmap is None
+        else:
+            assert e == e_mmap.tolist()
+
+
+def test_wiki_cache():
+    wiki_db = get_wiki_db()
+    cached_db = GenericLookup(
+        "entity_word_embedding",
+        Path(__file__).parent / "wiki_test" / "generated",
+        cache_size=40,
+    )
+
+    # The cache is bounded by the number of candidates, "fox" has 29 of them.
+    mentions = ["fox", "zebra", "fox"]
+    assert cached_db.wiki_batch(mentions, "wiki") == wiki_db.wiki_batch(
+        mentions, "wiki"
+    )
+    assert cached_db.cache_info() == {
+        "hits": 0,
+        "misses": 3,
+        "evictions": 0,
+        "size": 2,
+        "weight": 30,
+        "maxsize": 40,
+    }
+
+    # Negative results are cached as well.
+    assert cached_db.wiki("zebra", "wiki") is None
+    assert cached_db.wiki("jumped", "wiki", "freq") == wiki_db.wiki(
+        "jumped", "wiki", "freq"
+    )
+    assert cached_db.cache_info()["weight"] == 31
+
+    # The 22 candidates of "lazy" evict the least recently used "fox".
+    assert cached_db.wiki("lazy", "wiki") == wiki_db.wiki("lazy", "wiki")
+    info = cached_db.cache_info()
+    assert (info["hits"], info["evictions"], info["size"], info["weight"]) == (
+        1,
+        1,
+        3,
+        24,
+    )
+
+    # Candidate lists that exceed the cache are not cached.
+    assert cached_db.wiki("Fox", "wiki") == wiki_db.wiki("Fox", "wiki")
+    assert cached_db.cache_info()["size"] == 3
+
+
+def test_read_only():
+    wiki_db = get_wiki_db()
+    ro_db = GenericLookup(
+        "entity_word_embedding",
+        Path(__file__).parent / "wiki_test" / "generated",
+        read_only=True,
+    )
+    mentions = ["Fox", "zebra", "brown"]
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda m: ro_db.wiki(m, "wiki"), mentions * 4))
+    assert results == wiki_db.wiki_batch(mentions * 4, "wiki")
+
+    ro_db = pickle.loads(pickle.dumps(ro_db))
+    assert ro_db.wiki_batch(mentions, "wiki") == wiki_db.wiki_batch(mentions, "wiki")
+
+
+def test_read_write_default(tmp_path):
+    generated = tmp_path / "wiki_test" / "generated"
+    generated.mkdir(parents=True)
+    shutil.copy(
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db",
+        generated,
+    )
+
+    md = MentionDetection(tmp_path, "wiki_test", cache_size=0)
+    assert not md.wiki_db.read_only
+    freq = md.wiki_db.wiki("Fox", "wiki", "freq")
+
+    # Changes to the database are visible, as it is not opened as immutable.
+    db = sqlite3.connect(generated / "entity_word_embedding.db")
+    db.execute("update wiki set freq = ? where word = 'Fox'", (freq + 1,))
+    db.commit()
+    db.close()
+    assert md.wiki_db.wiki("Fox", "wiki", "freq") == freq + 1
+
+
+def test_read_only_changes(tmp_path):
+    shutil.copy(
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db",
+        tmp_path,
+    )
+    ro_db = GenericLookup("entity_word_embedding", tmp_path, read_only=True)
+    freq = ro_db.wiki("Fox", "wiki", "freq")
+
+    # Read-only connections cannot write, but see changes as they are not immutable.
+    with pytest.raises(sqlite3.OperationalError):
+        ro_db.db.execute("update wiki set freq = 0 where word = 'Fox'")
+    db = sqlite3.connect(tmp_path / "entity_word_embedding.db")
+    db.execute("update wiki set freq = ? where word = 'Fox'", (freq + 1,))
+    db.commit()
+    db.close()
+    assert ro_db.wiki("Fox", "wiki", "freq") == freq + 1
+
+    with pytest.raises(ValueError):
+        GenericLookup("entity_word_embedding", tmp_path, immutable=True)
+
+
+def test_resolved_alias(tmp_path):
+    db_path = (
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db"
+    )
+    shutil.copy(db_path, tmp_path / "entity_word_embedding.db")
+
+    wiki_db = get_wiki_db()
+    alias_db = GenericLookup(
+        "entity_word_embedding",
+        tmp_path,
+        table_name="wiki",
+        columns={"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+    )
+    assert alias_db.load_resolved_alias() > 0
+
+    mentions = ["FOX", "fox", "Fox,", "(Fox)", "zebra"]
+    assert alias_db.wiki_alias(mentions)[-1] is None
+    assert preprocess_mentions(mentions, alias_db) == preprocess_mentions(
+        mentions, wiki_db
+    )
+
+    # The alias rows only hold the canonical mention, whose candidates and frequency
+    # are joined from the wiki table.
+    columns = [
+        row[1] for row in alias_db.db.execute("pragma table_info(resolved_alias)")
+    ]
+    assert columns == ["word", "mention"]
+    aliases = alias_db.wiki_alias(mentions, column_name=("mention", "p_e_m", "freq"))
+    for alias in aliases[:-1]:
+        mention, p_e_m, freq = alias
+        assert p_e_m == wiki_db.wiki(mention, "wiki", "p_e_m")
+        assert freq == wiki_db.wiki(mention, "wiki", "freq")
+
+    for column in ["p_e_m", "freq"]:
+        assert preprocess_mentions_lookup(
+            mentions, alias_db, column
+        ) == preprocess_mentions_lookup(mentions, wiki_db, column)
+
+    # Aliased mentions need no lookup in the wiki table.
+    alias_db.wiki_cache.clear()
+    queries = []
+    alias_db.db.set_trace_callback(queries.append)
+    preprocess_mentions_lookup(mentions[:-1], alias_db)
+    alias_db.db.set_trace_callback(None)
+    assert queries and all("from resolved_alias " in q for q in queries)
+
+    # Only mentions that occur at least min_freq times are resolved ahead of time.
+    assert alias_db.load_resolved_alias(min_freq=10000) > 0
+    assert alias_db.wiki_alias(["Fox", "over"]) == ["Fox", None]
+
+
+def test_bloom(tmp_path):
+    db_path = (
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db"
+    )
+    shutil.copy(db_path, tmp_path / "entity_word_embedding.db")
+
+    wiki_db = get_wiki_db()
+    bloom_db = GenericLookup(
+        "entity_word_embedding",
+        tmp_path,
+        table_name="wiki",
+        columns={"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+    )
+    bloom_db.build_bloom(fp_rate=0.001)
+
+    bloom = bloom_db.get_bloom("wiki")
+    words = [w for w, in wiki_db.db.execute("select word from wiki")]
+    assert all("w:" + w in bloom for w in words)
+
+    mentions = ["Fox", "zebra", "BROWN", "brown"]
+    for column in ["p_e_m", "freq", "lower"]:
+        assert bloom_db.wiki_batch(mentions, "wiki", column) == wiki_db.wiki_batch(
+            mentions, "wiki", column
+        )
+    assert preprocess_mentions(mentions, bloom_db) == preprocess_mentions(
+        mentions, wiki_db
+    )
+
+    # The filter is ignored once the database changes.
+    db = sqlite3.connect(tmp_path / "entity_word_embedding.db")
+    db.execute("insert into wiki(word, lower, freq) values ('zebra', 'zebra', 7)")
+    db.commit()
+    db.close()
+    bloom_db = GenericLookup("entity_word_embedding", tmp_path)
+    assert bloom_db.get_bloom("wiki") is None
+    assert bloom_db.wiki("zebra", "wiki", "freq") == 7
+
+
+def test_bloom_alias(tmp_path):
+    db_path = (
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db"
+    )
+    shutil.copy(db_path, tmp_path / "entity_word_embedding.db")
+
+    wiki_db = get_wiki_db()
+    bloom_db = GenericLookup(
+        "entity_word_embedding",
+        tmp_path,
+        table_name="wiki",
+        columns={"p_e_m": "blob", "lower": "text", "freq": "INTEGER"},
+    )
+    bloom_db.load_resolved_alias()
+    bloom_db.build_bloom(fp_rate=0.001)
+    assert bloom_db.get_bloom("resolved_alias") is not None
+
+    mentions = ["Fox,", "FOX", "(Fox)", "brown", "zebra"]
+    assert preprocess_mentions_lookup(mentions, bloom_db) == preprocess_mentions_lookup(
+        mentions, wiki_db
+    )
+
+    # A mention that is neither an alias nor a mention is not looked up at all.
+    queries = []
+    bloom_db = GenericLookup("entity_word_embedding", tmp_path)
+    bloom_db.db.set_trace_callback(queries.append)
+    for lookup in [preprocess_mentions, preprocess_mentions_lookup]:
+        assert lookup(["Qwertyuiop"], bloom_db)[0] in [
+            "Qwertyuiop",
+            ("Qwertyuiop", None),
+        ]
+    assert queries == []
@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from pathlib import Path
 
+import numpy as np
+import torch
+from sklearn.linear_model import LogisticRegression
+
 from REL.entity_disambiguation import EntityDisambiguation
+from REL.mention_batch import MODEL_INPUTS
 from REL.mention_detection import MentionDetection
 from REL.ner import Cmns
 from REL.utils import process_results
@@ -32,3 +42,359 @@ def test_pipeline():
     gold_truth = {"test_doc": [(10, 3, "Fox", "fox", -1, "NULL", 0.0)]}
 
     return results == gold_truth
+
+
+def test_bounded_embeddings():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["Dog over fox", [[0, 3], [9, 3]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    predictions, _ = EntityDisambiguation(base_url, wiki_subfolder, config).predict(
+        mentions_dataset
+    )
+
+    model = EntityDisambiguation(
+        base_url, wiki_subfolder, {**config, "max_embeddings": 4}
+    )
+    for _ in range(2):
+        for doc in sample:
+            predictions_doc, _ = model.predict({doc: mentions_dataset[doc]})
+            assert predictions_doc[doc] == predictions[doc]
+
+    assert model.embedding_stats()["word"]["evictions"] > 0
+
+
+def test_bounded_embeddings_prepared():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["Dog over fox", [[0, 3], [9, 3]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+
+    # Datasets are prepared up front by train and evaluate, and predicted afterwards.
+    results = []
+    for max_embeddings in [None, 4]:
+        model = EntityDisambiguation(
+            base_url, wiki_subfolder, {**config, "max_embeddings": max_embeddings}
+        )
+        data = [
+            model.get_data_items(
+                {doc: mentions_dataset[doc]}, "raw", predict=True, evict=False
+            )
+            for doc in sample
+        ]
+
+        # The IDs of the first dataset still refer to the same tokens and embeddings.
+        tokens, vectors = [], []
+        for batches in data:
+            for batch in batches:
+                for key, name in [
+                    ("token_ids", "word"),
+                    ("s_ltoken_ids", "snd"),
+                    ("s_rtoken_ids", "snd"),
+                    ("s_mtoken_ids", "snd"),
+                    ("cands", "entity"),
+                ]:
+                    ids = batch.tensors[key]
+                    voca = model.embeddings[name + "_voca"]
+                    tokens.append([voca.id2word[i] for i in ids.view(-1).tolist()])
+                    vectors.append(model.embeddings[name + "_embeddings"].weight[ids])
+
+        predictions = {}
+        for batches in data:
+            predictions.update(
+                model._EntityDisambiguation__predict(batches, eval_raw=True)
+            )
+        results.append((tokens, vectors, predictions))
+
+    (tokens, vectors, predictions), (tokens_b, vectors_b, predictions_b) = results
+    assert tokens_b == tokens
+    assert predictions_b == predictions
+    for v, v_b in zip(vectors, vectors_b):
+        assert torch.equal(v_b, v)
+
+
+def test_preloaded_embeddings():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {"doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]]}
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    predictions, _ = EntityDisambiguation(base_url, wiki_subfolder, config).predict(
+        mentions_dataset
+    )
+
+    model = EntityDisambiguation(
+        base_url, wiki_subfolder, {**config, "preload_embeddings": True}
+    )
+    # Embeddings must not be retrieved while predicting.
+    model.emb = model.g_emb = None
+    predictions_preloaded, _ = model.predict(mentions_dataset)
+    assert predictions_preloaded == predictions
+
+
+def test_concurrent_predict():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["Dog over fox", [[0, 3], [9, 3]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+        "max_embeddings": 4,
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions = {
+        doc: model.predict({doc: mentions_dataset[doc]})[0][doc] for doc in sample
+    }
+
+    def predict(doc):
+        return model.predict({doc: deepcopy(mentions_dataset[doc])})[0][doc]
+
+    docs = list(sample) * 20
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for doc, predictions_doc in zip(docs, executor.map(predict, docs)):
+            assert predictions_doc == predictions[doc]
+
+
+def test_export_torchscript(tmp_path):
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["fox", [[0, 3]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+        "preload_embeddings": True,
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+
+    path = str(tmp_path / "ranker.pt")
+    model.export_torchscript(path, {"doc1": deepcopy(mentions_dataset["doc1"])})
+    traced = torch.jit.load(path)
+
+    # The traced ranker takes the inputs in the order of MODEL_INPUTS and generalizes to
+    # documents with a different number of mentions.
+    model.coref.with_coref(mentions_dataset)
+    data = model.get_data_items(mentions_dataset, "raw", predict=True)
+    for batch in data:
+        inputs, _ = batch.inputs(model.device)
+        with torch.no_grad():
+            scores, _ = model.model.forward(embeddings=model.embeddings, **inputs)
+            scores_traced, _ = traced(*[inputs[k] for k in MODEL_INPUTS])
+        assert torch.allclose(scores_traced, scores, atol=1e-5)
+
+
+def test_reduced_precision():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["Dog over fox and the lazy Brown fox", [[0, 3], [9, 3], [21, 4]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+    # Maximum difference of a score with the float32 model.
+    atol = 1e-3
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions, _ = model.predict(deepcopy(mentions_dataset))
+    embeddings = model.embeddings
+
+    for emb_dtype, emb_tol in [("bfloat16", 1e-2), ("int8", 1e-2)]:
+        for quantize in [None, "int8"]:
+            model = EntityDisambiguation(
+                base_url,
+                wiki_subfolder,
+                {**config, "emb_dtype": emb_dtype, "quantize": quantize},
+            )
+            predictions_reduced, _ = model.predict(deepcopy(mentions_dataset))
+            for doc in sample:
+                for p, p_reduced in zip(predictions[doc], predictions_reduced[doc]):
+                    assert p_reduced["prediction"] == p["prediction"]
+                    assert np.allclose(
+                        np.array(p_reduced["scores"], dtype=float),
+                        np.array(p["scores"], dtype=float),
+                        atol=atol,
+                    )
+
+            # The embeddings are stored in reduced precision and looked up as float32.
+            assert len(model.embeddings["word_voca"].id2word) > 1
+            for name in ["word", "entity", "snd"]:
+                layer = model.embeddings[name + "_embeddings"]
+                assert layer.weight.dtype == getattr(torch, emb_dtype)
+                voca, voca_float = (
+                    model.embeddings[name + "_voca"],
+                    embeddings[name + "_voca"],
+                )
+                words = [w for w in voca.id2word if w is not None]
+                vecs = embeddings[name + "_embeddings"](
+                    torch.LongTensor([voca_float.get_id(w) for w in words])
+                )
+                vecs_reduced = layer(torch.LongTensor([voca.get_id(w) for w in words]))
+                # Relative to the largest component of each embedding.
+                scale = vecs.abs().max(dim=1, keepdim=True)[0]
+                assert torch.allclose(vecs_reduced / scale, vecs / scale, atol=emb_tol)
+
+            linear = type(model.model.ctx_layer[0])
+            if quantize is None:
+                assert linear is torch.nn.Linear
+            else:
+                assert linear is torch.ao.nn.quantized.dynamic.Linear
+            assert type(model.model.score_combine[0]) is torch.nn.Linear
+
+
+def test_sparse_lbp():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    text = " ".join(["the brown fox jumped over the lazy dog"] * 10)
+    sample = {"doc1": [text, [[10 + 39 * i, 3] for i in range(10)]]}
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    predictions, _ = EntityDisambiguation(base_url, wiki_subfolder, config).predict(
+        deepcopy(mentions_dataset)
+    )
+
+    # Mentions exchange messages with all other mentions, including the padding entity.
+    model = EntityDisambiguation(base_url, wiki_subfolder, {**config, "lbp_window": 10})
+    assert model.predict(deepcopy(mentions_dataset))[0] == predictions
+
+    model = EntityDisambiguation(
+        base_url,
+        wiki_subfolder,
+        {**config, "lbp_window": 3, "max_batch_mentions": None},
+    )
+    predictions_sparse, _ = model.predict(deepcopy(mentions_dataset))
+    assert len(predictions_sparse["doc1"]) == len(predictions["doc1"])
+
+
+def test_lbp_tol():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    text = " ".join(["the brown fox jumped over the lazy dog"] * 10)
+    sample = {"doc1": [text, [[10 + 39 * i, 3] for i in range(10)]]}
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions, _ = model.predict(deepcopy(mentions_dataset))
+    assert model.lbp_stats()["documents"] == 1
+    assert model.lbp_stats()["mean_iterations"] == model.config["n_loops"]
+
+    model = EntityDisambiguation(base_url, wiki_subfolder, {**config, "lbp_tol": 0.2})
+    predictions_tol, _ = model.predict(deepcopy(mentions_dataset))
+    assert model.lbp_stats()["mean_iterations"] < model.config["n_loops"]
+    assert [p["prediction"] for p in predictions_tol["doc1"]] == [
+        p["prediction"] for p in predictions["doc1"]
+    ]
+
+
+def test_lr_confidence(tmp_path):
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {"doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]]}
+    for name in ["model.config", "model.state_dict"]:
+        shutil.copy(base_url / wiki_subfolder / "generated" / name, tmp_path)
+    config = {"mode": "eval", "model_path": f"{tmp_path}/model"}
+
+    model_lr = LogisticRegression()
+    model_lr.fit(np.array([[-1.0], [0.0], [0.5], [1.0]]), np.array([0, 0, 1, 1]))
+    with open(tmp_path / "lr_model.pkl", "wb") as f:
+        pickle.dump(model_lr, f)
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions, _ = model.predict(deepcopy(mentions_dataset))
+    for p in predictions["doc1"]:
+        score = max(float(s) for s in p["scores"])
+        expected = model_lr.predict_proba(np.array([[score]]))[0, 1]
+        assert abs(p["conf_ed"] - expected) < 1e-6
+
+    with open(tmp_path / "lr_model.json", "w") as f:
+        json.dump({"coef": [0.0], "intercept": 0.0}, f)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions, _ = model.predict(deepcopy(mentions_dataset))
+    assert [p["conf_ed"] for p in predictions["doc1"]] == [0.5, 0.5]
+
+
+def test_packed_documents():
+    base_url = Path(__file__).parent
+    wiki_subfolder = "wiki_test"
+    sample = {
+        "doc1": ["the brown fox jumped over the lazy dog", [[10, 3], [35, 3]]],
+        "doc2": ["Dog over fox", [[0, 3]]],
+        "doc3": ["the fox and the dog and the fox", [[4, 3], [16, 3], [28, 3]]],
+    }
+    config = {
+        "mode": "eval",
+        "model_path": f"{base_url}/{wiki_subfolder}/generated/model",
+        "lbp_tol": 0.05,
+    }
+
+    md = MentionDetection(base_url, wiki_subfolder)
+    mentions_dataset, _ = md.format_spans(sample)
+    model = EntityDisambiguation(base_url, wiki_subfolder, config)
+    predictions, _ = model.predict(deepcopy(mentions_dataset))
+
+    model = EntityDisambiguation(
+        base_url, wiki_subfolder, {**config, "max_packed_mentions": 10}
+    )
+    predictions_packed, timing = model.predict(deepcopy(mentions_dataset))
+    assert len(timing) == 1
+    assert predictions_packed.keys() == predictions.keys()
+    for doc in sample:
+        assert [p["prediction"] for p in predictions_packed[doc]] == [
+            p["prediction"] for p in predictions[doc]
+        ]
+        for p, p_packed in zip(predictions[doc], predictions_packed[doc]):
+            assert np.allclose(
+                np.array(p["scores"], dtype=float),
+                np.array(p_packed["scores"], dtype=float),
+                atol=1e-6,
+            )
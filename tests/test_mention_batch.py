@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import torch
+
+from REL.mention_batch import pad_ids
+from REL.utils import make_equal_len
+
+
+def test_pad_ids():
+    for lists in [[[1, 2, 3], [], [4]], [[], []], [[5]]]:
+        for to_right in [True, False]:
+            ids, mask = pad_ids(lists, 0, to_right=to_right)
+            eq_lists, eq_mask = make_equal_len(lists, 0, to_right=to_right)
+            assert torch.equal(ids, torch.LongTensor(eq_lists))
+            assert torch.equal(mask, torch.FloatTensor(eq_mask))
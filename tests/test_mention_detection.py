@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pickle
+import random
+import sqlite3
+from pathlib import Path
+
+import pytest
+import torch
+
+from REL.mention_detection import MentionDetection, _init_worker, _worker
+from REL.mention_detection_base import MentionDetectionBase
+from REL.ner import Cmns
+from REL.utils import split_in_words
+
+
+def legacy_get_ctxt(start, end, idx_sent, sentence, sentences_doc):
+    """
+    get_ctxt as it was before the context was sliced from a per-document token index.
+    """
+    left_ctxt = split_in_words(sentence[:start])
+    if idx_sent > 0:
+        i = idx_sent - 1
+        while (i >= 0) and (len(left_ctxt) <= 100):
+            left_ctxt = split_in_words(sentences_doc[i]) + left_ctxt
+            i -= 1
+    left_ctxt = " ".join(left_ctxt[-100:])
+
+    right_ctxt = split_in_words(sentence[end:])
+    if idx_sent < len(sentences_doc):
+        i = idx_sent + 1
+        while (i < len(sentences_doc)) and (len(right_ctxt) <= 100):
+            right_ctxt = right_ctxt + split_in_words(sentences_doc[i])
+            i += 1
+    right_ctxt = " ".join(right_ctxt[:100])
+
+    return left_ctxt, right_ctxt
+
+
+def test_get_ctxt():
+    md = MentionDetectionBase(Path(__file__).parent, "wiki_test")
+
+    rng = random.Random(0)
+    words = [
+        "Fox",
+        "the",
+        "U.S.",
+        "Zoë",
+        "AL-NAHAR",
+        "dog's",
+        "(lazy)",
+        "—",
+        "x,y",
+        "!",
+    ]
+    docs = [
+        [],
+        [""],
+        ["Fox"],
+        ["The brown fox, jumped!", "Over the lazy dog.", "Café Zoë"],
+        # Long documents, such that the context is cut off at 100 words.
+        [" ".join(rng.choices(words, k=rng.randint(0, 80))) for _ in range(6)],
+    ]
+
+    for sentences_doc in docs:
+        doc_tokens = md.tokenize_doc(sentences_doc)
+        for idx_sent, sentence in enumerate(sentences_doc):
+            positions = sorted(
+                rng.sample(range(len(sentence) + 1), min(len(sentence) + 1, 30))
+            )
+            positions = sorted(set(positions + [0, len(sentence)]))
+            for start in positions:
+                for end in [p for p in positions if p >= start]:
+                    expected = legacy_get_ctxt(
+                        start, end, idx_sent, sentence, sentences_doc
+                    )
+                    assert (
+                        md.get_ctxt(
+                            start, end, idx_sent, sentence, sentences_doc, doc_tokens
+                        )
+                        == expected
+                    )
+                    assert (
+                        md.get_ctxt(start, end, idx_sent, sentence, sentences_doc)
+                        == expected
+                    )
+
+    # A sentence that is not part of the tokenized document falls back to tokenizing it.
+    sentences_doc = ["The brown fox.", "Over the dog."]
+    doc_tokens = md.tokenize_doc(sentences_doc)
+    assert md.get_ctxt(4, 9, 0, "A brown Fox!", sentences_doc, doc_tokens) == (
+        legacy_get_ctxt(4, 9, 0, "A brown Fox!", sentences_doc)
+    )
+
+
+def test_parallel():
+    base_url = Path(__file__).parent
+    md = MentionDetection(base_url, "wiki_test")
+    tagger = Cmns(base_url, "wiki_test", n=5)
+
+    texts = [
+        "the brown fox jumped over the lazy dog",
+        "Dog over fox",
+        "The lazy Fox. The brown DOG jumped!",
+        "nothing here",
+        "",
+    ]
+    # Documents are not in sorted order and span several shards.
+    docs = ["doc_{}".format(i) for i in range(12)][::-1]
+    dataset = {doc: [texts[i % len(texts)], []] for i, doc in enumerate(docs)}
+    spans = {
+        doc: [text, [[0, 3], [4, 5]] if len(text) >= 9 else []]
+        for doc, (text, _) in dataset.items()
+    }
+
+    for expected, result in [
+        (
+            md.find_mentions(dataset, tagger),
+            md.find_mentions_parallel(dataset, tagger, n_workers=2, chunk_size=5),
+        ),
+        (
+            md.format_spans(spans),
+            md.format_spans_parallel(spans, n_workers=2, chunk_size=5),
+        ),
+    ]:
+        assert list(result[0]) == list(expected[0])
+        assert result == expected
+        assert result[1] > 0
+
+
+def test_worker_read_only():
+    base_url = Path(__file__).parent
+    md = MentionDetection(base_url, "wiki_test")
+    tagger = Cmns(base_url, "wiki_test", n=5)
+    assert not md.wiki_db.read_only
+
+    n_threads = torch.get_num_threads()
+    try:
+        _init_worker(*pickle.loads(pickle.dumps((md, tagger))))
+    finally:
+        torch.set_num_threads(n_threads)
+
+    # Workers open read-only connections, which cannot write to the database.
+    for wiki_db in [_worker["md"].wiki_db, _worker["tagger"].wiki_db]:
+        assert wiki_db.read_only
+        with pytest.raises(sqlite3.OperationalError):
+            wiki_db.db.execute("update wiki set freq = 0 where word = 'Fox'")
+    assert not md.wiki_db.read_only
+    _worker.clear()
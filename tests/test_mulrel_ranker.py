@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import inspect
+
+import torch
+
+from REL.mention_batch import MODEL_INPUTS
+from REL.mulrel_ranker import MulRelRanker, TracedMulRelRanker
+
+CONFIG = {
+    "emb_dims": 16,
+    "hid_dims": 8,
+    "n_rels": 3,
+    "tok_top_n": 5,
+    "dropout_rate": 0.3,
+    "n_loops": 10,
+    "use_local": True,
+    "use_local_only": False,
+    "use_pad_ent": True,
+    "lbp_window": None,
+    "lbp_tol": None,
+}
+N_WORDS = 50
+N_ENTITIES = 40
+N_CANDS = 4
+
+
+def get_ranker(**config):
+    """
+    Ranker with random weights. The relation embeddings are scaled up, such that LBP
+    changes the scores, unlike for the near-identity initialization.
+    """
+    torch.manual_seed(0)
+    model = MulRelRanker({**CONFIG, **config}, torch.device("cpu"))
+    with torch.no_grad():
+        model.rel_embs.normal_(0, 0.5)
+        model.ew_embs.normal_(0, 0.5)
+    model.eval()
+
+    embeddings = {
+        "word_embeddings": torch.nn.Embedding(N_WORDS, CONFIG["emb_dims"]),
+        "entity_embeddings": torch.nn.Embedding(N_ENTITIES, CONFIG["emb_dims"]),
+        "snd_embeddings": torch.nn.Embedding(N_WORDS, CONFIG["emb_dims"]),
+    }
+    return model, embeddings
+
+
+def get_inputs(n_ments, seed):
+    """
+    :return: random inputs of MulRelRanker.forward for a document with n_ments mentions.
+    """
+    g = torch.Generator().manual_seed(seed)
+
+    def ids(n, high):
+        return torch.randint(high, (n_ments, n), generator=g)
+
+    def mask(n):
+        m = (torch.rand(n_ments, n, generator=g) < 0.8).float()
+        m[:, 0] = 1
+        return m
+
+    p_e_m = torch.rand(n_ments, N_CANDS, generator=g)
+    return {
+        "token_ids": ids(8, N_WORDS),
+        "tok_mask": mask(8),
+        "entity_ids": ids(N_CANDS, N_ENTITIES),
+        "entity_mask": mask(N_CANDS),
+        "p_e_m": p_e_m / p_e_m.sum(dim=1, keepdim=True),
+        "s_ltoken_ids": ids(3, N_WORDS),
+        "s_ltoken_mask": mask(3),
+        "s_rtoken_ids": ids(3, N_WORDS),
+        "s_rtoken_mask": mask(3),
+        "s_mtoken_ids": ids(2, N_WORDS),
+        "s_mtoken_mask": mask(2),
+    }
+
+
+def pack(docs):
+    """
+    :return: inputs of the mentions of all documents and the document index of each mention.
+    """
+    inputs = {k: torch.cat([doc[k] for doc in docs]) for k in MODEL_INPUTS}
+    doc_ids = torch.cat(
+        [torch.full((len(doc["p_e_m"]),), i) for i, doc in enumerate(docs)]
+    )
+    return inputs, doc_ids
+
+
+def forward(model, embeddings, inputs, **kwargs):
+    with torch.no_grad():
+        scores, _ = model.forward(embeddings=embeddings, **inputs, **kwargs)
+    return scores
+
+
+def record_lbp(model):
+    """
+    :return: list to which the messages and iterations of each LBP run of the model are added.
+    """
+    runs = []
+    lbp = model._MulRelRanker__lbp
+
+    def recorded(*args):
+        runs.append(lbp(*args))
+        return runs[-1]
+
+    model._MulRelRanker__lbp = recorded
+    return runs
+
+
+def test_lbp_tol():
+    tol = 1e-3
+    n_loops = 100
+    for use_pad_ent in [True, False]:
+        for n_ments in [4, 8]:
+            inputs = get_inputs(n_ments, seed=n_ments)
+
+            results = []
+            for lbp_tol in [None, tol]:
+                model, embeddings = get_ranker(
+                    use_pad_ent=use_pad_ent, n_loops=n_loops, lbp_tol=lbp_tol
+                )
+                runs = record_lbp(model)
+                lbp_stats = {}
+                scores = forward(model, embeddings, inputs, lbp_stats=lbp_stats)
+                results.append((scores, runs[0][0], lbp_stats))
+            (scores, msgs, stats), (scores_tol, msgs_tol, stats_tol) = results
+
+            # LBP changes the scores, so the ranker is not degenerate.
+            model, embeddings = get_ranker(use_pad_ent=use_pad_ent, n_loops=0)
+            assert (forward(model, embeddings, inputs) - scores).abs().max() > 10 * tol
+
+            assert stats == {"documents": 1, "iterations": n_loops}
+            assert stats_tol["documents"] == 1
+            assert stats_tol["iterations"] < n_loops
+            # Messages are compared as probabilities.
+            assert (msgs_tol.exp() - msgs.exp()).abs().max() < tol
+            assert (scores_tol - scores).abs().max() < tol
+
+
+def test_lbp_stats():
+    # Documents that are packed into a single batch stop and are counted separately.
+    model, embeddings = get_ranker(n_loops=100, lbp_tol=1e-3)
+    docs = [get_inputs(n_ments, seed=n_ments) for n_ments in [3, 8, 5]]
+
+    iterations = 0
+    for inputs in docs:
+        lbp_stats = {}
+        forward(model, embeddings, inputs, lbp_stats=lbp_stats)
+        assert lbp_stats["documents"] == 1
+        iterations += lbp_stats["iterations"]
+
+    inputs, doc_ids = pack(docs)
+    lbp_stats = {}
+    forward(model, embeddings, inputs, lbp_stats=lbp_stats, doc_ids=doc_ids)
+    assert lbp_stats == {"documents": len(docs), "iterations": iterations}
+
+
+def test_sparse_lbp():
+    model, embeddings = get_ranker()
+    n_rels = CONFIG["n_rels"]
+    for n_ments in [3, 9]:
+        g = torch.Generator().manual_seed(n_ments)
+        rel_ctx_ctx_scores = torch.randn(n_rels, n_ments, n_ments, generator=g) * 3
+        rel_ctx_ctx_scores += torch.eye(n_ments).mul(-1e10)
+        entity_ids = torch.randint(N_ENTITIES, (n_ments, N_CANDS), generator=g)
+        ent_vecs = embeddings["entity_embeddings"](entity_ids)
+        entity_mask = (torch.rand(n_ments, N_CANDS, generator=g) < 0.8).float()
+        entity_mask[:, 0] = 1
+        local_ent_scores = torch.randn(n_ments, N_CANDS, generator=g)
+
+        with torch.no_grad():
+            dense, _ = model._MulRelRanker__dense_ent_scores(
+                rel_ctx_ctx_scores.clone().unsqueeze(1),
+                ent_vecs.unsqueeze(0),
+                entity_mask.unsqueeze(0),
+                local_ent_scores.unsqueeze(0),
+            )
+            # Each mention exchanges messages with all other mentions.
+            sparse, _ = model._MulRelRanker__sparse_ent_scores(
+                rel_ctx_ctx_scores.clone(),
+                ent_vecs,
+                entity_mask,
+                local_ent_scores,
+                n_ments - 1,
+            )
+        assert torch.allclose(sparse, dense[0], atol=1e-5)
+
+    # A window of fewer mentions than the document has changes the scores.
+    inputs = get_inputs(9, seed=0)
+    scores = forward(model, embeddings, inputs)
+    for lbp_window in [9, 12]:
+        model_window, _ = get_ranker(lbp_window=lbp_window)
+        assert torch.allclose(forward(model_window, embeddings, inputs), scores)
+    model_window, _ = get_ranker(lbp_window=2)
+    assert (forward(model_window, embeddings, inputs) - scores).abs().max() > 1e-3
+
+
+def test_packed_documents():
+    # A document with a single mention only uses its local scores without the padding
+    # entity, and with lbp_tol the documents stop after different numbers of iterations.
+    docs = [get_inputs(n_ments, seed=n_ments) for n_ments in [3, 1, 6, 2]]
+    inputs, doc_ids = pack(docs)
+
+    for use_pad_ent in [True, False]:
+        for lbp_tol in [None, 1e-3]:
+            model, embeddings = get_ranker(
+                use_pad_ent=use_pad_ent, n_loops=100, lbp_tol=lbp_tol
+            )
+            scores = torch.cat([forward(model, embeddings, doc) for doc in docs])
+            scores_packed = forward(model, embeddings, inputs, doc_ids=doc_ids)
+            assert torch.allclose(scores_packed, scores, atol=1e-5)
+
+            # Mentions of other documents would change the scores.
+            assert (forward(model, embeddings, inputs) - scores).abs().max() > 1e-3
+
+
+def test_traced_ranker():
+    # Positional inputs of the traced ranker, as passed by EntityDisambiguation.
+    parameters = list(inspect.signature(TracedMulRelRanker.forward).parameters)
+    assert parameters[1:] == MODEL_INPUTS
+
+    model, embeddings = get_ranker()
+    ranker = TracedMulRelRanker(model, embeddings, pad_id=0)
+    inputs = get_inputs(3, seed=0)
+    with torch.no_grad():
+        traced = torch.jit.trace(ranker, tuple(inputs[k] for k in MODEL_INPUTS))
+
+    # The traced ranker generalizes to documents with a different number of mentions.
+    for n_ments in [1, 2, 3, 8]:
+        inputs = get_inputs(n_ments, seed=n_ments)
+        with torch.no_grad():
+            scores, _ = traced(*[inputs[k] for k in MODEL_INPUTS])
+        assert scores.shape == (n_ments, N_CANDS)
+        assert torch.allclose(scores, forward(model, embeddings, inputs), atol=1e-5)
@@ -3,6 +3,7 @@
 
 from pathlib import Path
 
+from REL.mention_detection import MentionDetection
 from REL.ner import Cmns, Span
 
 
@@ -29,3 +30,22 @@ def test_cmns():
     ]
 
     return compare_spans(predictions, labels)
+
+
+def test_find_mentions_iter():
+    base_url = Path(__file__).parent
+    md = MentionDetection(base_url, "wiki_test")
+    tagger = Cmns(base_url, "wiki_test", n=5)
+    dataset = {
+        "doc1": ["the brown fox jumped over the lazy dog", []],
+        "doc2": ["The Fox . Brown dog over the lazy fox .", []],
+        "doc3": ["nothing here", []],
+    }
+
+    predictions, _ = md.find_mentions(dataset, tagger)
+    streamed = md.find_mentions_iter(
+        ((doc, text, spans) for doc, (text, spans) in dataset.items()),
+        tagger,
+        chunk_size=1,
+    )
+    assert dict(streamed) == predictions
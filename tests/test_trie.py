@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import shutil
+import sqlite3
+from pathlib import Path
+
+from REL.ner import Span, TrieTagger
+
+
+def test_trie(tmp_path):
+    generated = tmp_path / "wiki_test" / "generated"
+    generated.mkdir(parents=True)
+    shutil.copy(
+        Path(__file__).parent / "wiki_test" / "generated" / "entity_word_embedding.db",
+        generated,
+    )
+    db = sqlite3.connect(generated / "entity_word_embedding.db")
+    db.executemany(
+        "insert into wiki(word, lower, freq) values (?, ?, ?)",
+        [("New York", "new york", 10), ("New York City", "new york city", 5)],
+    )
+    db.commit()
+    db.close()
+
+    model = TrieTagger(tmp_path, "wiki_test", min_freq=5)
+    predictions = model.predict("the fox in New  York City, New York", None)
+    assert predictions == [
+        Span("the", 0, 3, 10786, "#TRIE#"),
+        Span("fox", 4, 7, 6263, "#TRIE#"),
+        Span("New  York City", 11, 25, 5, "#TRIE#"),
+        Span("New York", 27, 35, 10, "#TRIE#"),
+    ]
+    assert (generated / "trie_5" / "tokens.npy").is_file()
+    assert TrieTagger(tmp_path, "wiki_test", min_freq=5).predict("New", None) == []
+
+    # The cached trie is rebuilt once the database changes.
+    db = sqlite3.connect(generated / "entity_word_embedding.db")
+    db.execute("insert into wiki(word, lower, freq) values ('Zebra', 'zebra', 7)")
+    db.commit()
+    db.close()
+    assert TrieTagger(tmp_path, "wiki_test", min_freq=5).predict("Zebra", None) == [
+        Span("Zebra", 0, 5, 7, "#TRIE#")
+    ]
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+from pathlib import Path
+
+from REL.db.generic import GenericLookup
+from REL.utils import modify_uppercase_phrase, preprocess_mention, preprocess_mentions
+
+
+def legacy_preprocess_mention(m, wiki_db):
+    """
+    preprocess_mention as it was before the lookups were batched, one query per step.
+    """
+    cur_m = modify_uppercase_phrase(m)
+    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
+
+    if not freq_lookup_cur_m:
+        cur_m = m
+
+    freq_lookup_m = wiki_db.wiki(m, "wiki", "freq")
+    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
+
+    if freq_lookup_m and (freq_lookup_m > freq_lookup_cur_m):
+        cur_m = m
+
+    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
+    if not freq_lookup_cur_m:
+        find_lower = wiki_db.wiki(m.lower(), "wiki", "lower")
+
+        if find_lower:
+            cur_m = find_lower
+
+    freq_lookup_cur_m = wiki_db.wiki(cur_m, "wiki", "freq")
+    if not freq_lookup_cur_m:
+        temp = re.sub(r"[\(.|,|!|')]", "", m).strip()
+        simple_lookup = wiki_db.wiki(temp, "wiki", "freq")
+
+        if simple_lookup:
+            cur_m = temp
+
+    return cur_m
+
+
+def test_preprocess_mentions():
+    wiki_db = GenericLookup(
+        "entity_word_embedding", Path(__file__).parent / "wiki_test" / "generated"
+    )
+
+    words = ["fox", "brown", "lazy", "jumped", "the", "dog", "zebra", "the fox"]
+    casings = [str.lower, str.upper, str.title, lambda w: w[:-1] + w[-1].upper()]
+    wrappers = ["{}", "{},", "({})", "{}.", "{}!", " {} ", "'{}'", "{}'s", "U.S. {}"]
+    mentions = [
+        wrapper.format(casing(w))
+        for w in words
+        for casing in casings
+        for wrapper in wrappers
+    ]
+    mentions += ["", " ", ".", "(,!)", "U.S.", "DoG", "doG", "FOX,", "(LAZY)"]
+
+    expected = [legacy_preprocess_mention(m, wiki_db) for m in mentions]
+    assert preprocess_mentions(mentions, wiki_db) == expected
+    assert [preprocess_mention(m, wiki_db) for m in mentions] == expected